@@ -0,0 +1,108 @@
+import os
+import io
+import sys
+import tempfile
+import unittest
+import contextlib
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from config import CF
+from synt import onto_loop, onto_name, show_totals
+from scheduler import new_scheduler, set_scheduler, seed_name
+
+
+def read_seeds(fname: str) -> list[str]:
+    """The seed questions of a file, one per line, skipping blank lines and # comments."""
+    with open(fname) as f:
+        seeds = [line.strip() for line in f]
+    return [s for s in seeds if s and not s.startswith("#")]
+
+
+def unique_seeds(seeds: list[str], out_dir: str) -> list[str]:
+    """The seeds, without those that would write to the files of an earlier one."""
+    names, unique = set(), []
+    for seed in seeds:
+        name = onto_name(out_dir, seed)
+        if name in names:
+            print("*** SKIPPED seed with the same files as an earlier one:", seed)
+            continue
+        names.add(name)
+        unique.append(seed)
+    return unique
+
+
+def run_seed(seed: str, n: int, out_dir: str) -> float | None:
+    """Run onto_loop for one seed, returning its cost, or None if it failed."""
+    with seed_name(seed):
+        try:
+            _, _, cost = onto_loop(seed, n=n, out_dir=out_dir)
+            return cost
+        except Exception as e:
+            print(f"*** FAILED seed: {seed}: {type(e).__name__}: {e}")
+            return None
+
+
+def run_batch(seeds: list[str], n: int = 4, out_dir=None) -> dict[str, float | None]:
+    """
+    Run onto_loop for many seeds at once, CF.BATCH_SEEDS at a time, writing
+    their files to out_dir. All LLM calls go through one scheduler, with at
+    most CF.LLM_CONCURRENCY calls per backend in flight, shared fairly
+    between the seeds, and through the response cache (CF.BATCH_CACHE), so
+    a rerun only pays for new prompts. Seeds repeating an earlier one are
+    skipped, and no graph is opened in the browser. Return the cost of each seed.
+    """
+    if out_dir is None:
+        out_dir = CF.OUTDIR
+    seeds = unique_seeds(seeds, out_dir)
+    cache, show_graph = CF.CACHE, CF.SHOW_GRAPH
+    if cache == "off":
+        CF.CACHE = CF.BATCH_CACHE
+    CF.SHOW_GRAPH = False
+    set_scheduler(new_scheduler())
+    t1 = time()
+    try:
+        with ThreadPoolExecutor(max_workers=CF.BATCH_SEEDS) as pool:
+            jobs = [pool.submit(run_seed, seed, n, out_dir) for seed in seeds]
+            costs = {seed: job.result() for seed, job in zip(seeds, jobs)}
+
+        failed = [s for s, c in costs.items() if c is None]
+        total = sum(c for c in costs.values() if c is not None)
+        print(f"\nBATCH of {len(seeds)} seeds done, {len(failed)} failed")
+        for seed in failed:
+            print("\tFAILED:", seed)
+        print("BATCH Cost: $%.8f" % total, "total time:", time() - t1)
+        print("BATCH totals of all seeds:")
+        show_totals()
+    finally:
+        set_scheduler(None)
+        CF.CACHE, CF.SHOW_GRAPH = cache, show_graph
+    return costs
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch(self):
+        from mockllm import mock_llm
+
+        seeds = ["What is an FPGA?", "What is a CPU?", "what is an FPGA?"]
+        out = io.StringIO()
+        cache_file = CF.CACHE_FILE
+        with tempfile.TemporaryDirectory() as d, mock_llm(), contextlib.redirect_stdout(out):
+            CF.CACHE_FILE = os.path.join(d, "cache.sqlite")
+            try:
+                costs = run_batch(seeds, n=1, out_dir=d)
+            finally:
+                CF.CACHE_FILE = cache_file
+            self.assertEqual(len([f for f in os.listdir(d) if f.endswith("_kb.tsv")]), 2)
+        self.assertEqual(list(costs), seeds[:2])
+        self.assertTrue(CF.SHOW_GRAPH)
+        self.assertIn("SKIPPED seed", out.getvalue())
+        self.assertEqual(out.getvalue().count("Cache hits:"), 1)  # the totals, once
+
+
+if __name__ == "__main__":  # python batch.py <seeds.txt> [steps]
+    run_batch(read_seeds(sys.argv[1]), n=int(sys.argv[2]) if len(sys.argv) > 2 else 4)
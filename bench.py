@@ -0,0 +1,365 @@
+import os
+import io
+import sys
+import glob
+import json
+import random
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+from collections import defaultdict
+from datetime import datetime
+from time import perf_counter
+from config import CF
+from synt import onto_loop, rank_svos
+from terms import to_edge, parse_edge, uniform_str
+from store import TripleStore
+from redir import redirect_edges_no_backflow
+from rank import rank_dict, node_ranks, nx_node_ranks, triple_scores, top_rows, IncrementalRanker
+from infer import count_inferred
+from concepts import concept_aliases
+from mockllm import mock_llm
+
+SIZES = (1000, 10000, 100000, 1000000)  # edges of the synthetic graphs of the suite
+RESULTS_FILE = "bench_results.jsonl"
+REGRESSION = 1.2  # slowdown flagged by compare_results, for timings above 10ms
+
+_results: list[dict] = []
+
+
+def record(bench: str, size: int, seconds: float, **extra):
+    """Keep the result of a benchmark for save_results."""
+    _results.append({"bench": bench, "size": size, "seconds": round(seconds, 6), **extra})
+
+
+def synthetic_facts(n: int, seed: int = 0) -> list[str]:
+    """Generate n fact lines in the shapes LLMs usually answer with."""
+    rng = random.Random(seed)
+    words = ["fpga", "Instruction_Set", "pipeline", "LogicProgram", "stable-model",
+             "horn_clause", "vector store", "unification", "LLM", "knowledge graph"]
+    verbs = ["is_a_kind_of", "usedFor", "can_lead_to", "is part of", "enables"]
+    facts = []
+    for _ in range(n):
+        s = rng.choice(words) + str(rng.randrange(n // 10 + 1))
+        o = rng.choice(words) + str(rng.randrange(n // 10 + 1))
+        facts.append(f"fact('{s}','{rng.choice(verbs)}','{o}').")
+    return facts
+
+
+def pro_lines(fnames: list[str]) -> list[str]:
+    lines = []
+    for fname in fnames:
+        with open(fname) as f:
+            lines.extend(line.strip() for line in f if line.startswith("fact("))
+    return lines
+
+
+def timed(parse, lines: list[str]) -> tuple[list, float]:
+    uniform_str.cache_clear()
+    with contextlib.redirect_stdout(io.StringIO()):  # mute the warnings
+        t1 = perf_counter()
+        edges = [parse(f) for f in lines]
+        t = perf_counter() - t1
+    return edges, t
+
+
+def bench_to_edge(fnames=None, n: int = 50000):
+    """
+    Compare re-parsing the fact lines of the .pro files in fnames (by default
+    those in CF.OUTDIR, or n synthetic facts if there are none) with the
+    fast path of to_edge and with the full Prolog parser.
+    """
+    if fnames is None:
+        fnames = glob.glob(os.path.join(CF.OUTDIR, "*.pro"))
+    lines = pro_lines(fnames) or synthetic_facts(n)
+    print(f"Parsing {len(lines)} facts from {len(fnames)} files")
+
+    slow, t_slow = timed(parse_edge, lines)
+    fast, t_fast = timed(to_edge, lines)
+    assert fast == slow, "fast path and natlog disagree"
+
+    print("natlog parser: %.3fs (%.0f facts/s)" % (t_slow, len(lines) / t_slow))
+    print("fast path:     %.3fs (%.0f facts/s)" % (t_fast, len(lines) / t_fast))
+    print("speedup: %.1fx" % (t_slow / t_fast))
+    record("to_edge", len(lines), t_fast, rate=len(lines) / t_fast)
+    record("parse_edge", len(lines), t_slow, rate=len(lines) / t_slow)
+    return t_slow, t_fast
+
+
+def synthetic_edges(n: int, seed: int = 0) -> set:
+    """A random graph of about n distinct edges, with a skewed node degree."""
+    rng = random.Random(seed)
+    nodes = max(10, n // 5)
+    verbs = [f"verb_{i}" for i in range(max(5, n // 100))]
+    edges = set()
+    while len(edges) < n:
+        s = f"node_{int(nodes * rng.random() ** 2)}"
+        o = f"node_{rng.randrange(nodes)}"
+        edges.add((s, rng.choice(verbs), o))
+    return edges
+
+
+def adjacency(edges) -> tuple[dict, dict]:
+    """The successor and predecessor sets as consumers used to rebuild them."""
+    succs, preds = defaultdict(set), defaultdict(set)
+    for s, _, o in edges:
+        succs[s].add(o)
+        preds[o].add(s)
+    return succs, preds
+
+
+def bench_store(n: int = 200000):
+    """
+    Compare the memory and adjacency lookup time of a set of tuples and a
+    TripleStore, both loaded from n lines of a merged TSV knowledge base.
+    """
+    lines = ["\t".join(t) for t in synthetic_edges(n)]
+
+    tracemalloc.start()
+    m0 = tracemalloc.get_traced_memory()[0]
+    edges = {tuple(line.split("\t")) for line in lines}
+    m_set = tracemalloc.get_traced_memory()[0] - m0
+    t1 = perf_counter()
+    succs, preds = adjacency(edges)
+    t_set = perf_counter() - t1
+    del succs, preds, edges
+
+    m0 = tracemalloc.get_traced_memory()[0]
+    store = TripleStore(tuple(line.split("\t")) for line in lines)
+    m_store = tracemalloc.get_traced_memory()[0] - m0
+    tracemalloc.stop()
+    t1 = perf_counter()
+    for i in store.node_ids():
+        store.succ_ids(i)
+        store.pred_ids(i)
+    t_store = perf_counter() - t1
+
+    print(f"{n} edges, {len(store.names)} distinct strings")
+    print("set of tuples: %.1f bytes/edge, adjacency rebuild %.3fs" % (m_set / n, t_set))
+    print("TripleStore:   %.1f bytes/edge, all adjacency from indexes %.3fs" % (m_store / n, t_store))
+    return m_set, m_store
+
+
+def bench_rank(sizes=(1000, 10000, 100000, 300000), topn: int = 100):
+    """
+    Time the sparse PageRank with a partial top-n selection against networkx
+    with a full sort, on synthetic graphs of the given sizes, and check that
+    both agree within tolerance.
+    """
+    for n in sizes:
+        store = TripleStore(synthetic_edges(n))
+        with contextlib.redirect_stdout(io.StringIO()):
+            t1 = perf_counter()
+            rs = nx_node_ranks(store)
+            ranked = sorted(store, key=lambda x: rs.get(x[0], 0) + rs.get(x[1], 0), reverse=True)[:topn]
+            t_nx = perf_counter() - t1
+
+            t1 = perf_counter()
+            ranks = node_ranks(store)
+            rows = top_rows(triple_scores(store, ranks), topn)
+            t_sparse = perf_counter() - t1
+
+        diff = max(abs(ranks[store.ids[x]] - r) for x, r in rs.items())
+        same = len(set(ranked) & {store.triple(r) for r in rows})
+        print(
+            "%8d edges: networkx %.3fs sparse %.3fs speedup %.1fx, max rank diff %.1e, top %d overlap %d"
+            % (n, t_nx, t_sparse, t_nx / t_sparse, diff, topn, same)
+        )
+
+
+def bench_incremental(n: int = 100000, steps: int = 20, per_step: int = 200):
+    """
+    Grow a graph of n edges by steps of per_step edges, updating the ranks
+    after each step warm-started, and from scratch for comparison.
+    """
+    edges = list(synthetic_edges(n + steps * per_step))
+    store = TripleStore(edges[:n])
+    ranker = IncrementalRanker(store)
+    t_warm = t_cold = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        ranker.update()
+        for i in range(steps):
+            store.update(edges[n + i * per_step : n + (i + 1) * per_step])
+            t1 = perf_counter()
+            warm = ranker.update()
+            t_warm += perf_counter() - t1
+            t1 = perf_counter()
+            cold = node_ranks(store)
+            t_cold += perf_counter() - t1
+    print(
+        "%d steps of %d edges on %d edges: warm %.3fs cold %.3fs, max rank diff %.1e"
+        % (steps, per_step, n, t_warm, t_cold, np.abs(warm - cold).max())
+    )
+
+
+def bench_redirect(sizes=(10000, 100000, 1000000), topn: int = 100):
+    """Time redirect_edges_no_backflow on synthetic hub-heavy graphs of growing size."""
+    for n in sizes:
+        store = TripleStore(synthetic_edges(n))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ranks = rank_dict(store, node_ranks(store))
+        t1 = perf_counter()
+        out = redirect_edges_no_backflow(store, ranks, topn)
+        t = perf_counter() - t1
+        print("%8d edges: redirected to %d edges in %.3fs (%.0f edges/s)" % (n, len(out), t, n / t))
+        record("redirect", n, t, rate=n / t)
+
+
+def bench_rank_svos(sizes=SIZES, topn: int = 100):
+    """Time rank_svos, PageRank then redirection to the top edges, as at the end of a run."""
+    for n in sizes:
+        store = TripleStore(synthetic_edges(n))
+        with contextlib.redirect_stdout(io.StringIO()):
+            t1 = perf_counter()
+            rank_svos(store, topn, redirect=True)
+            t = perf_counter() - t1
+        print("%8d edges: ranked in %.3fs (%.0f edges/s)" % (n, t, n / t))
+        record("rank_svos", n, t, rate=n / t)
+
+
+def bench_views(sizes=SIZES, views=(25, 50, 100, 500)):
+    """Time rank_svos for all the views at once, against one rank_svos per view."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        rank_svos(synthetic_edges(100), 10)  # imports scipy, outside of the timings
+    for n in sizes:
+        store = TripleStore(synthetic_edges(n))
+        with contextlib.redirect_stdout(io.StringIO()):
+            t1 = perf_counter()
+            rank_svos(store, list(views), redirect=True)
+            t = perf_counter() - t1
+            t1 = perf_counter()
+            for k in views:
+                rank_svos(store, k, redirect=True)
+            t_each = perf_counter() - t1
+        print("%8d edges: %d views in %.3fs, one at a time in %.3fs" % (n, len(views), t, t_each))
+        record("rank_views", n, t, rate=n / t)
+
+
+def bench_vis(sizes=SIZES):
+    """Time writing the HTML graph of synthetic graphs with the fixed layout."""
+    from vis import visualize_rels
+
+    for n in sizes:
+        edges = synthetic_edges(n)
+        with tempfile.TemporaryDirectory() as d, contextlib.redirect_stdout(io.StringIO()):
+            t1 = perf_counter()
+            visualize_rels(edges, os.path.join(d, "g"), show=False, layout="fixed")
+            t = perf_counter() - t1
+        print("%8d edges: drawn in %.3fs" % (n, t))
+        record("visualize_rels", n, t, rate=n / t)
+
+
+def bench_steps(steps: int = 8, profile: str = "local", parallel: bool = False):
+    """
+    Time onto_loop end to end for steps steps against the mock LLM with the
+    given latency profile, generalization and the graph included.
+    """
+    show = CF.SHOW_GRAPH
+    CF.SHOW_GRAPH = False
+    try:
+        with mock_llm(profile) as mock, tempfile.TemporaryDirectory() as d:
+            with contextlib.redirect_stdout(io.StringIO()):
+                t1 = perf_counter()
+                onto_loop("How can an FPGA accelerate a small instruction set?", n=steps, out_dir=d, parallel=parallel)
+                t = perf_counter() - t1
+    finally:
+        CF.SHOW_GRAPH = show
+    name = f"steps_{profile}" + ("_parallel" if parallel else "")
+    print("%d steps (%s): %.3fs, %.2f steps/s, %d LLM calls" % (steps, name, t, steps / t, mock.requests))
+    record(name, steps, t, rate=steps / t, calls=mock.requests)
+
+
+def git_commit() -> str:
+    try:
+        res = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return res.stdout.strip()
+    except OSError:
+        return ""
+
+
+def save_results(fname: str = RESULTS_FILE):
+    """Append the results kept so far to fname, one JSON line each, tagged with the run."""
+    run = {"run": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(), "python": platform.python_version()}
+    with open(fname, "a") as f:
+        for r in _results:
+            f.write(json.dumps({**run, **r}) + "\n")
+    print(f"{len(_results)} results appended to {fname}")
+    _results.clear()
+
+
+def compare_results(fname: str = RESULTS_FILE):
+    """Compare the last two runs in fname, flagging slowdowns by more than REGRESSION."""
+    with open(fname) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    runs = list(dict.fromkeys(r["run"] for r in rows))
+    if len(runs) < 2:
+        print("Nothing to compare in", fname)
+        return
+    old, new = ({(r["bench"], r["size"]): r for r in rows if r["run"] == run} for run in runs[-2:])
+    commits = {r["run"]: r["commit"] for r in rows}
+    print(f"{runs[-2]} ({commits[runs[-2]]}) -> {runs[-1]} ({commits[runs[-1]]})")
+    for key, r in new.items():
+        if key not in old:
+            continue
+        ratio = r["seconds"] / max(old[key]["seconds"], 1e-9)
+        flag = "  REGRESSION" if ratio > REGRESSION and r["seconds"] > 0.01 else ""  # not timer noise
+        print("%-24s %8d: %.3fs -> %.3fs (%+.0f%%)%s" % (*key, old[key]["seconds"], r["seconds"], 100 * (ratio - 1), flag))
+
+
+def run_suite(sizes=SIZES, profile: str = "local", steps: int = 8):
+    """Run the benchmarks kept over time and append their results to RESULTS_FILE."""
+    bench_steps(steps, profile)
+    bench_steps(steps, profile, parallel=True)
+    bench_to_edge([], n=sizes[-1] // 10)
+    bench_rank_svos(sizes)
+    bench_views(sizes)
+    bench_redirect(sizes)
+    bench_vis(sizes)
+    save_results()
+
+
+def bench_infer(sizes=(5000, 20000, 50000), n: int = 2):
+    """Time counting the facts infer.pl would infer with n distinct verbs on synthetic graphs."""
+    for size in sizes:
+        store = TripleStore(synthetic_edges(size))
+        t1 = perf_counter()
+        k = count_inferred(store, n)
+        t = perf_counter() - t1
+        print("%8d edges: %d facts inferred with %d verbs in %.3fs" % (size, k, n, t))
+
+
+def synthetic_names(n: int, seed: int = 0) -> list[str]:
+    """n distinct concept names of 1 to 3 words, some of them plural."""
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(max(n // 100, 50))]
+    names = set()
+    while len(names) < n:
+        name = "_".join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        names.add(name + "s" if rng.random() < 0.1 else name)
+    return list(names)
+
+
+def bench_concepts(sizes=(10000, 100000, 300000)):
+    """Time finding the near-duplicate concepts among synthetic names."""
+    for size in sizes:
+        names = synthetic_names(size)
+        t1 = perf_counter()
+        aliases = concept_aliases(names)
+        t = perf_counter() - t1
+        print("%8d names: %d aliases in %.3fs (%.0f names/s)" % (size, len(aliases), t, size / t))
+
+
+if __name__ == "__main__":  # python bench.py [suite [quick] | compare | <file.pro>...]
+    if sys.argv[1:2] == ["suite"]:
+        run_suite(SIZES[:2] if sys.argv[2:3] == ["quick"] else SIZES)
+    elif sys.argv[1:2] == ["compare"]:
+        compare_results()
+    else:
+        bench_to_edge(sys.argv[1:] or None)
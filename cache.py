@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import hashlib
+import unittest
+import tempfile
+from time import time
+from threading import Lock
+from config import CF
+
+
+class CacheMiss(LookupError):
+    """Raised in replay mode when a prompt has no recorded answer."""
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed store of LLM answers, kept in SQLite and
+    keyed by a hash of (backend, model, prompt).
+
+    Entries older than max_age seconds are evicted, then least recently
+    used ones until the total size of the answers is below max_bytes, on
+    opening the cache and then every evict_every insertions.
+    """
+
+    def __init__(self, fname: str, max_bytes: int = 0, max_age: float = 0, evict_every: int = 1000):
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.puts = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        dname = os.path.dirname(fname)
+        if dname:
+            os.makedirs(dname, exist_ok=True)
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                 key TEXT PRIMARY KEY,
+                 backend TEXT,
+                 model TEXT,
+                 answer TEXT,
+                 cost REAL,
+                 size INTEGER,
+                 created REAL,
+                 used REAL)"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS answers_used ON answers(used)")
+        self.db.commit()
+        self.evict()
+
+    @staticmethod
+    def key(backend: str, model: str, prompt: str) -> str:
+        h = hashlib.sha256()
+        for x in (backend, model, prompt):
+            h.update(x.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        """Return the answer and its original cost, or None, counting hits and misses."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT answer, cost FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved += row[1]
+            self.db.execute("UPDATE answers SET used = ? WHERE key = ?", (time(), key))
+            self.db.commit()
+            return row[0], row[1]
+
+    def put(self, key: str, backend: str, model: str, answer: str, cost: float):
+        now = time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, backend, model, answer, cost, len(answer), now, now),
+            )
+            self.db.commit()
+            self.puts += 1
+            due = self.puts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Drop entries that are too old, then the least recently used ones while too large."""
+        with self.lock:
+            if self.max_age > 0:
+                self.db.execute(
+                    "DELETE FROM answers WHERE created < ?", (time() - self.max_age,)
+                )
+            if self.max_bytes > 0:
+                (total,) = self.db.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM answers"
+                ).fetchone()
+                rows = self.db.execute("SELECT key, size FROM answers ORDER BY used")
+                drop = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    drop.append((key,))
+                    total -= size
+                self.db.executemany("DELETE FROM answers WHERE key = ?", drop)
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def stats(self) -> str:
+        return "Cache hits: %d misses: %d saved: $%.8f" % (
+            self.hits,
+            self.misses,
+            self.saved,
+        )
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def cache_file() -> str:
+    """CF.CACHE_FILE, by default llm_cache.sqlite in CF.OUTDIR."""
+    return CF.CACHE_FILE or os.path.join(CF.OUTDIR, "llm_cache.sqlite")
+
+
+def get_cache() -> ResponseCache:
+    """Return the process-wide cache, reopening it if its file changed."""
+    global _cache
+    with _cache_lock:
+        fname = cache_file()
+        if _cache is None or _cache.fname != fname:
+            _cache = ResponseCache(
+                fname,
+                max_bytes=CF.CACHE_MAX_MB * 1024 * 1024,
+                max_age=CF.CACHE_MAX_DAYS * 24 * 3600,
+            )
+        return _cache
+
+
+def show_stats():
+    if CF.CACHE != "off":
+        print(get_cache().stats())
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_roundtrip(self):
+        c = ResponseCache(self.fname)
+        k = c.key("gpt", "gpt-5-mini", "hello")
+        self.assertNotEqual(k, c.key("ollama", "gpt-5-mini", "hello"))
+        self.assertIsNone(c.get(k))
+        c.put(k, "gpt", "gpt-5-mini", "world", 0.5)
+        c.db.close()
+
+        c = ResponseCache(self.fname)
+        self.assertEqual(c.get(k), ("world", 0.5))
+        self.assertEqual((c.hits, c.misses, c.saved), (1, 0, 0.5))
+
+    def test_evict_by_size(self):
+        c = ResponseCache(self.fname)
+        for i in range(10):
+            c.put(c.key("gpt", "m", str(i)), "gpt", "m", "x" * 100, 0.0)
+        c.db.execute("UPDATE answers SET used = rowid")
+        c.max_bytes = 350
+        c.evict()
+        self.assertEqual(len(c), 3)
+        self.assertIsNotNone(c.get(c.key("gpt", "m", "9")))
+
+    def test_evict_on_put(self):
+        c = ResponseCache(self.fname, max_bytes=250, evict_every=4)
+        for i in range(3):
+            c.put(c.key("gpt", "m", str(i)), "gpt", "m", "x" * 100, 0.0)
+        self.assertEqual(len(c), 3)
+        c.put(c.key("gpt", "m", "3"), "gpt", "m", "x" * 100, 0.0)
+        self.assertEqual(len(c), 2)
+
+    def test_cache_file(self):
+        saved = CF.CACHE_FILE, CF.OUTDIR
+        try:
+            CF.CACHE_FILE, CF.OUTDIR = None, "runs"
+            self.assertEqual(cache_file(), os.path.join("runs", "llm_cache.sqlite"))
+            CF.CACHE_FILE = self.fname
+            self.assertEqual(cache_file(), self.fname)
+        finally:
+            CF.CACHE_FILE, CF.OUTDIR = saved
+
+    def test_evict_by_age(self):
+        c = ResponseCache(self.fname)
+        c.put(c.key("gpt", "m", "old"), "gpt", "m", "x", 0.0)
+        c.db.execute("UPDATE answers SET created = 0")
+        c.max_age = 3600
+        c.evict()
+        self.assertEqual(len(c), 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,6 +1,14 @@
 import os
-import openai
+import unittest
+from time import perf_counter, sleep
+from threading import Lock
+from contextvars import ContextVar
+from collections import defaultdict
 from config import CF
+from cache import get_cache, CacheMiss
+from metrics import record_call
+from scheduler import llm_slot
+from ratelimit import get_limiter
 
 
 def get_model() -> str:
@@ -17,16 +25,160 @@ def get_llm_name() -> str:
         return "gpt"
 
 
-def get_client() -> openai.OpenAI:
+def client_key() -> tuple:
+    """The settings a client depends on; a change in them requires a new client."""
     if CF.USE_OLLAMA:
         # Ollama API is OpenAI-compatible (does not check API key)
-        return openai.OpenAI(
-            base_url=CF.OLLAMA_BASE_URL,
-            api_key="ollama",  # Ollama ignores the key, but requires it
-        )
+        base_url, api_key = CF.OLLAMA_BASE_URL, "ollama"
     else:
-        api_key = CF.API_KEY
-        return openai.OpenAI(api_key=api_key)
+        base_url, api_key = None, CF.API_KEY
+    return (
+        base_url,
+        api_key,
+        CF.MAX_CONNECTIONS,
+        CF.MAX_KEEPALIVE,
+        CF.KEEPALIVE_EXPIRY,
+        CF.TIMEOUT,
+    )
+
+
+# openai and httpx take most of the startup time, so they are only
+# imported by the functions making or handling LLM calls
+
+
+def http_limits(key: tuple) -> "httpx.Limits":
+    import httpx
+
+    _, _, max_connections, max_keepalive, keepalive_expiry, _ = key
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+_clients: dict = {}
+_clients_lock = Lock()
+
+
+def get_client() -> "openai.OpenAI":
+    """
+    Return the process-wide client for the current backend, with a pool of
+    keep-alive connections shared by all calls. A new client is created on
+    first use and whenever the settings in client_key change.
+    """
+    import openai
+
+    key = client_key()
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            base_url, api_key, *_, timeout = key
+            client = openai.OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                timeout=timeout,
+                max_retries=0,  # retried in with_retries
+                http_client=openai.DefaultHttpxClient(
+                    limits=http_limits(key),
+                    event_hooks={"request": [trace_request]},
+                ),
+            )
+            _clients[key] = client
+        return client
+
+
+# connection-level timing of the HTTP requests made by the clients,
+# collected with the httpcore "trace" request extension
+
+TIMING_PHASES = {
+    "connect_tcp": "connect",
+    "start_tls": "connect",
+    "send_request_headers": "send",
+    "send_request_body": "send",
+    "receive_response_headers": "wait",
+    "receive_response_body": "receive",
+}
+
+_call_timing: ContextVar[dict | None] = ContextVar("call_timing", default=None)
+_timing_lock = Lock()
+_timing_totals = defaultdict(float)
+
+
+def new_timing() -> dict:
+    return {"connect": 0.0, "send": 0.0, "wait": 0.0, "receive": 0.0, "connections": 0, "requests": 0}
+
+
+def trace_event(starts: dict, name: str):
+    prefix, _, event = name.rpartition(".")
+    phase = TIMING_PHASES.get(prefix.rpartition(".")[2])
+    if phase is None:
+        return
+    if event == "started":
+        starts[prefix] = perf_counter()
+    elif prefix in starts:
+        t = perf_counter() - starts.pop(prefix)
+        timing = _call_timing.get()
+        if timing is not None:
+            timing[phase] += t
+            if prefix.endswith("connect_tcp"):
+                timing["connections"] += 1
+
+
+def count_request():
+    timing = _call_timing.get()
+    if timing is not None:
+        timing["requests"] += 1  # more than one when the client retries
+
+
+def trace_request(request: "httpx.Request"):
+    count_request()
+    starts: dict = {}
+    request.extensions["trace"] = lambda name, info: trace_event(starts, name)
+
+
+def start_timing() -> dict:
+    """Start collecting the timing of the calls made from the current thread or task."""
+    timing = new_timing()
+    _call_timing.set(timing)
+    return timing
+
+
+def end_timing(timing: dict, total: float):
+    """Record the timing of a finished call, taking total as its wall-clock time."""
+    timing["total"] = total
+    timing["other"] = max(
+        0.0,
+        total - timing["connect"] - timing["send"] - timing["wait"] - timing["receive"],
+    )
+    with _timing_lock:
+        _timing_totals["calls"] += 1
+        for x, t in timing.items():
+            _timing_totals[x] += t
+
+
+def last_timing() -> dict | None:
+    """The timing breakdown of the last call made from the current thread or task."""
+    return _call_timing.get()
+
+
+def timing_stats() -> dict:
+    """Totals of the timing breakdown over all calls made so far."""
+    with _timing_lock:
+        return dict(_timing_totals)
+
+
+def show_timing():
+    stats = timing_stats()
+    total = stats.get("total", 0.0)
+    if not total:
+        return
+    print(
+        "LLM calls: %d new connections: %d time: %.3fs"
+        % (stats["calls"], stats["connections"], total)
+    )
+    for x in ("connect", "send", "wait", "receive", "other"):
+        print("\t%s: %.3fs (%.1f%%)" % (x, stats[x], 100 * stats[x] / total))
 
 
 def get_cost_rates():
@@ -45,38 +197,171 @@ def get_cost_rates():
     return input_rate / 1000000, output_rate / 1000000
 
 
+def from_cache(prompt: str) -> tuple[str | None, str | None]:
+    """
+    Look a prompt up in the response cache as set by CF.CACHE:
+
+      • "off"    - always call the LLM
+      • "on"     - answer from the cache if possible, else call the LLM and store
+      • "record" - always call the LLM and store the answer
+      • "replay" - answer only from the cache, raising CacheMiss otherwise
+
+    Return the cached answer or None, and the key to store a new answer
+    under, or None if answers should not be stored.
+    """
+    if CF.CACHE == "off":
+        return None, None
+
+    cache = get_cache()
+    key = cache.key(get_llm_name(), get_model(), prompt)
+    if CF.CACHE in ("on", "replay"):
+        hit = cache.get(key)
+        if hit is not None:
+            return hit[0], key
+        if CF.CACHE == "replay":
+            raise CacheMiss(get_llm_name() + "-->" + get_model() + ": " + key)
+    return None, key
+
+
+def to_cache(key: str | None, answer: str, cost: float):
+    if key is not None and answer:
+        get_cache().put(key, get_llm_name(), get_model(), answer, cost)
+
+
+def record_hit():
+    record_call(backend=get_llm_name(), model=get_model(), cache_hit=True)
+
+
+def record_llm_call(timing: dict, usage, cost: float):
+    """Record the tokens, latency, retries and cost of a finished LLM call."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    record_call(
+        backend=get_llm_name(),
+        model=get_model(),
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+        latency=timing["total"],
+        retries=max(0, timing["requests"] - 1),
+        cost=cost,
+    )
+
+
 def ask(prompt: str) -> tuple[str, float]:
-    """Return the response from the OpenAI API for a given prompt."""
+    """
+    Return the response from the LLM for a given prompt, going through
+    the response cache. Answers served from the cache cost $0.
+    """
+    answer, key = from_cache(prompt)
+    if answer is not None:
+        record_hit()
+        return answer, 0.0
+    answer, cost = ask_llm(prompt)
+    to_cache(key, answer, cost)
+    return answer, cost
+
+
+def retryable(e: "openai.OpenAIError") -> bool:
+    """Timeouts, connection errors, 408, 409, 429 and 5xx answers are worth retrying."""
+    import openai
+
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
 
-    client = get_client()
-    try:
-        response = client.chat.completions.create(
-            model=get_model(),
-            messages=[{"role": "user", "content": prompt}],
-        )
-        if response is None:
-            print("*** No response from OpenAI API")
-            exit(1)
-
-    except openai.OpenAIError as e:
-
-        print("*** OpenAIError:", e)
-        print("LLM:", get_llm_name())
-        print("LLM model:", get_model())
-        raise ConnectionRefusedError(get_llm_name() + "-->" + get_model())
 
+def estimate_tokens(prompt: str) -> float:
+    return len(prompt) / 4 + CF.EST_COMPLETION_TOKENS
+
+
+def failed_call(e: "openai.OpenAIError") -> tuple[bool | None, object]:
+    """
+    The outcome of a failed call for the limiter, False if rate limited, else
+    None (timeouts, connection errors, 5xx: no sign about the rate), and the
+    headers of its response if any.
+    """
+    import openai
+
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    return (False if isinstance(e, openai.RateLimitError) else None), headers
+
+
+def retry_wait(limiter, e: "openai.OpenAIError", attempt: int) -> float:
+    """Raise if the failed call should not be retried, else return the backoff."""
+    if not retryable(e) or attempt >= CF.MAX_RETRIES:
+        llm_error(e)
+    t = limiter.backoff(attempt, failed_call(e)[1])
+    print(f"*** Retrying in {t:.2f}s after: {type(e).__name__}")
+    return t
+
+
+def done_call(raw) -> tuple[object, object, float]:
+    """The parsed response of a call that went through, its headers and the tokens it used."""
+    response = raw.parse()
+    usage = getattr(response, "usage", None)  # None for streams, counted as estimated
+    return response, raw.headers, getattr(usage, "total_tokens", 0) or 0
+
+
+def with_retries(create, prompt: str):
+    """
+    Call create() for the raw response to prompt through the rate limiter of
+    the backend, retrying failed calls up to CF.MAX_RETRIES times with
+    backoff, and return the parsed response. Each call is released from the
+    limiter whatever happens to it.
+    """
+    import openai
+
+    limiter = get_limiter(get_llm_name())
+    estimate = estimate_tokens(prompt)
+    for attempt in range(CF.MAX_RETRIES + 1):
+        first = True
+        while (t := limiter.try_acquire(estimate)) > 0:
+            limiter.note_wait(t, first)
+            first = False
+            sleep(t)
+        ok, headers, used = None, None, 0
+        try:
+            response, headers, used = done_call(create())
+            ok = True
+            return response
+        except openai.OpenAIError as e:
+            ok, headers = failed_call(e)
+            error = e
+        finally:
+            limiter.release(ok, headers, used, estimate)
+        sleep(retry_wait(limiter, error, attempt))
+
+
+def llm_error(e: "openai.OpenAIError"):
+    print("*** OpenAIError:", e)
+    print("LLM:", get_llm_name())
+    print("LLM model:", get_model())
+    raise ConnectionRefusedError(get_llm_name() + "-->" + get_model())
+
+
+def usage_cost(usage) -> float:
     if CF.USE_OLLAMA:
-        cost = 0.0
-    elif response.usage is None:
-        cost = 0.0
+        return 0.0
+    elif usage is None:
+        return 0.0
     else:
-        usage = response.usage
         input_tokens = usage.prompt_tokens
         output_tokens = usage.completion_tokens
 
         input_rate, output_rate = get_cost_rates()
 
-        cost = (input_tokens * input_rate) + (output_tokens * output_rate)
+        return (input_tokens * input_rate) + (output_tokens * output_rate)
+
+
+def get_answer(response) -> tuple[str, float]:
+    """Extract the answer and its cost from a chat completion response."""
+    if response is None:
+        print("*** No response from OpenAI API")
+        raise ConnectionRefusedError(get_llm_name() + "-->" + get_model())
+
+    cost = usage_cost(response.usage)
 
     answer = response.choices[0].message.content
     if answer is None:
@@ -86,6 +371,162 @@ def ask(prompt: str) -> tuple[str, float]:
         return answer, cost
 
 
+def ask_llm(prompt: str) -> tuple[str, float]:
+    """Return the response from the OpenAI API for a given prompt."""
+
+    client = get_client()
+    with llm_slot(get_llm_name()):
+        timing = start_timing()
+        t1 = perf_counter()
+        try:
+            response = with_retries(
+                lambda: client.chat.completions.with_raw_response.create(
+                    model=get_model(),
+                    messages=[{"role": "user", "content": prompt}],
+                ),
+                prompt,
+            )
+        finally:
+            end_timing(timing, perf_counter() - t1)
+
+    answer, cost = get_answer(response)
+    record_llm_call(timing, response.usage, cost)
+    return answer, cost
+
+
+class StreamedAnswer:
+    """
+    The answer to a prompt, iterated over as complete lines while it streams
+    in. The full text and cost are known once the iteration is over. Closing
+    the stream, or leaving the loop over it, cancels the rest of the answer;
+    the cost of a cancelled answer is then estimated from its length.
+    Only answers streamed to the end are stored in the response cache.
+    """
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        self.text = ""
+        self.cost = 0.0
+        self.done = False
+        self.lines = self.stream_lines()
+
+    def __iter__(self):
+        return self.lines
+
+    def close(self):
+        self.lines.close()
+
+    def stream_lines(self):
+        answer, key = from_cache(self.prompt)
+        if answer is not None:
+            record_hit()
+            self.text = answer
+            yield from answer.split("\n")
+            self.done = True
+            return
+
+        import openai
+
+        client = get_client()
+        options = {} if CF.USE_OLLAMA else {"stream_options": {"include_usage": True}}
+        usage = None
+        buf = ""
+        with llm_slot(get_llm_name()):  # held until the stream ends or is closed
+            timing = start_timing()
+            t1 = perf_counter()
+            try:
+                stream = with_retries(
+                    lambda: client.chat.completions.with_raw_response.create(
+                        model=get_model(),
+                        messages=[{"role": "user", "content": self.prompt}],
+                        stream=True,
+                        **options,
+                    ),
+                    self.prompt,
+                )
+                with stream:
+                    for chunk in stream:
+                        if chunk.usage is not None:
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content or ""
+                        self.text += delta
+                        buf += delta
+                        while "\n" in buf:
+                            line, buf = buf.split("\n", 1)
+                            yield line
+                    if buf:
+                        yield buf
+                self.done = True
+            except openai.OpenAIError as e:
+                llm_error(e)
+            finally:
+                end_timing(timing, perf_counter() - t1)
+                if usage is None and not self.done and not CF.USE_OLLAMA:
+                    input_rate, output_rate = get_cost_rates()
+                    self.cost = (len(self.prompt) * input_rate + len(self.text) * output_rate) / 4
+                else:
+                    self.cost = usage_cost(usage)
+                record_llm_call(timing, usage, self.cost)
+
+        to_cache(key, self.text, self.cost)
+
+
+def ask_stream(prompt: str) -> StreamedAnswer:
+    """Like ask, but returning the answer as lines while it streams in."""
+    return StreamedAnswer(prompt)
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        self.saved = CF.USE_OLLAMA, CF.OLLAMA_BASE_URL
+
+    def tearDown(self):
+        CF.USE_OLLAMA, CF.OLLAMA_BASE_URL = self.saved
+
+    def test_reuse_and_recreate(self):
+        CF.USE_OLLAMA = True
+        CF.OLLAMA_BASE_URL = "http://localhost:11434/v1"
+        client = get_client()
+        self.assertIs(client, get_client())
+
+        CF.OLLAMA_BASE_URL = "http://127.0.0.1:11434/v1"
+        other = get_client()
+        self.assertIsNot(client, other)
+        self.assertEqual(str(other.base_url), "http://127.0.0.1:11434/v1/")
+
+
+class TestRetries(unittest.TestCase):
+    def test_release(self):
+        import httpx
+        import openai
+
+        limiter = get_limiter(get_llm_name())
+        in_flight, concurrency, saved = limiter.in_flight, limiter.concurrency, CF.MAX_RETRIES
+        CF.MAX_RETRIES = 0
+
+        def broken():
+            raise ValueError("not an OpenAIError")
+
+        def timeout():
+            raise openai.APITimeoutError(httpx.Request("POST", "http://localhost/v1/chat/completions"))
+
+        try:
+            with self.assertRaises(ValueError):
+                with_retries(broken, "hello")
+            with self.assertRaises(ConnectionRefusedError):
+                with_retries(timeout, "hello")
+            self.assertEqual((limiter.in_flight, limiter.concurrency), (in_flight, concurrency))
+        finally:
+            CF.MAX_RETRIES = saved
+
+
 if __name__ == "__main__":
     prompt = "What is the capital of France?"
     answer, cost = ask(prompt)
@@ -0,0 +1,270 @@
+import os
+import sys
+import argparse
+import unittest
+import tempfile
+import subprocess
+from config import CF
+
+# Command line entry point: python cli.py <command> ...
+#
+#   run       build the knowledge graph of a question with the LLM
+#   batch     run many seed questions, one per line of a file
+#   rank      the top edges of a _kb.tsv file by PageRank
+#   redirect  the same, redirected to the top nodes
+#   infer     the facts the infer.pl rules infer from a _kb.tsv file
+#   query     the answers to a Prolog goal, such as fact(X, is_a_kind_of, Y)
+#   render    draw a _kb.tsv file as an HTML graph
+#   replay    rebuild the files of a run from its journal, with no LLM calls
+#   merge     merge the graphs of many runs into one deduplicated _kb.tsv file
+#   serve     answer concept-map queries over HTTP from the graphs of runs held in memory
+#
+# Each command imports what it needs only when it runs, so that the quick
+# ones do not pay for loading the LLM client or the drawing libraries.
+
+IMPORT_BUDGET = 1.0  # seconds allowed for importing synt, see TestCli
+HEAVY_MODULES = ("openai", "httpx", "pyvis", "networkx", "scipy", "senstore", "natlog")
+
+
+def read_kb(fname: str):
+    """The edges of a _kb.tsv file, one subject, verb and object per line."""
+    from store import TripleStore
+
+    with open(fname) as f:
+        return TripleStore(tuple(line.rstrip("\n").split("\t")) for line in f if line.strip())
+
+
+def kb_prefix(fname: str) -> str:
+    """The file name prefix of the run a _kb.tsv or _journal.jsonl file belongs to."""
+    for suffix in ("_kb.tsv", "_journal.jsonl", ".tsv"):
+        if fname.endswith(suffix):
+            return fname[: -len(suffix)]
+    return fname
+
+
+def write_edges(edges, out: str | None):
+    f = open(out, "w") if out else sys.stdout
+    try:
+        for s, v, o in edges:
+            f.write(f"{s}\t{v}\t{o}\n")
+    finally:
+        if out:
+            f.close()
+
+
+def cmd_run(args):
+    if args.tree:
+        from synt import onto_tree
+
+        onto_tree(args.question, k=args.k, max_depth=args.depth, out_dir=args.out)
+    else:
+        from synt import onto_loop
+
+        onto_loop(args.question, n=args.steps, out_dir=args.out, parallel=args.parallel, resume=args.resume)
+
+
+def cmd_batch(args):
+    from batch import read_seeds, run_batch
+
+    run_batch(read_seeds(args.seeds), n=args.steps, out_dir=args.out)
+
+
+def ranked(args, redirect: bool):
+    from synt import rank_svos, save_views
+
+    if args.sizes:
+        save_views(args.output or kb_prefix(args.kb), rank_svos(read_kb(args.kb), args.sizes, redirect=redirect))
+    else:
+        write_edges(rank_svos(read_kb(args.kb), args.topn, redirect=redirect), args.output)
+
+
+def cmd_rank(args):
+    ranked(args, redirect=False)
+
+
+def cmd_redirect(args):
+    ranked(args, redirect=True)
+
+
+def cmd_infer(args):
+    from infer import save_inferred
+
+    save_inferred(args.output or kb_prefix(args.kb), read_kb(args.kb), max_len=args.max_len)
+
+
+def cmd_query(args):
+    from goals import answer_goal, format_answer
+
+    answers, _ = answer_goal(read_kb(args.kb), args.goal, limit=args.limit)
+    for a in answers:
+        print(format_answer(a))
+    if not answers:
+        print("no")
+
+
+def cmd_render(args):
+    from vis import visualize_rels
+
+    _, hfile = visualize_rels(
+        read_kb(args.kb), (args.output or kb_prefix(args.kb)) + "_graph", show=args.show, layout=args.layout
+    )
+    print(f"Knowledge graph shown in {hfile}")
+
+
+def cmd_replay(args):
+    from collections import defaultdict
+    from store import TripleStore
+    from journal import load_journal, replay
+    from synt import save_files
+
+    records, _ = load_journal(args.journal)
+    if not records:
+        print(f"No steps in {args.journal}")
+        return
+    ddict = defaultdict(list)
+    edges = TripleStore()
+    replay(records, ddict, edges)
+    print(f"Replayed {len(records)} steps of {args.journal}, with {len(edges)} edges")
+    save_files(args.output or kb_prefix(args.journal), records[0]["quest"], ddict, edges)
+
+
+def cmd_merge(args):
+    from merge import merge_runs
+
+    merge_runs(args.paths or [CF.OUTDIR], args.output, mem_mb=args.mem, workers=args.workers)
+
+
+def cmd_serve(args):
+    import asyncio
+    from service import serve
+
+    asyncio.run(serve(args.paths or [CF.OUTDIR], port=args.port))
+
+
+def parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="cli.py", description="Knowledge graphs distilled from LLM answers.")
+    cmds = p.add_subparsers(dest="command", required=True)
+
+    c = cmds.add_parser("run", help="build the knowledge graph of a question")
+    c.add_argument("question")
+    c.add_argument("-n", "--steps", type=int, default=4)
+    c.add_argument("--tree", action="store_true", help="expand a tree of questions (onto_tree)")
+    c.add_argument("-k", type=int, default=None, help="follow-up questions per tree node")
+    c.add_argument("--depth", type=int, default=None, help="levels of the tree")
+    c.add_argument("--parallel", action="store_true", default=None)
+    c.add_argument("--resume", action="store_true", default=None)
+    c.add_argument("--out", default=None, help="output directory")
+    c.set_defaults(fn=cmd_run)
+
+    c = cmds.add_parser("batch", help="run the seed questions of a file")
+    c.add_argument("seeds")
+    c.add_argument("-n", "--steps", type=int, default=4)
+    c.add_argument("--out", default=None, help="output directory")
+    c.set_defaults(fn=cmd_batch)
+
+    for name, fn, help in (
+        ("rank", cmd_rank, "the top edges by PageRank"),
+        ("redirect", cmd_redirect, "the top edges, redirected to the top nodes"),
+    ):
+        c = cmds.add_parser(name, help=help)
+        c.add_argument("kb")
+        c.add_argument("--topn", type=int, default=CF.TOPN)
+        c.add_argument("--sizes", type=int, nargs="+", help="save the views of these sizes, from one ranking")
+        c.add_argument("-o", "--output", default=None, help="output TSV file, stdout if none, or file prefix of the views")
+        c.set_defaults(fn=fn)
+
+    c = cmds.add_parser("infer", help="save the facts inferred by the infer.pl rules")
+    c.add_argument("kb")
+    c.add_argument("--max-len", type=int, default=4)
+    c.add_argument("-o", "--output", default=None, help="output file prefix")
+    c.set_defaults(fn=cmd_infer)
+
+    c = cmds.add_parser("query", help="answer a conjunction of fact/3 goals")
+    c.add_argument("kb")
+    c.add_argument("goal")
+    c.add_argument("--limit", type=int, default=100)
+    c.set_defaults(fn=cmd_query)
+
+    c = cmds.add_parser("render", help="draw the edges as an HTML graph")
+    c.add_argument("kb")
+    c.add_argument("--layout", default=None, choices=("auto", "physics", "fixed"))
+    c.add_argument("--show", action="store_true", help="open it in the browser")
+    c.add_argument("-o", "--output", default=None, help="output file prefix")
+    c.set_defaults(fn=cmd_render)
+
+    c = cmds.add_parser("replay", help="rebuild the files of a run from its journal")
+    c.add_argument("journal")
+    c.add_argument("-o", "--output", default=None, help="output file prefix")
+    c.set_defaults(fn=cmd_replay)
+
+    c = cmds.add_parser("merge", help="merge the graphs of many runs into one")
+    c.add_argument("paths", nargs="*", help="directories of runs or their files, CF.OUTDIR if none")
+    c.add_argument("-o", "--output", default=os.path.join(CF.OUTDIR, "merged"), help="output file prefix")
+    c.add_argument("--mem", type=int, default=None, help="memory budget in MB")
+    c.add_argument("--workers", type=int, default=None, help="processes, one per CPU if none")
+    c.set_defaults(fn=cmd_merge)
+
+    c = cmds.add_parser("serve", help="answer concept-map queries over HTTP")
+    c.add_argument("paths", nargs="*", help="directories of runs or their files, CF.OUTDIR if none")
+    c.add_argument("--port", type=int, default=None)
+    c.set_defaults(fn=cmd_serve)
+    return p
+
+
+def main(argv: list[str] | None = None):
+    args = parser().parse_args(argv)
+    args.fn(args)
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+def import_time(module: str) -> float:
+    """Seconds to import module in a fresh interpreter, as python -X importtime reports it."""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    for line in reversed(res.stderr.splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise ValueError(f"no import time for {module}")
+
+
+class TestCli(unittest.TestCase):
+    def test_import_time(self):
+        res = subprocess.run(
+            [sys.executable, "-c", f"import sys, synt; print(*(m for m in {HEAVY_MODULES!r} if m in sys.modules))"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        self.assertEqual(res.stdout.strip(), "")
+        self.assertLess(import_time("synt"), IMPORT_BUDGET)
+
+    def test_rank_and_replay(self):
+        from journal import Journal, step_record
+
+        with tempfile.TemporaryDirectory() as d:
+            kb = os.path.join(d, "q_kb.tsv")
+            write_edges([("a", "v", "b"), ("b", "v", "c"), ("c", "v", "a"), ("d", "v", "a")], kb)
+            out = os.path.join(d, "top.tsv")
+            main(["rank", kb, "--topn", "2", "-o", out])
+            with open(out) as f:
+                self.assertEqual(len(f.readlines()), 2)
+            main(["redirect", kb, "--sizes", "2", "3", "-o", os.path.join(d, "v")])
+            for n in (2, 3):
+                for suffix in ("_kb.tsv", ".pro", "_graph.html"):
+                    self.assertTrue(os.path.exists(os.path.join(d, f"v_top{n}{suffix}")))
+
+            item = {"QUERY_GOAL": [], "ANSWER_FACTS": ["fact(a,v,b)."], "ANSWER_SUMMARY": ["S."], "NEXT_QUESTION": "q2"}
+            with Journal(os.path.join(d, "r_journal.jsonl")) as j:
+                j.append(step_record(1, "q1", item, "fact(aaa,v,bbb).", 0.0))
+            main(["replay", os.path.join(d, "r_journal.jsonl")])
+            with open(os.path.join(d, "r_kb.tsv")) as f:
+                self.assertEqual(f.read(), "aaa\tv\tbbb\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import re
+import unittest
+import numpy as np
+from config import CF
+from store import TripleStore, as_store
+
+# Merging of near-duplicate concepts, such as fpga_accelerator,
+# fpga_accelerators and fpga_based_accelerator, into one canonical name.
+#
+# Each name gets a MinHash signature of its character 3-grams (computed for
+# all names at once with NumPy). Names agreeing on all rows of one of the
+# LSH bands of their signatures become candidates, and candidates whose
+# signatures agree on at least a threshold fraction of rows (their
+# estimated Jaccard similarity) are merged, so that no pairs of names are
+# compared beyond the candidates.
+
+PERMS = 64  # MinHash rows, in BANDS bands of PERMS // BANDS rows
+BANDS = 16
+NEGATIONS = {"non", "not", "no", "anti", "un", "without"}
+DIGITS_RE = re.compile(r"\d+")
+NO_GRAMS = 0xFFFFFFFF  # the signature of names with no 3-gram, never candidates
+
+_rng = np.random.default_rng(17)
+_A = _rng.integers(1, 1 << 63, PERMS, dtype=np.uint64) | np.uint64(1)  # multiply-shift hashing
+_B = _rng.integers(0, 1 << 63, PERMS, dtype=np.uint64)
+_M = _rng.integers(1, 1 << 63, PERMS // BANDS, dtype=np.uint64) | np.uint64(1)
+
+
+def shingle_key(name: str) -> str:
+    """The name as compared: lower case words, with a plural s dropped."""
+    words = name.lower().split("_")
+    return "_".join(w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w for w in words)
+
+
+def signatures(names: list[str]) -> np.ndarray:
+    """
+    The PERMS x len(names) MinHash signatures of the 3-grams of the names,
+    32 bits each, NO_GRAMS for names with no 3-gram (an empty shingle key).
+    """
+    text = "\n".join("_" + shingle_key(x) + "_" for x in names).encode("utf-8")
+    buf = np.frombuffer(text, dtype=np.uint8).astype(np.uint32)
+    codes = (buf[:-2] << 16) | (buf[1:-1] << 8) | buf[2:]
+    nl = buf == ord("\n")
+    valid = ~(nl[:-2] | nl[1:-1] | nl[2:])  # 3-grams within one name
+    owner = np.cumsum(nl)[:-2][valid]
+    x = codes[valid].astype(np.uint64)
+    sig = np.full((PERMS, len(names)), NO_GRAMS, dtype=np.uint64)
+    if len(x):
+        starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        for k in range(PERMS):
+            h = (_A[k] * x + _B[k]) >> np.uint64(32)
+            sig[k, owner[starts]] = np.minimum.reduceat(h, starts)
+    return sig.astype(np.uint32)
+
+
+def candidate_pairs(sig: np.ndarray) -> np.ndarray:
+    """
+    Pairs of names with equal rows in some band: in each band, the names
+    sorted by band key, paired with the one before them and with the first
+    of their bucket, which links each bucket in linear time.
+    """
+    rows = PERMS // BANDS
+    pairs = []
+    for b in range(BANDS):
+        band = sig[b * rows : (b + 1) * rows]
+        key = (band.astype(np.uint64) * _M[:, None]).sum(axis=0)  # wraps around, as a hash
+        order = np.argsort(key, kind="stable")
+        k = key[order]
+        same = np.flatnonzero(k[1:] == k[:-1]) + 1
+        if len(same) == 0:
+            continue
+        first = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        leader = first[np.searchsorted(first, same, side="right") - 1]
+        pairs.append(np.stack((order[same - 1], order[same]), axis=1))
+        pairs.append(np.stack((order[leader], order[same]), axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    has_grams = (sig != NO_GRAMS).any(axis=0)
+    pairs = pairs[(pairs[:, 0] != pairs[:, 1]) & has_grams[pairs[:, 0]] & has_grams[pairs[:, 1]]]
+    return np.unique(pairs, axis=0)
+
+
+def compatible(a: str, b: str) -> bool:
+    """
+    Names with different numbers, differing by a negation, a one word
+    name and a longer one containing it (computer, quantum_computer), or
+    names with different words (quantum_computer, classical_computer) are
+    never merged. Added words (fpga_based_accelerator) and misspelled
+    ones are fine.
+    """
+    if DIGITS_RE.findall(a) != DIGITS_RE.findall(b):
+        return False
+    wa, wb = set(shingle_key(a).split("_")), set(shingle_key(b).split("_"))
+    if (wa ^ wb) & NEGATIONS:
+        return False
+    small, large = sorted((wa, wb), key=len)
+    if small <= large:
+        return len(small) >= 2 or small == large
+    # words replaced by others must be spelling variants of them
+    return grams("_".join(sorted(wa - wb)), "_".join(sorted(wb - wa))) >= 0.5
+
+
+def grams(x: str, y: str) -> float:
+    """The exact Jaccard similarity of the 3-grams of x and y."""
+    gx = {x[i : i + 3] for i in range(len(x) - 2)} or {x}
+    gy = {y[i : i + 3] for i in range(len(y) - 2)} or {y}
+    return len(gx & gy) / len(gx | gy)
+
+
+def similarity(sig: np.ndarray, i, j) -> np.ndarray:
+    """The estimated Jaccard similarity of names i and j (or arrays of them)."""
+    return (sig[:, i] == sig[:, j]).mean(axis=0)
+
+
+def near_duplicates(
+    names: list[str], threshold: float | None = None, sig: np.ndarray | None = None
+) -> list[tuple[int, int]]:
+    """Pairs of indexes of names with an estimated Jaccard similarity of at least threshold."""
+    if threshold is None:
+        threshold = CF.MERGE_SIM
+    if len(names) < 2:
+        return []
+    if sig is None:
+        sig = signatures(names)
+    pairs = candidate_pairs(sig)
+    pairs = pairs[similarity(sig, pairs[:, 0], pairs[:, 1]) >= threshold]
+    return [(int(i), int(j)) for i, j in pairs if compatible(names[i], names[j])]
+
+
+def concept_aliases(
+    names: list[str], counts: list[int] | None = None, threshold: float | None = None
+) -> dict[str, str]:
+    """
+    Group the near-duplicate names and map the names of a group to its
+    canonical name: the most used one (by counts), then the shortest.
+    Only the names similar to the canonical one itself are mapped, so that
+    chains of similar names do not drift. Only names with a different
+    canonical name are returned.
+    """
+    if threshold is None:
+        threshold = CF.MERGE_SIM
+    if len(names) < 2:
+        return {}
+    sig = signatures(names)
+    parent = list(range(len(names)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in near_duplicates(names, threshold, sig):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(names)):
+        groups.setdefault(find(i), []).append(i)
+    if counts is None:
+        counts = [0] * len(names)
+    aliases = {}
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        best = min(members, key=lambda i: (-counts[i], len(names[i]), names[i]))
+        sims = similarity(sig, np.full(len(members), best), np.array(members))
+        for i, sim in zip(members, sims):
+            if i != best and sim >= threshold and compatible(names[i], names[best]):
+                aliases[names[i]] = names[best]
+    return aliases
+
+
+def merge_concepts(edges, threshold: float | None = None) -> tuple[TripleStore, dict[str, str]]:
+    """
+    The edges with near-duplicate subjects and objects renamed to their
+    canonical names (self loops this creates are dropped), and the alias table.
+    """
+    store = as_store(edges)
+    ids = sorted(store.node_ids())
+    names = [store.names[i] for i in ids]
+    counts = [store.count[0][i] + store.count[2][i] for i in ids]
+    aliases = concept_aliases(names, counts, threshold)
+    merged = TripleStore()
+    for s, v, o in store:
+        s, o = aliases.get(s, s), aliases.get(o, o)
+        if s != o:
+            merged.add((s, v, o))
+    print(f"Merged {len(aliases)} near-duplicate concepts, {len(store)} -> {len(merged)} edges")
+    return merged, aliases
+
+
+def save_aliases(fname: str, aliases: dict[str, str]):
+    aname = fname + "_aliases.tsv"
+    with open(aname, "w") as f:
+        for alias, name in sorted(aliases.items()):
+            f.write(f"{alias}\t{name}\n")
+    print(f"Concept aliases stored in {aname}")
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestConcepts(unittest.TestCase):
+    def test_aliases(self):
+        names = [
+            "fpga_accelerator",
+            "fpga_accelerators",
+            "fpga_based_accelerator",
+            "FpgaAccelerator".lower(),
+            "classical_logic",
+            "non_classical_logic",
+            "node_123",
+            "node_124",
+            "inference",
+            "interference",
+            "llm",
+            "llms",
+            "computer",
+            "quantum_computer",
+            "quantum_computers",
+            "classical_computer",
+            "quantum_computr",
+        ]
+        counts = [1, 5, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 1, 3, 1, 1, 1]
+        aliases = concept_aliases(names, counts, threshold=0.6)
+        self.assertEqual(aliases["fpga_accelerator"], "fpga_accelerators")
+        self.assertEqual(aliases["fpga_based_accelerator"], "fpga_accelerators")
+        self.assertEqual(aliases["llm"], "llms")
+        self.assertEqual(aliases["quantum_computr"], "quantum_computer")
+        for x in ("classical_logic", "non_classical_logic", "node_123", "node_124", "inference", "computer", "classical_computer"):
+            self.assertNotIn(x, aliases)
+
+    def test_merge(self):
+        edges = {
+            ("fpga_accelerator", "speeds_up", "interpreter"),
+            ("fpga_accelerators", "speeds_up", "interpreters"),
+            ("fpga_accelerators", "is_a", "fpga_accelerator"),
+        }
+        merged, aliases = merge_concepts(edges, threshold=0.6)
+        self.assertEqual(len(aliases), 2)
+        self.assertEqual(len(merged), 1)
+
+    def test_short_names(self):
+        names = ["fpga_accelerator", "", "a", "ab", "fpga_accelerators", "", "ab"]
+        sig = signatures(names)
+        self.assertTrue((sig[:, [0, 4]] == signatures([names[0], names[4]])).all())
+        self.assertTrue((sig[:, [2, 3]] == signatures(["a", "ab"])).all())
+        self.assertTrue((sig[:, [1, 5]] == NO_GRAMS).all())
+        self.assertEqual(near_duplicates(names, 0.6), [(0, 4), (3, 6)])
+
+    def test_no_all_pairs(self):
+        names = [f"concept_{w}_{i:x}" for i in range(3000) for w in ("alpha", "beta")]
+        sig = signatures(names)
+        self.assertLess(len(candidate_pairs(sig)), 20 * len(names))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -10,9 +10,59 @@ class CF:
     TOPN = 100
     TOP_K = 3
     MAX_DEPTH = 4
+    PARALLEL = False
+    MAX_WORKERS = 4
+    DUP_QUEST = 0.7  # min Jaccard similarity of the words of a repeated question
+    QUEST_RETRIES = 1  # other next questions asked for a repeated one, before rerouting
+    MIN_YIELD = 0  # stop onto_loop when steps add fewer new edges, never if 0
+    SATURATION_STEPS = 2  # ... in so many steps in a row
+    STREAM_FACTS = False
+    MAX_STEP_EDGES = 0  # no cap if 0
     REDIRECT = True
+    VIEW_SIZES = ()  # also save the views of these top sizes, e.g. (25, 50, 100, 500), as _top<n> files
+    PAGERANK_TOL = 1e-6
+    STEP_TOPN = 0  # top edges shown after each step, none if 0
+    GEN_BATCH = 200  # nouns per generalization call, all in one call if 0
+    GEN_INCREMENTAL = False  # generalize the nouns of each step while the loop goes on
+    LOCAL_ANSWERS = False  # ask for the query goal first and answer it from the graph if possible
+    LOCAL_MIN_FACTS = 3  # edges answering the goal needed to skip the fact call
+    MERGE_CONCEPTS = False  # merge near-duplicate concepts before generalizing and ranking
+    MERGE_SIM = 0.6  # min estimated Jaccard similarity of the 3-grams of merged names
+    MERGE_MEM_MB = 256  # memory budget of merge.py for deduplicating edges
+    MERGE_WORKERS = 0  # processes of merge.py, one per CPU if 0
+    INFER = False  # save the facts inferred by the infer.pl rules
     OUTDIR = "out"
+    RESUME = False  # resume onto_loop from the journal of an earlier run
+    JOURNAL_SYNC = 4  # fsync the journal every so many steps
+    MAX_CONNECTIONS = 20
+    MAX_KEEPALIVE = 10
+    KEEPALIVE_EXPIRY = 60.0
+    TIMEOUT = 600.0
+    RPM = 0  # requests per minute, learned from the rate-limit headers if 0
+    TPM = 0  # tokens per minute, learned from the rate-limit headers if 0
+    EST_COMPLETION_TOKENS = 500  # counted against TPM before the usage is known
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 1.0  # seconds, doubled on each retry
+    BACKOFF_MAX = 60.0
+    CACHE = "off"  # "off", "on", "record" or "replay"
+    CACHE_FILE = None  # llm_cache.sqlite in OUTDIR if None
+    CACHE_MAX_MB = 512
+    CACHE_MAX_DAYS = 90
+    BATCH_SEEDS = 16  # seeds run at once by batch.py
+    BATCH_CACHE = "on"  # response cache mode of a batch if CACHE is "off"
+    LLM_CONCURRENCY = {"gpt": 8, "ollama": 2}  # LLM calls in flight per backend in a batch
+    METRICS = True  # save per-call metrics as _metrics.json and _metrics.prom
+    METRICS_CALLS = 1000  # last calls of a run kept in _metrics.json
+    SERVICE_PORT = 8765  # port of service.py
+    SERVICE_CACHE = 256  # query answers kept by service.py
+    SERVICE_POLL = 5.0  # seconds between checks of service.py for changed runs, never if 0
+    SHOW_GRAPH = True  # open the graph of a run in the browser
     EDGE_LABELS = True
+    VIS_LAYOUT = "auto"  # "physics" (in the browser), "fixed" (precomputed) or "auto"
+    VIS_LIVE_NODES = 500  # "auto" precomputes the layout above this many nodes
+    VIS_MAX_NODES = 1500
+    VIS_MAX_EDGES = 5000
+    VIS_LOD_LEVELS = 3  # rank buckets, expanded one per doubling of the zoom
 
     @staticmethod
     def show():
@@ -0,0 +1,188 @@
+import unittest
+from threading import Lock
+from store import TripleStore, as_store
+from terms import uniform_str
+
+# Evaluation of the Prolog goals query_prompter turns questions into, such as
+# fact(X, discovered, ac), fact(X, used, motor), against the edges of a run.
+# The patterns of a conjunction are joined one at a time, the most selective
+# first, each looked up in the subject, verb and object indexes of a
+# TripleStore with the variables bound so far filled in.
+#
+# A pattern is a (s, v, o) tuple of constants (str) and variables (int,
+# numbering the variable names of the goal).
+
+Pattern = tuple
+
+_stats_lock = Lock()
+_stats = {"goals": 0, "answered": 0, "skipped_calls": 0}
+
+
+def parse_conj(goal: str) -> tuple[list[Pattern], list[str]] | None:
+    """
+    The fact/3 patterns of a goal and its variable names, with constants
+    normalized as edges are, or None if the goal does not parse. Other
+    predicates are ignored.
+    """
+    from natlog.prolog_parser import parse_goal, VarNum
+
+    goal = goal.strip().rstrip(".")
+    if not goal:
+        return None
+    try:
+        terms, names = parse_goal(goal + ".")
+    except Exception:
+        return None
+    pats = []
+    for t in terms:
+        if not isinstance(t, tuple) or len(t) != 4 or t[0] != "fact":
+            continue
+        pats.append(tuple(int(x) if isinstance(x, VarNum) else uniform_str(str(x)) for x in t[1:]))
+    return (pats, list(names)) if pats else None
+
+
+def estimate(store: TripleStore, pat: Pattern, bound: set) -> float:
+    """About how many rows match pat once the variables in bound have values."""
+    est = float(len(store))
+    avg = len(store) / max(1, len(store.names))  # rows per value of a column
+    for k, x in enumerate(pat):
+        if isinstance(x, int):
+            if x in bound:
+                est = min(est, avg)
+        else:
+            i = store.ids.get(x)
+            est = min(est, store.count[k][i] if i is not None else 0)
+    return est
+
+
+def join_order(store: TripleStore, pats: list[Pattern]) -> list[Pattern]:
+    """The patterns in the order of joining: greedily, the one with the fewest rows next."""
+    pats, plan, bound = list(pats), [], set()
+    while pats:
+        best = min(pats, key=lambda p: estimate(store, p, bound))
+        pats.remove(best)
+        plan.append(best)
+        bound.update(x for x in best if isinstance(x, int))
+    return plan
+
+
+def unify(pat: Pattern, triple: tuple, binding: list) -> list | None:
+    """binding extended with the values pat takes in triple, None if they clash."""
+    new = list(binding)
+    for x, y in zip(pat, triple):
+        if isinstance(x, int):
+            if new[x] is None:
+                new[x] = y
+            elif new[x] != y:
+                return None
+    return new
+
+
+def evaluate(store: TripleStore, pats: list[Pattern], nvars: int, limit: int = 100) -> list[tuple[tuple, list[int]]]:
+    """Up to limit distinct solutions: the values of the nvars variables and the rows they use."""
+    plan = join_order(store, pats)
+    if any(estimate(store, p, set()) == 0 for p in plan):
+        return []
+    solutions = {}
+
+    def solve(j: int, binding: list, rows: list):
+        if len(solutions) >= limit:
+            return
+        if j == len(plan):
+            solutions.setdefault(tuple(binding), list(rows))
+            return
+        pat = plan[j]
+        key = [binding[x] if isinstance(x, int) else x for x in pat]
+        for r in store.match_rows(*key):
+            new = unify(pat, store.triple(r), binding)
+            if new is not None:
+                solve(j + 1, new, rows + [r])
+
+    solve(0, [None] * nvars, [])
+    return list(solutions.items())
+
+
+def answer_goal(edges, goal: str, limit: int = 100) -> tuple[list[dict[str, str]], list[tuple]]:
+    """
+    The answers to the goal lines of goal on edges, as variable bindings,
+    and the edges supporting them.
+    """
+    store = as_store(edges)
+    answers, support = [], {}
+    for line in goal.split("\n"):
+        parsed = parse_conj(line)
+        if parsed is None:
+            continue
+        pats, names = parsed
+        for values, rows in evaluate(store, pats, len(names), limit):
+            answers.append(dict(zip(names, values)))
+            for r in rows:
+                support[r] = store.triple(r)
+    return answers, list(support.values())
+
+
+def note_goal(answered: bool, skipped_call: bool = False):
+    with _stats_lock:
+        _stats["goals"] += 1
+        _stats["answered"] += answered
+        _stats["skipped_calls"] += skipped_call
+
+
+def goal_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def show_goal_stats():
+    stats = goal_stats()
+    if stats["goals"]:
+        print(
+            "Goals answered from the graph: %d of %d (%.1f%%), fact calls skipped: %d"
+            % (stats["answered"], stats["goals"], 100 * stats["answered"] / stats["goals"], stats["skipped_calls"])
+        )
+
+
+def format_answer(answer: dict[str, str]) -> str:
+    return ", ".join(f"{x}={y}" for x, y in answer.items()) or "true"
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestGoals(unittest.TestCase):
+    def setUp(self):
+        self.store = TripleStore(
+            [
+                ("tesla", "discovered", "alternative_current"),
+                ("tesla", "used_alternative_current", "in_a_motor"),
+                ("edison", "discovered", "phonograph"),
+                ("edison", "used_alternative_current", "in_a_motor"),
+                ("a", "r", "b"),
+                ("b", "r", "a"),
+                ("b", "r", "c"),
+            ]
+        )
+
+    def test_conjunction(self):
+        goal = "fact(X, discovered, alternative_current), fact(X, used_alternative_current, in_a_motor)."
+        answers, support = answer_goal(self.store, goal)
+        self.assertEqual(answers, [{"X": "tesla"}])
+        self.assertEqual(len(support), 2)
+
+    def test_shared_and_repeated_variables(self):
+        answers, _ = answer_goal(self.store, "fact(X, r, Y), fact(Y, r, X)")
+        self.assertEqual(sorted(a["X"] for a in answers), ["a", "b"])
+        self.assertEqual(answer_goal(self.store, "fact(X, r, X)")[0], [])
+        self.assertEqual(answer_goal(self.store, "fact(a, r, b).")[0], [{}])
+
+    def test_order_and_unknowns(self):
+        pats, _ = parse_conj("fact(X, r, Y), fact(X, discovered, phonograph)")
+        self.assertEqual(join_order(self.store, pats)[0], (0, "discovered", "phonograph"))
+        self.assertEqual(answer_goal(self.store, "fact(X, invented, Y)")[0], [])
+        self.assertEqual(answer_goal(self.store, "not a goal (")[0], [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
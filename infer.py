@@ -0,0 +1,248 @@
+import sys
+import unittest
+import numpy as np
+from itertools import product
+from typing import Iterable, Iterator
+from store import TripleStore, as_store
+
+# In-process evaluation of the rules of infer.pl over a set of edges:
+#
+#   generated_fact(S,[V],O)     for each fact(S,V,O)
+#   inferred_with(N,S,Vs,O)     for each path S -> O of 2 to 4 facts, S \= O,
+#                               with Vs its N distinct verbs, sorted, and
+#                               not a generated_fact
+#   all_facts(N,S,Vs,O)         generated_fact or inferred_with N
+#
+# Paths are grown one fact at a time from a frontier of (S, verbs, end)
+# states, joined with the facts through a subject index (CSR arrays), a
+# whole level at a time with NumPy. A state depends only on its start,
+# verb set and end, so a state already reached by a shorter path is dropped
+# from the frontier (semi-naive evaluation): its extensions were all reached
+# from the shorter path, within the same bound. Dropping the states of
+# length 1 is also what removes the generated facts.
+
+Result = tuple[int, str, list[str], str]  # (distinct verb count, S, Vs, O)
+
+
+def pack(vs: np.ndarray) -> np.ndarray:
+    """The verb sets as columns of 64 bit words, several verb indexes per word."""
+    per_word = 64 // (8 * vs.itemsize)
+    cols = []
+    for i in range(0, vs.shape[1], per_word):
+        word = np.zeros(len(vs), dtype=np.uint64)
+        for j in range(i, min(i + per_word, vs.shape[1])):
+            word = (word << np.uint64(8 * vs.itemsize)) | vs[:, j].astype(np.uint64)
+        cols.append(word)
+    return np.stack(cols, axis=1)
+
+
+def new_states(
+    seen_so: np.ndarray, seen_vs: np.ndarray, so: np.ndarray, vs: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Among the candidate states with packed (S, O) ids so and packed verb
+    sets vs, the index of the first occurrence of each one that is not in the
+    sorted seen states, and the sorted seen states with the new ones added.
+    """
+    n = len(seen_so)
+    all_so = np.concatenate((seen_so, so))
+    all_vs = np.concatenate((seen_vs, vs))
+    order = np.lexsort((*all_vs.T[::-1], all_so))  # stable: seen states first among equals
+    so_sorted, vs_sorted = all_so[order], all_vs[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (so_sorted[1:] != so_sorted[:-1]) | (vs_sorted[1:] != vs_sorted[:-1]).any(axis=1)
+    fresh = first & (order >= n)
+    return order[fresh] - n, so_sorted[first], vs_sorted[first]
+
+
+def path_levels(
+    store: TripleStore, max_len: int = 4, subjects: Iterable[str] | None = None
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    For paths of 2 to max_len facts, lazily, one path length at a time, the
+    (S, verbs, O) id states not reached by any shorter path: arrays of the
+    subjects, of the sorted verb indexes (1-based, 0 padded, into the array
+    of verb ids yielded last) and of the objects. Paths start from all
+    subjects, or only from the given ones.
+    """
+    S = np.frombuffer(store.subj, dtype=np.int32).astype(np.int64)
+    V = np.frombuffer(store.verb, dtype=np.int32)
+    O = np.frombuffer(store.obj, dtype=np.int32).astype(np.int64)
+    verbs, vi = np.unique(V, return_inverse=True)
+    vi = (vi + 1).astype(np.uint16 if len(verbs) < 0xFFFF else np.uint32)
+
+    # facts sorted by subject, with the range of each subject in indptr
+    order = np.argsort(S, kind="stable")
+    es, ev, eo = S[order], vi[order], O[order]
+    n = len(store.names)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(S, minlength=n), out=indptr[1:])
+    outdeg = np.diff(indptr)
+
+    s, v, o = es, ev, eo
+    if subjects is not None:
+        start = np.isin(es, [store.ids[x] for x in subjects if x in store.ids])
+        s, v, o = s[start], v[start], o[start]
+    vs = np.zeros((len(s), max_len), dtype=vi.dtype)
+    vs[:, -1] = v
+    empty = np.zeros(0, dtype=np.int64)
+    _, seen_so, seen_vs = new_states(empty, pack(vs[:0]), (s << 32) | o, pack(vs))
+    for _ in range(max_len - 1):
+        if len(o) == 0:
+            return
+        # join the frontier with the facts of its end nodes
+        deg = outdeg[o]
+        rep = np.repeat(np.arange(len(o)), deg)
+        first = np.cumsum(deg) - deg
+        e = np.repeat(indptr[o] - first, deg) + np.arange(len(rep))
+        ns, no = s[rep], eo[e]
+
+        # add the new verb to each sorted verb set, zeroing repeats
+        nv = np.concatenate((vs[rep], ev[e][:, None]), axis=1)
+        nv.sort(axis=1)
+        nv[:, 1:][nv[:, 1:] == nv[:, :-1]] = 0
+        nv.sort(axis=1)
+        nv = np.ascontiguousarray(nv[:, 1:])
+
+        idx, seen_so, seen_vs = new_states(seen_so, seen_vs, (ns << 32) | no, pack(nv))
+        s, vs, o = ns[idx], nv[idx], no[idx]
+        yield s, vs, o, verbs
+
+
+def inferred_with(
+    store, n: int | None = None, max_len: int = 4, subjects=None
+) -> Iterator[Result]:
+    """Like inferred_with/4: the facts inferred from paths, with n distinct verbs if given."""
+    store = as_store(store)
+    names = store.names
+    for s, vs, o, verbs in path_levels(store, max_len, subjects):
+        counts = (vs > 0).sum(axis=1)
+        keep = s != o
+        if n is not None:
+            keep &= counts == n
+        for k in np.flatnonzero(keep):
+            yield int(counts[k]), names[s[k]], sorted(names[verbs[v - 1]] for v in vs[k] if v), names[o[k]]
+
+
+def count_inferred(store, n: int | None = None, max_len: int = 4) -> int:
+    """The number of facts inferred_with would return, without building them."""
+    total = 0
+    for s, vs, o, _ in path_levels(as_store(store), max_len):
+        keep = s != o
+        if n is not None:
+            keep &= (vs > 0).sum(axis=1) == n
+        total += int(keep.sum())
+    return total
+
+
+def generated_facts(store, subjects=None) -> Iterator[Result]:
+    """Like generated_fact/3, with the verb count in front."""
+    store = as_store(store)
+    if subjects is not None:
+        rows = (r for s in subjects for r in store.match_rows(s=s))
+    else:
+        rows = range(len(store))
+    for r in rows:
+        s, v, o = store.triple(r)
+        yield 1, s, [v], o
+
+
+def all_facts(store, n: int, max_len: int = 4, subjects=None) -> Iterator[Result]:
+    """Like all_facts/4: the generated facts followed by those inferred with n verbs."""
+    store = as_store(store)
+    yield from generated_facts(store, subjects)
+    yield from inferred_with(store, n, max_len, subjects)
+
+
+def count(store, n: int, max_len: int = 4) -> dict[str, int]:
+    """Like count/1: the number of generated, inferred (with n verbs) and all facts."""
+    store = as_store(store)
+    generated = len(store)
+    inferred = count_inferred(store, n, max_len)
+    return {"generated_fact": generated, "inferred": inferred, "all_facts": generated + inferred}
+
+
+def query(store, n: int, s: str, max_len: int = 4) -> Iterator[tuple[str, list[str], str]]:
+    """Like query/2: all facts about subject s, inferred ones with n distinct verbs."""
+    for _, s1, vs, o in all_facts(store, n, max_len, subjects=[s]):
+        yield s1, vs, o
+
+
+def save_inferred(fname: str, store, max_len: int = 4):
+    """Write all inferred facts to a TSV file: verb count, subject, verbs, object."""
+    tname = fname + "_inferred.tsv"
+    k = 0
+    with open(tname, "w") as f:
+        for n, s, vs, o in inferred_with(store, max_len=max_len):
+            f.write(f"{n}\t{s}\t{','.join(vs)}\t{o}\n")
+            k += 1
+    print(f"{k} inferred facts stored in {tname}")
+
+
+def go(store, subjects=("reasoning_llm_output", "inconsistency_tolerance", "paraconsistent_logic")):
+    """Like go/0: print the facts of a few subjects with 1 to 4 distinct verbs."""
+    for s, n in product(subjects, range(1, 5)):
+        print(f"\n--- Facts with {s} verbs:{n}")
+        for x in query(store, n, s):
+            print(x)
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+def brute_force(edges: set, n: int) -> set:
+    """inferred_with/4 by enumerating all paths, clause by clause."""
+    res = set()
+    for k in (2, 3, 4):
+        paths = [(s, (v,), o) for s, v, o in edges]
+        for _ in range(k - 1):
+            paths = [(s, vs + (v,), o) for s, vs, x in paths for x1, v, o in edges if x1 == x]
+        for s, vs, o in paths:
+            svs = tuple(sorted(set(vs)))
+            if s != o and len(svs) == n and not (len(svs) == 1 and (s, svs[0], o) in edges):
+                res.add((n, s, svs, o))
+    return res
+
+
+class TestInfer(unittest.TestCase):
+    def setUp(self):
+        self.edges = {
+            ("a", "is", "b"),
+            ("b", "is", "c"),
+            ("a", "is", "c"),
+            ("c", "has", "d"),
+            ("d", "is", "a"),
+            ("b", "has", "b"),
+            ("d", "uses", "e"),
+            ("e", "is", "f"),
+            ("f", "has", "g"),
+        }
+
+    def test_same_as_rules(self):
+        store = TripleStore(self.edges)
+        for n in range(1, 5):
+            got = [(k, s, tuple(vs), o) for k, s, vs, o in inferred_with(store, n)]
+            self.assertEqual(len(got), len(set(got)))
+            self.assertEqual(set(got), brute_force(self.edges, n))
+
+    def test_count_and_query(self):
+        store = TripleStore(self.edges)
+        c = count(store, 2)
+        self.assertEqual(c["generated_fact"], len(self.edges))
+        self.assertEqual(c["inferred"], len(brute_force(self.edges, 2)))
+        self.assertEqual(c["all_facts"], c["generated_fact"] + c["inferred"])
+        about_e = set((s, tuple(vs), o) for s, vs, o in query(store, 2, "e"))
+        self.assertEqual(about_e, {("e", ("is",), "f"), ("e", ("has", "is"), "g")})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:  # python infer.py <kb.tsv> <subject>...
+        with open(sys.argv[1]) as f:
+            kb = TripleStore(tuple(line.rstrip("\n").split("\t")) for line in f if line.strip())
+        for n in range(1, 5):
+            print(n, count(kb, n))
+        go(kb, sys.argv[2:])
+    else:
+        unittest.main(verbosity=2)
@@ -0,0 +1,174 @@
+import os
+import json
+import unittest
+import tempfile
+from collections import defaultdict
+from config import CF
+from terms import parse_facts
+
+# A run is journaled as one JSON line per step, appended as soon as the step
+# is done, so that saving costs the size of the step, not of the whole run,
+# and an interrupted run can be resumed from its last complete step.
+
+
+def step_record(step: int, quest: str, item: dict, answer: str, cost: float) -> dict:
+    """The journal record of a step, from its ddict item and its fact answer as the LLM gave it."""
+    return {
+        "step": step,
+        "quest": quest,
+        "facts": item["ANSWER_FACTS"],
+        "answer": answer,
+        "goal": item["QUERY_GOAL"],
+        "answers": item.get("GOAL_ANSWERS", []),
+        "sum": item["ANSWER_SUMMARY"],
+        "next": item["NEXT_QUESTION"],
+        "cost": cost,
+    }
+
+
+def ddict_item(record: dict) -> dict:
+    """The ddict item of a step, as record_step builds it."""
+    return {
+        "QUERY_GOAL": record["goal"],
+        "GOAL_ANSWERS": record.get("answers", []),
+        "ANSWER_FACTS": record["facts"],
+        "ANSWER_SUMMARY": record["sum"],
+        "NEXT_QUESTION": record["next"],
+    }
+
+
+class Journal:
+    """
+    Append-only JSONL file of step records. Each record is flushed when
+    appended, and the file is fsynced every sync_every records and on close.
+    """
+
+    def __init__(self, fname: str, resume: bool = False, sync_every: int | None = None):
+        if sync_every is None:
+            sync_every = CF.JOURNAL_SYNC
+        self.fname = fname
+        self.sync_every = max(1, sync_every)
+        self.pending = 0
+        self.records = []
+        dname = os.path.dirname(fname)
+        if dname:
+            os.makedirs(dname, exist_ok=True)
+        if resume and os.path.exists(fname):
+            self.records, size = load_journal(fname)
+            with open(fname, "r+b") as f:
+                f.truncate(size)  # drop a partly written last record
+        self.f = open(fname, "a" if resume else "w")
+
+    def append(self, record: dict):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self.records.append(record)
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.pending = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_journal(fname: str) -> tuple[list[dict], int]:
+    """The complete records of a journal, and the size of the file they span."""
+    records, size = [], 0
+    with open(fname, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            size += len(line)
+    return records, size
+
+
+def replay(records: list[dict], ddict: defaultdict, edges):
+    """
+    Rebuild the ddict and edges of a run from its journal records, parsing
+    the fact answers again, as the current to_edge does. Records written
+    before the answers were journaled give their parsed edges.
+    """
+    for r in records:
+        ddict[r["quest"]].append(ddict_item(r))
+        if "answer" in r:
+            edges.update(parse_facts(r["answer"].split("\n"))[1])
+        else:
+            edges.update(tuple(e) for e in r["edges"])
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, "run_journal.jsonl")
+        self.items = [
+            {
+                "QUERY_GOAL": [f"goal{i}"],
+                "GOAL_ANSWERS": [f"X=a{i}"],
+                "ANSWER_FACTS": [f"fact(a{i},is,b{i})."],
+                "ANSWER_SUMMARY": [f"Summary {i}."],
+                "NEXT_QUESTION": f"q{i+1}",
+            }
+            for i in range(3)
+        ]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, k: int, resume=False):
+        with Journal(self.fname, resume=resume, sync_every=2) as j:
+            for i in range(len(j.records), k):
+                answer = f"Here are the facts:\nfact(node{i},is,'Part{i}').\nfact(it,is,part{i})."
+                j.append(step_record(i + 1, f"q{i}", self.items[i], answer, 0.5))
+        return j
+
+    def test_replay(self):
+        self.write(3)
+        records, _ = load_journal(self.fname)
+        ddict, edges = defaultdict(list), set()
+        replay(records, ddict, edges)
+        self.assertEqual(dict(ddict), {f"q{i}": [self.items[i]] for i in range(3)})
+        self.assertEqual(edges, {(f"node_{i}", "is", f"part_{i}") for i in range(3)})
+
+    def test_replay_edges(self):
+        # records without the fact answer give their parsed edges
+        record = step_record(1, "q0", self.items[0], "", 0.5)
+        del record["answer"]
+        record["edges"] = [["a0", "is", "b0"]]
+        ddict, edges = defaultdict(list), set()
+        replay([record], ddict, edges)
+        self.assertEqual(edges, {("a0", "is", "b0")})
+
+    def test_resume_after_partial_record(self):
+        self.write(2)
+        with open(self.fname, "a") as f:
+            f.write('{"step": 3, "quest": "q2", "fac')  # crashed mid write
+        j = self.write(3, resume=True)
+        self.assertEqual([r["step"] for r in j.records], [1, 2, 3])
+        records, size = load_journal(self.fname)
+        self.assertEqual(records, j.records)
+        self.assertEqual(size, os.path.getsize(self.fname))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,269 @@
+import os
+import re
+import glob
+import heapq
+import shutil
+import tempfile
+import unittest
+import contextlib
+from zlib import crc32
+from concurrent.futures import ProcessPoolExecutor
+from config import CF
+from terms import to_edge, good_noun, uniform_str
+
+# Merging of the graphs of many runs (the _kb.tsv or .pro files in out/) into
+# one deduplicated knowledge base, in a bounded amount of memory.
+#
+# The files are parsed by a pool of processes, each writing the normalized
+# edges it reads to hash partitions on disk, tagged with the run they come
+# from. The partitions, each small enough to deduplicate in memory, are then
+# deduplicated in parallel and written back sorted, and a k-way merge of
+# them streams out the merged files:
+#
+#   <out>_kb.tsv       subject, verb and object, for rank_svos and cli.py
+#   <out>.pro          the same as fact/3 clauses, for infer.pl
+#   <out>_sources.tsv  the edges and the runs they come from
+#   <out>_runs.tsv     the number, file name prefix and seed question of each run
+
+MEM_PER_BYTE = 10  # bytes of memory a byte of input takes once deduplicated in a dict, about
+FLUSH_BYTES = 1 << 20  # edges buffered by a parsing task before appending them to the partitions
+VIEW_RE = re.compile(r"_top\d+$")  # the prefixes of the views save_views writes next to a run
+
+
+def run_prefix(fname: str) -> str:
+    """The file name prefix of the run a _kb.tsv or .pro file belongs to."""
+    return fname[: -len("_kb.tsv")] if fname.endswith("_kb.tsv") else os.path.splitext(fname)[0]
+
+
+def run_prefixes(paths: list[str], exclude: str | None = None) -> list[tuple[str, str]]:
+    """
+    The runs in the directories or files of paths, as their file name prefix
+    and the file to read their edges from: the _kb.tsv file if there is one,
+    else the .pro file. The _top<n> views of the runs in the directories are
+    not runs, and are skipped.
+    """
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(os.path.join(path, "*_kb.tsv")) + glob.glob(os.path.join(path, "*.pro"))
+            fnames += sorted(f for f in found if not VIEW_RE.search(run_prefix(f)))
+        else:
+            fnames.append(path)
+    runs = {}
+    for fname in fnames:
+        prefix = run_prefix(fname)
+        if exclude and os.path.abspath(prefix) == os.path.abspath(exclude):
+            continue
+        if prefix not in runs or fname.endswith("_kb.tsv"):
+            runs[prefix] = fname
+    return list(runs.items())
+
+
+def seed_question(prefix: str) -> str:
+    """The seed question of a run, from its _sum.txt or .pro file, else its file name."""
+    for fname, tag in ((prefix + "_sum.txt", "SEED QUESTION:"), (prefix + ".pro", "% SEED QUESTION:")):
+        if os.path.exists(fname):
+            with open(fname) as f:
+                line = f.readline()
+            if line.startswith(tag):
+                return line[len(tag) :].strip()
+    return os.path.basename(prefix)
+
+
+def read_edges(fname: str):
+    """
+    The edges of a _kb.tsv or .pro file, streamed line by line and
+    normalized as to_edge does, None for malformed lines.
+    """
+    with open(fname) as f:
+        if fname.endswith(".pro"):
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("%"):
+                    yield to_edge(line)
+            return
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 3 and good_noun(fields[0]) and good_noun(fields[2]) and fields[1].strip():
+                yield uniform_str(fields[0]), uniform_str(fields[1]), uniform_str(fields[2])
+            elif line.strip():
+                yield None
+
+
+def partition_name(tmp: str, part: int, task: int) -> str:
+    return os.path.join(tmp, f"p{part:05d}_t{task:04d}.tsv")
+
+
+def split_runs(runs: list[tuple[int, str]], parts: int, tmp: str, task: int) -> tuple[int, int]:
+    """
+    Append the edges of the numbered runs, with the number of their run, to
+    the parts hash partitions of task in tmp. Return the number of edges and
+    of malformed lines.
+    """
+    bufs = [[] for _ in range(parts)]
+    size = n = bad = 0
+
+    def flush():
+        for part, buf in enumerate(bufs):
+            if buf:
+                with open(partition_name(tmp, part, task), "a") as f:
+                    f.writelines(buf)
+                buf.clear()
+
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):  # to_edge warnings
+        for run, fname in runs:
+            for edge in read_edges(fname):
+                if edge is None:
+                    bad += 1
+                    continue
+                key = "\t".join(edge)
+                line = f"{key}\t{run}\n"
+                bufs[crc32(key.encode("utf-8")) % parts].append(line)
+                size += len(line)
+                n += 1
+                if size > FLUSH_BYTES:
+                    flush()
+                    size = 0
+    flush()
+    return n, bad
+
+
+def dedup_partition(fnames: list[str], out: str) -> int:
+    """Write the distinct edges of the partition files, sorted, with the sorted runs of each. Return their number."""
+    runs: dict[str, set] = {}
+    for fname in fnames:
+        with open(fname) as f:
+            for line in f:
+                key, run = line.rstrip("\n").rsplit("\t", 1)
+                runs.setdefault(key, set()).add(int(run))
+    with open(out, "w") as f:
+        for key in sorted(runs):
+            f.write(f"{key}\t{','.join(map(str, sorted(runs[key])))}\n")
+    return len(runs)
+
+
+def num_parts(nbytes: int, mem_mb: int, workers: int) -> int:
+    """Partitions needed for workers of them at a time to fit in mem_mb megabytes."""
+    budget = max(1, mem_mb * (1 << 20) // workers)
+    return max(1, -(-nbytes * MEM_PER_BYTE // budget))
+
+
+def merge_runs(
+    paths: list[str], out: str, mem_mb: int | None = None, workers: int | None = None
+) -> dict[str, int]:
+    """
+    Merge the graphs of the runs in paths (directories or files) into one
+    deduplicated knowledge base, saved with out as file name prefix.
+    Return counts of runs, edges read, malformed lines, distinct edges and partitions.
+    """
+    if mem_mb is None:
+        mem_mb = CF.MERGE_MEM_MB
+    if workers is None:
+        workers = CF.MERGE_WORKERS or os.cpu_count() or 1
+    runs = run_prefixes(paths, exclude=out)
+    nbytes = sum(os.path.getsize(fname) for _, fname in runs)
+    parts = num_parts(nbytes, mem_mb, workers)
+    stats = {"runs": len(runs), "edges": 0, "malformed": 0, "distinct": 0, "parts": parts}
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+
+    # tasks of about the same size, the largest runs first
+    ntasks = max(1, min(len(runs), 4 * workers))
+    tasks = [[] for _ in range(ntasks)]
+    loads = [0] * ntasks
+    for run in sorted(range(len(runs)), key=lambda r: -os.path.getsize(runs[r][1])):
+        t = loads.index(min(loads))
+        tasks[t].append((run, runs[run][1]))
+        loads[t] += os.path.getsize(runs[run][1])
+
+    tmp = tempfile.mkdtemp(prefix="merge_", dir=os.path.dirname(out) or ".")
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for n, bad in pool.map(split_runs, tasks, [parts] * ntasks, [tmp] * ntasks, range(ntasks)):
+                stats["edges"] += n
+                stats["malformed"] += bad
+            outs = [os.path.join(tmp, f"d{part:05d}.tsv") for part in range(parts)]
+            inputs = [
+                [partition_name(tmp, part, t) for t in range(ntasks) if os.path.exists(partition_name(tmp, part, t))]
+                for part in range(parts)
+            ]
+            stats["distinct"] = sum(pool.map(dedup_partition, inputs, outs))
+        save_merged(out, runs, outs)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(
+        "Merged %(runs)d runs: %(edges)d edges read, %(malformed)d malformed lines, "
+        "%(distinct)d distinct edges, in %(parts)d partitions" % stats
+    )
+    return stats
+
+
+def save_merged(out: str, runs: list[tuple[str, str]], outs: list[str]):
+    """Stream the sorted partitions, merged, into the files of the merged knowledge base."""
+    files = [open(fname) for fname in outs]
+    try:
+        with (
+            open(out + "_kb.tsv", "w") as kb,
+            open(out + ".pro", "w") as pro,
+            open(out + "_sources.tsv", "w") as src,
+        ):
+            pro.write(f"% MERGED RUNS: {len(runs)}\n\n")
+            for line in heapq.merge(*files):
+                s, v, o, _ = line.split("\t")
+                kb.write(f"{s}\t{v}\t{o}\n")
+                pro.write(f"fact({s},{v},{o}).\n")
+                src.write(line)
+    finally:
+        for f in files:
+            f.close()
+    with open(out + "_runs.tsv", "w") as f:
+        for run, (prefix, _) in enumerate(runs):
+            f.write(f"{run}\t{os.path.basename(prefix)}\t{seed_question(prefix)}\n")
+    print(f"Merged knowledge graph stored in {out}_kb.tsv and {out}.pro, sources in {out}_sources.tsv")
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge(self):
+        from synt import save_views
+
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "a_kb.tsv"), "w") as f:
+                f.write("fpga\tspeeds_up\tinterpreter\nfpga\tis_a\thardware\nx\tbad\ty\n")
+            with open(os.path.join(d, "a_sum.txt"), "w") as f:
+                f.write("SEED QUESTION: What is an FPGA?\n\n")
+            with open(os.path.join(d, "a.pro"), "w") as f:  # a_kb.tsv is read instead
+                f.write("% SEED QUESTION: What is an FPGA?\n\nfact(unread,is,unread).\n")
+            with open(os.path.join(d, "b.pro"), "w") as f:
+                f.write("% SEED QUESTION: What is a CPU?\n\n")
+                f.write("fact(cpu,is_a,hardware).\nfact('FPGA',speeds_up,interpreter).\n")
+            save_views(os.path.join(d, "a"), {1: [("fpga", "redirected_to", "hardware")]})  # not runs
+            out = os.path.join(d, "merged", "all")
+            stats = merge_runs([d], out, mem_mb=1, workers=2)
+            self.assertEqual((stats["runs"], stats["edges"], stats["malformed"], stats["distinct"]), (2, 4, 1, 3))
+
+            with open(out + "_kb.tsv") as f:
+                kb = [tuple(line.rstrip("\n").split("\t")) for line in f]
+            self.assertEqual(kb, sorted(kb))
+            self.assertEqual(len(kb), 3)
+            with open(out + "_sources.tsv") as f:
+                self.assertIn("fpga\tspeeds_up\tinterpreter\t0,1\n", f.read())
+            with open(out + "_runs.tsv") as f:
+                self.assertEqual(f.read(), "0\ta\tWhat is an FPGA?\n1\tb\tWhat is a CPU?\n")
+            with open(out + ".pro") as f:
+                self.assertIn("fact(cpu,is_a,hardware).\n", f.read())
+            self.assertEqual(merge_runs([d, out + "_kb.tsv"], out)["runs"], 2)  # not merged into itself
+
+    def test_parts(self):
+        self.assertEqual(num_parts(1000, 256, 4), 1)
+        self.assertEqual(num_parts(1 << 30, 256, 4), 4 * MEM_PER_BYTE * 4)
+
+
+if __name__ == "__main__":  # python merge.py <out_prefix> [<dir or file>...]
+    import sys
+
+    merge_runs(sys.argv[2:] or [CF.OUTDIR], sys.argv[1] if len(sys.argv) > 1 else os.path.join(CF.OUTDIR, "merged"))
@@ -0,0 +1,317 @@
+import os
+import json
+import unittest
+import tempfile
+from unittest import mock
+from copy import deepcopy
+from threading import Lock
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import CF
+
+# Per-call telemetry of the LLM calls of a run: which prompter asked, the
+# backend and model, tokens, latency, retries, cost and, for the prompters
+# answering with facts, how many edges were parsed from the answer.
+# Calls are added as they finish to the totals and histograms of their
+# (prompter, backend, model) group, exported as JSON and in the Prometheus
+# text format (for the textfile collector). Only the last CF.METRICS_CALLS
+# calls of a run are kept as such, and a run is dropped by end_run.
+
+LATENCY_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)  # seconds
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)  # completion tokens
+
+_prompter: ContextVar[str] = ContextVar("prompter", default="ask")
+_run: ContextVar[str] = ContextVar("run", default="")
+_last_call: ContextVar[tuple | None] = ContextVar("last_call", default=None)  # (call, its group)
+_calls_lock = Lock()
+_groups: dict[str, dict[tuple, dict]] = {}  # run -> (prompter, backend, model) -> totals and histograms
+_calls: dict[str, deque] = {}  # run -> its last CF.METRICS_CALLS calls
+
+
+@contextmanager
+def prompter_name(name: str):
+    """Attribute the calls made from the current thread or task to the prompter name."""
+    token = _prompter.set(name)
+    try:
+        yield
+    finally:
+        _prompter.reset(token)
+
+
+def start_run(name: str):
+    """
+    Tag the calls made from now on in the current thread or task with the
+    run name, dropping those of an earlier run of the same name.
+    """
+    _run.set(name)
+    with _calls_lock:
+        _groups[name] = {}
+        _calls[name] = deque(maxlen=CF.METRICS_CALLS)
+
+
+def end_run(name: str):
+    """Drop the metrics of the run, once saved."""
+    with _calls_lock:
+        _groups.pop(name, None)
+        _calls.pop(name, None)
+
+
+def new_histogram(buckets: tuple) -> dict:
+    counts = {str(b): 0 for b in buckets}
+    counts["+Inf"] = 0
+    return {"buckets": counts, "sum": 0, "count": 0}
+
+
+def observe(h: dict, x):
+    """Count x in the cumulative buckets of h, as in Prometheus."""
+    for le in h["buckets"]:
+        if x <= float(le):
+            h["buckets"][le] += 1
+    h["sum"] += x
+    h["count"] += 1
+
+
+def add_call(groups: dict, call: dict) -> dict:
+    """Add the call to the totals and histograms of its group, returned."""
+    key = (call["prompter"], call["backend"], call["model"])
+    g = groups.get(key)
+    if g is None:
+        g = groups[key] = {
+            "prompter": key[0],
+            "backend": key[1],
+            "model": key[2],
+            "calls": 0,
+            "cache_hits": 0,
+            "retries": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "cost": 0.0,
+            "edges": 0,
+            "latency": new_histogram(LATENCY_BUCKETS),
+            "completion_tokens_hist": new_histogram(TOKEN_BUCKETS),
+        }
+    g["calls"] += 1
+    g["cache_hits"] += call["cache_hit"]
+    for k in ("retries", "prompt_tokens", "completion_tokens", "cached_tokens", "cost"):
+        g[k] += call[k]
+    g["edges"] += call["edges"] or 0
+    observe(g["latency"], call["latency"])
+    if not call["cache_hit"]:
+        observe(g["completion_tokens_hist"], call["completion_tokens"])
+    return g
+
+
+def record_call(**fields) -> dict:
+    """Record a finished call, attributed to the current run and prompter."""
+    call = {
+        "run": _run.get(),
+        "prompter": _prompter.get(),
+        "backend": "",
+        "model": "",
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "latency": 0.0,
+        "retries": 0,
+        "cost": 0.0,
+        "cache_hit": False,
+        "edges": None,
+    }
+    call.update(fields)
+    with _calls_lock:
+        g = add_call(_groups.setdefault(call["run"], {}), call)
+        _calls.setdefault(call["run"], deque(maxlen=CF.METRICS_CALLS)).append(call)
+    _last_call.set((call, g))
+    return call
+
+
+def note_edges(n: int):
+    """Record the number of edges parsed from the answer of the last call of this thread or task."""
+    last = _last_call.get()
+    if last is not None:
+        call, g = last
+        with _calls_lock:
+            g["edges"] += n - (call["edges"] or 0)
+            call["edges"] = n
+
+
+def reset_metrics():
+    with _calls_lock:
+        _groups.clear()
+        _calls.clear()
+
+
+def calls(run: str | None = None) -> list[dict]:
+    """The last CF.METRICS_CALLS calls of the run, or of the current run if None."""
+    if run is None:
+        run = _run.get()
+    with _calls_lock:
+        return list(_calls.get(run, ()))
+
+
+def summary(cs: list[dict] | None = None) -> list[dict]:
+    """
+    The calls grouped by prompter, backend and model, with their totals and
+    histograms. All the calls of the current run if cs is None.
+    """
+    if cs is None:
+        with _calls_lock:
+            groups = deepcopy(_groups.get(_run.get(), {}))
+    else:
+        groups = {}
+        for c in cs:
+            add_call(groups, c)
+    return [groups[k] for k in sorted(groups)]
+
+
+def to_json(fname: str, cs: list[dict] | None = None):
+    groups = summary(cs)
+    if cs is None:
+        cs = calls()
+    with open(fname, "w") as f:
+        json.dump({"groups": groups, "calls": cs}, f, indent=2)
+
+
+def prom_labels(g: dict, **extra) -> str:
+    labels = {"prompter": g["prompter"], "backend": g["backend"], "model": g["model"], **extra}
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items())
+
+
+def to_prometheus(fname: str, cs: list[dict] | None = None):
+    """Write the metrics in the Prometheus text format, replacing the file atomically."""
+    groups = summary(cs)
+    lines = []
+
+    def hist(name: str, help: str, key: str):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        for g in groups:
+            h = g[key]
+            for le, n in h["buckets"].items():
+                lines.append(f"{name}_bucket{{{prom_labels(g, le=le)}}} {n}")
+            lines.append(f"{name}_sum{{{prom_labels(g)}}} {h['sum']}")
+            lines.append(f"{name}_count{{{prom_labels(g)}}} {h['count']}")
+
+    def counter(name: str, help: str, key: str):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} counter")
+        for g in groups:
+            lines.append(f"{name}{{{prom_labels(g)}}} {g[key]}")
+
+    hist("llm_call_seconds", "Latency of the LLM calls.", "latency")
+    hist("llm_completion_tokens", "Completion tokens per LLM call.", "completion_tokens_hist")
+    counter("llm_calls_total", "LLM calls, cache hits included.", "calls")
+    counter("llm_cache_hits_total", "LLM calls answered from the response cache.", "cache_hits")
+    counter("llm_retries_total", "Retried LLM requests.", "retries")
+    counter("llm_prompt_tokens_total", "Prompt tokens.", "prompt_tokens")
+    counter("llm_completion_tokens_total", "Completion tokens.", "completion_tokens")
+    counter("llm_cached_tokens_total", "Prompt tokens served from the provider cache.", "cached_tokens")
+    counter("llm_cost_dollars_total", "Cost of the LLM calls.", "cost")
+    counter("llm_edges_total", "Edges parsed from the answers.", "edges")
+
+    tname = fname + ".tmp"
+    with open(tname, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tname, fname)
+
+
+def save_metrics(fname: str):
+    """Save the metrics of the run to the _metrics.json and _metrics.prom files."""
+    if not CF.METRICS:
+        return
+    to_json(fname + "_metrics.json")
+    to_prometheus(fname + "_metrics.prom")
+    print(f"Call metrics stored in {fname}_metrics.json and {fname}_metrics.prom")
+
+
+def show_metrics():
+    """Print the share of time and cost of each prompter in the current run."""
+    groups = summary()
+    time = sum(g["latency"]["sum"] for g in groups) or 1.0
+    cost = sum(g["cost"] for g in groups) or 1.0
+    for g in groups:
+        print(
+            "%s: calls: %d time: %.3fs (%.1f%%) cost: $%.8f (%.1f%%) tokens: %d+%d edges: %d"
+            % (
+                g["prompter"],
+                g["calls"],
+                g["latency"]["sum"],
+                100 * g["latency"]["sum"] / time,
+                g["cost"],
+                100 * g["cost"] / cost,
+                g["prompt_tokens"],
+                g["completion_tokens"],
+                g["edges"],
+            )
+        )
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        reset_metrics()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        reset_metrics()
+        _run.set("")
+        self.dir.cleanup()
+
+    def test_grouping(self):
+        with prompter_name("fact_prompter"):
+            record_call(backend="gpt", model="m", latency=0.7, completion_tokens=300, cost=0.5)
+            note_edges(12)
+            record_call(backend="gpt", model="m", latency=3.0, retries=1, cost=0.25)
+        record_call(backend="gpt", model="m", cache_hit=True)
+        ask, fact = summary()
+        self.assertEqual((ask["prompter"], ask["calls"], ask["cache_hits"]), ("ask", 1, 1))
+        self.assertEqual((fact["calls"], fact["retries"], fact["cost"], fact["edges"]), (2, 1, 0.75, 12))
+        self.assertEqual(fact["latency"]["buckets"]["1.0"], 1)
+        self.assertEqual(fact["latency"]["buckets"]["5.0"], 2)
+        self.assertEqual(fact["completion_tokens_hist"]["buckets"]["250"], 1)
+
+    def test_runs(self):
+        start_run("r1")
+        record_call(latency=1.0)
+        start_run("r2")
+        record_call(latency=2.0)
+        self.assertEqual([c["latency"] for c in calls()], [2.0])
+        start_run("r1")
+        self.assertEqual(calls(), [])
+        self.assertEqual(len(calls("r2")), 1)
+
+    def test_export(self):
+        with prompter_name("sum_prompter"):
+            record_call(backend="gpt", model='m"1', latency=1.5, cost=0.1)
+        fname = os.path.join(self.dir.name, "run")
+        to_json(fname + ".json")
+        with open(fname + ".json") as f:
+            self.assertEqual(json.load(f)["groups"][0]["latency"]["count"], 1)
+        to_prometheus(fname + ".prom")
+        with open(fname + ".prom") as f:
+            text = f.read()
+        self.assertIn('llm_call_seconds_bucket{prompter="sum_prompter",backend="gpt",model="m\\"1",le="2.0"} 1', text)
+        self.assertIn('llm_cost_dollars_total{prompter="sum_prompter",backend="gpt",model="m\\"1"} 0.1', text)
+
+    def test_bounded(self):
+        with mock.patch.object(CF, "METRICS_CALLS", 3):
+            start_run("r1")
+            for i in range(10):
+                record_call(latency=float(i))
+                note_edges(1)
+        self.assertEqual([c["latency"] for c in calls()], [7.0, 8.0, 9.0])
+        (g,) = summary()
+        self.assertEqual((g["calls"], g["edges"], g["latency"]["sum"]), (10, 10, 45.0))
+        self.assertEqual(summary(calls())[0]["calls"], 3)
+        end_run("r1")
+        self.assertEqual((calls(), summary()), ([], []))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,233 @@
+import json
+import random
+import sqlite3
+import hashlib
+import unittest
+import threading
+from time import sleep
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import CF
+
+# A local stand-in for an OpenAI-compatible LLM, serving /v1/chat/completions
+# (plain and streamed) on 127.0.0.1, so that whole runs can be timed offline.
+# Answers are recorded ones, looked up in a response cache file, or else
+# synthetic ones of the shape each prompter expects, the same for the same
+# prompt. A latency profile sets the time to the first token and the rate
+# at which the rest of the answer comes.
+
+PROFILES = {
+    "instant": {"latency": 0.0, "tokens_per_s": 0, "jitter": 0.0},  # 0 tokens/s: no wait
+    "local": {"latency": 0.05, "tokens_per_s": 2000, "jitter": 0.2},
+    "remote": {"latency": 0.5, "tokens_per_s": 200, "jitter": 0.3},
+}
+FACTS_PER_ANSWER = 20
+VOCABULARY = 2000  # distinct concepts the synthetic answers draw from, so that steps overlap
+VERBS = ("is_a_kind_of", "is_part_of", "can_lead_to", "enables", "uses")
+
+
+def concept(rng: random.Random) -> str:
+    return f"concept_{int(VOCABULARY * rng.random() ** 2)}"
+
+
+def synthetic_answer(prompt: str) -> str:
+    """An answer of the shape the prompter of prompt expects, seeded by the prompt."""
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+    if "Here are the nouns:" in prompt:
+        nouns = prompt.split("Here are the nouns:", 1)[1].split("you will work with", 1)[0].strip()
+        return "\n".join(
+            f"fact('{n}',is_a_kind_of,'{concept(rng)}')." for n in nouns.split(";") if n
+        )
+    if "Prolog goals" in prompt:
+        return f"fact(X, {rng.choice(VERBS)}, {concept(rng)})."
+    if "summarize them" in prompt:
+        words = [concept(rng).replace("_", " ") for _ in range(8)]
+        return " ".join(f"The {a} relates to the {b}." for a, b in zip(words[::2], words[1::2]))
+    if "questions should I ask" in prompt:
+        return "\n".join(f"What is the role of {concept(rng)} in {concept(rng)}?" for _ in range(5))
+    if "question should I ask" in prompt:
+        return f"What is the role of {concept(rng)} in {concept(rng)}?"
+    return "\n".join(
+        f"fact('{concept(rng)}',{rng.choice(VERBS)},'{concept(rng)}')." for _ in range(FACTS_PER_ANSWER)
+    )
+
+
+def tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class MockLLM:
+    """
+    The server, with its latency profile and its recorded answers (a
+    response cache file, looked up as backend and model would be, or None),
+    counting the requests it got.
+    """
+
+    def __init__(self, profile: str | dict = "instant", recorded: str | None = None, backend="gpt", model=None):
+        self.profile = PROFILES[profile] if isinstance(profile, str) else profile
+        self.recorded = recorded
+        self.backend = backend
+        self.model = model or CF.GPT_MODEL
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.replayed = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d/v1" % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, prompt: str) -> str:
+        if self.recorded:
+            from cache import ResponseCache
+
+            key = ResponseCache.key(self.backend, self.model, prompt)
+            with sqlite3.connect(f"file:{self.recorded}?mode=ro", uri=True) as db:
+                row = db.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                with self.lock:
+                    self.replayed += 1
+                return row[0]
+        return synthetic_answer(prompt)
+
+    def delay(self) -> tuple[float, float]:
+        """Seconds to the first token and per token."""
+        p = self.profile
+        k = 1 + p["jitter"] * (2 * random.random() - 1)
+        per_token = k / p["tokens_per_s"] if p["tokens_per_s"] else 0.0
+        return p["latency"] * k, per_token
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, obj: dict):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        mock = self.server.mock
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found: " + self.path}})
+            return
+        with mock.lock:
+            mock.requests += 1
+        prompt = "\n".join(m["content"] for m in req["messages"])
+        text = mock.answer(prompt)
+        usage = {
+            "prompt_tokens": tokens(prompt),
+            "completion_tokens": tokens(text),
+            "total_tokens": tokens(prompt) + tokens(text),
+        }
+        first, per_token = mock.delay()
+        sleep(first)
+        if req.get("stream"):
+            self.stream(req, text, usage, per_token)
+            return
+        sleep(per_token * usage["completion_tokens"])
+        self.send_json(
+            200,
+            {
+                "id": "mock",
+                "object": "chat.completion",
+                "created": 0,
+                "model": req["model"],
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                ],
+                "usage": usage,
+            },
+        )
+
+    def stream(self, req: dict, text: str, usage: dict, per_token: float):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(choices, **extra):
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": req["model"]}
+            self.wfile.write(b"data: " + json.dumps({**chunk, "choices": choices, **extra}).encode() + b"\n\n")
+            self.wfile.flush()
+
+        try:
+            for i in range(0, len(text), 16):  # about 4 tokens per chunk
+                send([{"index": 0, "delta": {"content": text[i : i + 16]}, "finish_reason": None}])
+                sleep(per_token * 4)
+            if req.get("stream_options", {}).get("include_usage"):
+                send([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):  # the client cancelled the answer
+            pass
+
+
+@contextmanager
+def mock_llm(profile: str | dict = "instant", recorded: str | None = None):
+    """Run the calls made within on a MockLLM, as an Ollama backend with the response cache off."""
+    mock = MockLLM(profile, recorded)
+    saved = CF.USE_OLLAMA, CF.OLLAMA_BASE_URL, CF.CACHE
+    CF.USE_OLLAMA, CF.OLLAMA_BASE_URL, CF.CACHE = True, mock.url, "off"
+    try:
+        yield mock
+    finally:
+        CF.USE_OLLAMA, CF.OLLAMA_BASE_URL, CF.CACHE = saved
+        mock.stop()
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestMockLLM(unittest.TestCase):
+    def test_ask(self):
+        from chatbot import ask, ask_stream
+
+        with mock_llm() as mock:
+            answer, _ = ask('Here is my question: "What is an FPGA?"')
+            self.assertEqual(len(answer.split("\n")), FACTS_PER_ANSWER)
+            self.assertEqual(ask('Here is my question: "What is an FPGA?"')[0], answer)
+            lines = list(ask_stream('Here is my question: "What is an FPGA?"'))
+            self.assertEqual("\n".join(lines), answer)
+            self.assertEqual(mock.requests, 3)
+
+    def test_recorded(self):
+        import os
+        import tempfile
+        from cache import ResponseCache
+
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, "cache.db")
+            cache = ResponseCache(fname)
+            cache.put(cache.key("gpt", CF.GPT_MODEL, "hello"), "gpt", CF.GPT_MODEL, "recorded answer", 0.1)
+            cache.db.commit()
+            mock = MockLLM(recorded=fname)
+            try:
+                self.assertEqual(mock.answer("hello"), "recorded answer")
+                self.assertIn("fact(", mock.answer("Here is my question: 'x'"))
+                self.assertEqual(mock.replayed, 1)
+            finally:
+                mock.stop()
+                cache.db.close()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
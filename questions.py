@@ -0,0 +1,108 @@
+import re
+import unittest
+from collections import Counter
+from config import CF
+
+# The questions asked in a run, indexed by their content words, so that a
+# next question paraphrasing one of them (or the seed question) is caught
+# before paying for its facts, summary, next question and goal.
+
+STOPWORDS = {
+    "the", "and", "for", "are", "what", "which", "who", "whom", "how", "why", "when", "where",
+    "does", "did", "can", "could", "should", "would", "will", "this", "that", "these", "those",
+    "with", "from", "into", "about", "between", "its", "their", "they", "there", "some", "any",
+    "has", "have", "been", "being", "was", "were", "more", "most", "other", "than", "also",
+}
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def quest_words(quest: str) -> frozenset:
+    """The set of lowercased content words of a question, with a plural s dropped."""
+    words = (w for w in WORD_RE.findall(quest.lower()) if len(w) > 2 and w not in STOPWORDS)
+    return frozenset(w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w for w in words)
+
+
+class QuestIndex:
+    """
+    Questions with an inverted index from their words, answering the most
+    similar earlier question by the Jaccard similarity of their words,
+    looking only at the questions sharing some word with it.
+    """
+
+    def __init__(self, threshold: float | None = None):
+        if threshold is None:
+            threshold = CF.DUP_QUEST
+        self.threshold = threshold
+        self.quests: list[str] = []
+        self.words: list[frozenset] = []
+        self.postings: dict[str, list[int]] = {}
+
+    def __len__(self):
+        return len(self.quests)
+
+    def add(self, quest: str):
+        ws = quest_words(quest)
+        i = len(self.quests)
+        self.quests.append(quest)
+        self.words.append(ws)
+        for w in ws:
+            self.postings.setdefault(w, []).append(i)
+
+    def nearest(self, quest: str) -> tuple[str | None, float]:
+        """The most similar question and its similarity, (None, 0.0) if none shares a word."""
+        ws = quest_words(quest)
+        shared = Counter(i for w in ws for i in self.postings.get(w, ()))
+        best, sim = None, 0.0
+        for i, k in shared.items():
+            s = k / (len(ws) + len(self.words[i]) - k)
+            if s > sim:
+                best, sim = self.quests[i], s
+        return best, sim
+
+    def similar(self, quest: str) -> str | None:
+        """The earlier question quest is a near duplicate of, if any."""
+        best, sim = self.nearest(quest)
+        return best if sim >= self.threshold else None
+
+
+def saturated(yields: list[int], min_yield: int | None = None, steps: int | None = None) -> bool:
+    """Check if each of the last steps steps added fewer than min_yield new edges."""
+    if min_yield is None:
+        min_yield = CF.MIN_YIELD
+    if steps is None:
+        steps = CF.SATURATION_STEPS
+    if min_yield <= 0 or len(yields) < max(1, steps):
+        return False
+    return all(y < min_yield for y in yields[-max(1, steps):])
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestQuestIndex(unittest.TestCase):
+    def test_similar(self):
+        index = QuestIndex(threshold=0.7)
+        index.add("How do FPGA accelerators speed up logic programs?")
+        index.add("What are the limits of Horn clause resolution?")
+        self.assertEqual(
+            index.similar("How can FPGA accelerators speed up logic programs"),
+            "How do FPGA accelerators speed up logic programs?",
+        )
+        self.assertEqual(
+            index.similar("What limits does Horn clause resolution have?"),
+            "What are the limits of Horn clause resolution?",
+        )
+        self.assertIsNone(index.similar("Why do FPGA accelerators need custom memory layouts?"))
+        self.assertEqual(index.nearest("Who wrote Hamlet?"), (None, 0.0))
+
+    def test_saturated(self):
+        self.assertFalse(saturated([30, 2], min_yield=0, steps=1))
+        self.assertFalse(saturated([30, 2], min_yield=5, steps=2))
+        self.assertTrue(saturated([30, 2, 4], min_yield=5, steps=2))
+        self.assertFalse(saturated([3], min_yield=5, steps=2))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,241 @@
+import unittest
+from array import array
+import numpy as np
+from config import CF
+from store import TripleStore
+
+# PageRank of the concept graph, computed on sparse matrices built directly
+# from the id columns of a TripleStore. It follows networkx.pagerank on the
+# reversed graph, with each (s,o) pair weighted by maxlen / (verbs linking them).
+
+
+def pair_weights(store: TripleStore) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The distinct (s,o) pairs of ids, and their weights maxlen / (verbs per pair)."""
+    s = np.frombuffer(store.subj, dtype=np.int32).astype(np.int64)
+    o = np.frombuffer(store.obj, dtype=np.int32).astype(np.int64)
+    pairs, counts = np.unique((s << 32) | o, return_counts=True)
+    maxlen = counts.max()
+    print(f"Max verbs per (s,o): {maxlen}")
+    return pairs >> 32, pairs & 0xFFFFFFFF, maxlen / counts
+
+
+def pagerank(
+    src: np.ndarray,
+    dst: np.ndarray,
+    weight: np.ndarray,
+    n: int,
+    alpha: float = 0.85,
+    tol: float = 1e-6,
+    max_iter: int = 100,
+    x0: np.ndarray | None = None,
+) -> tuple[np.ndarray, int]:
+    """
+    Power iteration PageRank of the graph with weighted edges src -> dst over
+    nodes 0..n-1, starting from x0 (uniform if None). Dangling nodes spread
+    their rank uniformly. Stops when the L1 change falls below n * tol, as in
+    networkx, and returns the ranks with the number of iterations done.
+    """
+    import scipy.sparse as sp
+
+    A = sp.csr_array((weight, (src, dst)), shape=(n, n), dtype=float)
+    out = np.asarray(A.sum(axis=1)).ravel()
+    dangling = out == 0
+    inv = np.divide(1.0, out, out=np.zeros(n), where=~dangling)
+    AT = (sp.diags_array(inv) @ A).T.tocsr()  # x @ A == A.T @ x
+
+    if x0 is None:
+        x = np.full(n, 1.0 / n)
+    else:
+        x = x0 / x0.sum()
+    p = 1.0 / n
+    for i in range(max_iter):
+        xlast = x
+        x = alpha * (AT @ x + x[dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - xlast).sum() < n * tol:
+            return x, i + 1
+    print(f"WARNING: PageRank did not converge in {max_iter} iterations")
+    return x, max_iter
+
+
+def node_ranks(store: TripleStore, tol: float | None = None) -> np.ndarray:
+    """
+    PageRank of the nodes of the store, indexed by string id (0 for strings
+    that are not nodes).
+    """
+    if tol is None:
+        tol = CF.PAGERANK_TOL
+    if len(store) == 0:
+        return np.zeros(len(store.names))
+    s, o, w = pair_weights(store)
+    nodes = np.unique(np.concatenate((s, o)))
+    src = np.searchsorted(nodes, o)  # on the reversed graph
+    dst = np.searchsorted(nodes, s)
+    x, iters = pagerank(src, dst, w, len(nodes), tol=tol)
+    print(f"PageRank of {len(nodes)} nodes converged in {iters} iterations")
+    ranks = np.zeros(len(store.names))
+    ranks[nodes] = x
+    return ranks
+
+
+def rank_dict(store: TripleStore, ranks: np.ndarray) -> dict[str, float]:
+    """The ranks of the nodes by name."""
+    names = store.names
+    return {names[i]: float(ranks[i]) for i in store.node_ids()}
+
+
+def triple_scores(store: TripleStore, ranks: np.ndarray) -> np.ndarray:
+    """
+    The score of each triple: the rank of its subject plus that of its verb,
+    0 unless the verb is also a node, the key rank_svos sorted by with networkx.
+    """
+    s = np.frombuffer(store.subj, dtype=np.int32)
+    v = np.frombuffer(store.verb, dtype=np.int32)
+    return ranks[s] + ranks[v]
+
+
+def top_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Rows of the k highest scores (all if k <= 0), best first, ties kept in
+    row order, as a stable sort would. Only the rows reaching the k-th best
+    score are sorted.
+    """
+    if k <= 0 or k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    rows = np.flatnonzero(scores >= threshold)
+    return rows[np.argsort(-scores[rows], kind="stable")][:k]
+
+
+class IncrementalRanker:
+    """
+    Keeps the ranks of a growing TripleStore up to date. Only the rows added
+    since the last update are folded into the (s,o) pair counts and the node
+    index, and the power iteration is warm-started from the previous ranks,
+    so when a step adds a few edges, it mostly settles the part of the graph
+    that changed and converges in far fewer rounds than from scratch.
+    """
+
+    def __init__(self, store: TripleStore):
+        self.store = store
+        self.done = 0  # rows of the store already counted
+        self.pairs: dict[tuple[int, int], int] = {}  # (s,o) ids -> pair index
+        self.src = array("i")  # pair index -> node index of o (reversed graph)
+        self.dst = array("i")  # pair index -> node index of s
+        self.counts = array("i")  # pair index -> verbs linking s and o
+        self.node_index: dict[int, int] = {}  # string id -> node index
+        self.nodes = array("i")  # node index -> string id
+        self.x: np.ndarray | None = None  # ranks by node index
+        self.ranks: np.ndarray | None = None  # ranks by string id
+
+    def node(self, i: int) -> int:
+        k = self.node_index.get(i)
+        if k is None:
+            k = len(self.nodes)
+            self.node_index[i] = k
+            self.nodes.append(i)
+        return k
+
+    def update(self, tol: float | None = None) -> np.ndarray:
+        """Fold in the new rows of the store and return the ranks by string id."""
+        if tol is None:
+            tol = CF.PAGERANK_TOL
+        store = self.store
+        subj, obj = store.subj, store.obj
+        for row in range(self.done, len(store)):
+            so = subj[row], obj[row]
+            k = self.pairs.get(so)
+            if k is None:
+                self.pairs[so] = len(self.counts)
+                self.src.append(self.node(so[1]))
+                self.dst.append(self.node(so[0]))
+                self.counts.append(1)
+            else:
+                self.counts[k] += 1
+        self.done = len(store)
+
+        n = len(self.nodes)
+        self.ranks = np.zeros(len(store.names))
+        if n == 0:
+            return self.ranks
+        counts = np.array(self.counts, dtype=float)
+        x0 = None
+        if self.x is not None:
+            x0 = np.full(n, 1.0 / n)
+            x0[: len(self.x)] = self.x
+        self.x, iters = pagerank(
+            np.array(self.src), np.array(self.dst), counts.max() / counts, n, tol=tol, x0=x0
+        )
+        print(f"PageRank of {n} nodes updated in {iters} iterations")
+        self.ranks[np.array(self.nodes)] = self.x
+        return self.ranks
+
+    def top(self, k: int) -> list:
+        """The k best ranked triples as of the last update."""
+        rows = top_rows(triple_scores(self.store, self.ranks), k)
+        return [self.store.triple(r) for r in rows]
+
+
+def nx_node_ranks(store: TripleStore) -> dict[str, float]:
+    """The ranks as computed with networkx, for reference."""
+    import networkx as nx
+
+    names = store.names
+    g = nx.DiGraph()
+    for s, o, w in zip(*pair_weights(store)):
+        g.add_edge(names[s], names[o], weight=w)
+    return nx.pagerank(g.reverse())
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestPageRank(unittest.TestCase):
+    def setUp(self):
+        self.store = TripleStore(
+            [
+                ("a", "is", "b"),
+                ("a", "has", "b"),
+                ("b", "is", "c"),
+                ("c", "is", "a"),
+                ("d", "is", "a"),
+                ("d", "has", "e"),
+                ("e", "is", "e"),
+            ]
+        )
+
+    def test_same_as_networkx(self):
+        ranks = rank_dict(self.store, node_ranks(self.store, tol=1e-10))
+        expected = nx_node_ranks(self.store)
+        self.assertEqual(ranks.keys(), expected.keys())
+        for x, r in expected.items():
+            self.assertAlmostEqual(ranks[x], r, places=5)
+
+    def test_warm_start(self):
+        ranker = IncrementalRanker(self.store)
+        ranker.update()
+        self.store.update([("e", "is", "f"), ("f", "has", "a")])
+        warm = ranker.update()
+        cold = node_ranks(self.store)
+        self.assertTrue(np.allclose(warm, cold, atol=1e-5))
+        self.assertEqual(ranker.top(2), ranker.top(0)[:2])
+
+    def test_scores_as_networkx(self):
+        # subject plus verb rank, the verb "e" being a node too, sorted stably as rank_svos did
+        self.store.add(("b", "e", "d"))
+        ranks = node_ranks(self.store, tol=1e-10)
+        rs = nx_node_ranks(self.store)
+        expected = sorted(self.store, key=lambda x: rs.get(x[0], 0) + rs.get(x[1], 0), reverse=True)
+        rows = top_rows(np.round(triple_scores(self.store, ranks), 6), 0)
+        self.assertEqual([self.store.triple(r) for r in rows], expected)
+
+    def test_top_rows(self):
+        scores = np.array([1.0, 3.0, 2.0, 3.0, 0.5, 2.0])
+        expected = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        for k in range(0, len(scores) + 1):
+            self.assertEqual(list(top_rows(scores, k)), expected[:k] if k else expected)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
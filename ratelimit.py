@@ -0,0 +1,235 @@
+import random
+import unittest
+from time import monotonic
+from threading import Lock
+from config import CF
+
+# Client-side rate limiting of the LLM calls of a backend: token buckets for
+# requests and tokens per minute, synced with the x-ratelimit-* headers of
+# the answers, and an AIMD limit on the calls in flight, halved on each 429
+# and slowly raised back on success, so that concurrent pipelines stay just
+# under the provider limits instead of repeatedly hitting them.
+
+
+class TokenBucket:
+    """Refills at rate per second up to capacity; unlimited while rate is 0."""
+
+    def __init__(self, per_minute: float = 0):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.t = monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.t) * self.rate)
+        self.t = now
+
+    def wait(self, n: float, now: float) -> float:
+        """Seconds until n can be taken, 0 if now."""
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        need = min(n, self.capacity) - self.level
+        return 0.0 if need <= 0 else need / self.rate
+
+    def take(self, n: float):
+        """Take n, possibly going into debt, as when correcting an estimate."""
+        if self.rate:
+            self.level -= n
+
+    def sync(self, limit: float | None, remaining: float | None, now: float):
+        """Follow the per-minute limit and the remaining amount reported by the provider."""
+        if limit:
+            self.rate = limit / 60
+            self.capacity = limit
+        if remaining is not None and self.rate:
+            self.refill(now)
+            self.level = min(self.level, remaining)
+
+
+def parse_duration(s: str | None) -> float | None:
+    """Seconds in a reset header such as "1s", "6m0s" or "20ms"."""
+    if not s:
+        return None
+    total, num = 0.0, ""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    i = 0
+    try:
+        while i < len(s):
+            if s[i].isdigit() or s[i] == ".":
+                num += s[i]
+                i += 1
+                continue
+            unit = "ms" if s[i : i + 2] == "ms" else s[i]
+            total += float(num) * units[unit]
+            num = ""
+            i += len(unit)
+        return total + float(num) if num else total
+    except (KeyError, ValueError):
+        return None
+
+
+def header_float(headers, name: str) -> float | None:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_concurrency: int = 16):
+        self.lock = Lock()
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)  # AIMD limit on the calls in flight
+        self.in_flight = 0
+        self.throttled = 0  # calls that had to wait
+        self.waited = 0.0
+        self.retries = 0
+        self.rate_limited = 0  # 429 answers
+
+    def try_acquire(self, tokens: float) -> float:
+        """Start a call of about tokens tokens, returning 0, or the seconds to wait before trying again."""
+        with self.lock:
+            if self.in_flight >= int(self.concurrency):
+                return 0.05
+            now = monotonic()
+            wait = max(self.requests.wait(1, now), self.tokens.wait(tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            return 0.0
+
+    def note_wait(self, t: float, first: bool):
+        with self.lock:
+            self.waited += t
+            if first:
+                self.throttled += 1
+
+    def release(self, ok: bool | None, headers=None, used_tokens: float = 0, estimate: float = 0):
+        """
+        End a call: correct the token estimate, sync the buckets with the
+        rate-limit headers, then raise the concurrency limit additively if the
+        call went through (ok), halve it if it was rate limited (not ok), and
+        leave it if it failed otherwise (None).
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if used_tokens:
+                self.tokens.take(used_tokens - estimate)
+            if headers is not None:
+                now = monotonic()
+                self.requests.sync(
+                    header_float(headers, "x-ratelimit-limit-requests"),
+                    header_float(headers, "x-ratelimit-remaining-requests"),
+                    now,
+                )
+                self.tokens.sync(
+                    header_float(headers, "x-ratelimit-limit-tokens"),
+                    header_float(headers, "x-ratelimit-remaining-tokens"),
+                    now,
+                )
+            if ok:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            elif ok is not None:
+                self.rate_limited += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+
+    def backoff(self, attempt: int, headers=None) -> float:
+        """
+        Seconds to wait before retry number attempt (from 0): as told by the
+        retry-after or reset headers if any, else a full-jitter exponential.
+        """
+        with self.lock:
+            self.retries += 1
+        if headers is not None:
+            ms = header_float(headers, "retry-after-ms")
+            if ms is not None:
+                return ms / 1000
+            s = header_float(headers, "retry-after")
+            if s is not None:
+                return s
+            resets = [
+                parse_duration(headers.get(h))
+                for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+            ]
+            resets = [r for r in resets if r]
+            if resets:
+                return max(resets) * (1 + 0.1 * random.random())
+        return random.uniform(0, min(CF.BACKOFF_MAX, CF.BACKOFF_BASE * 2**attempt))
+
+    def stats(self) -> str:
+        return (
+            "Rate limiting: throttled calls: %d (%.3fs waiting) retries: %d rate limited: %d concurrency: %.1f"
+            % (self.throttled, self.waited, self.retries, self.rate_limited, self.concurrency)
+        )
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = Lock()
+
+
+def get_limiter(backend: str) -> RateLimiter:
+    """The process-wide limiter of a backend, created from CF.RPM, CF.TPM and CF.MAX_CONNECTIONS."""
+    with _limiters_lock:
+        limiter = _limiters.get(backend)
+        if limiter is None:
+            limiter = RateLimiter(CF.RPM, CF.TPM, CF.MAX_CONNECTIONS)
+            _limiters[backend] = limiter
+        return limiter
+
+
+def show_limits():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    for backend, limiter in limiters.items():
+        if limiter.throttled or limiter.retries:
+            print(backend, limiter.stats())
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket(self):
+        b = TokenBucket(60)  # one per second
+        now = b.t
+        b.take(60)
+        self.assertAlmostEqual(b.wait(2, now), 2.0)
+        self.assertEqual(b.wait(2, now + 2), 0.0)
+        b.sync(120, 1, now + 2)
+        self.assertEqual((b.rate, b.level), (2.0, 1))
+        self.assertEqual(TokenBucket(0).wait(1e9, now), 0.0)
+
+    def test_aimd(self):
+        r = RateLimiter(max_concurrency=8)
+        for _ in range(8):
+            self.assertEqual(r.try_acquire(10), 0.0)
+        self.assertGreater(r.try_acquire(10), 0.0)
+        r.release(False)
+        self.assertEqual(r.concurrency, 4.0)
+        r.release(True)
+        self.assertEqual(r.concurrency, 4.25)
+        r.release(None)  # a timeout or a 5xx
+        self.assertEqual(r.concurrency, 4.25)
+        self.assertEqual((r.in_flight, r.rate_limited), (5, 1))
+
+    def test_headers(self):
+        r = RateLimiter()
+        self.assertEqual(r.try_acquire(100), 0.0)
+        r.release(True, {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0"})
+        self.assertGreater(r.try_acquire(1), 0.5)
+        self.assertEqual(r.backoff(0, {"retry-after-ms": "250"}), 0.25)
+        self.assertAlmostEqual(r.backoff(0, {"x-ratelimit-reset-requests": "6m0s"}), 360, delta=36)
+        self.assertEqual(parse_duration("20ms"), 0.02)
+        self.assertEqual(parse_duration("1h2m3.5s"), 3723.5)
+        self.assertLessEqual(r.backoff(3), CF.BACKOFF_BASE * 8)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -1,5 +1,9 @@
-from typing import Iterable, Tuple, Dict, Set, Optional
+from typing import Iterable, Tuple, Dict, Set, Optional, Sequence
+import heapq
+import numbers
 import unittest
+import numpy as np
+from store import as_store
 
 Edge = Tuple[str, str, str]  # (source, edge_label, target)
 
@@ -7,10 +11,10 @@ Edge = Tuple[str, str, str]  # (source, edge_label, target)
 def redirect_edges_no_backflow(
     edges: Iterable[Edge],
     ranks: Dict[str, float],
-    topn: int,
+    topn: int | Sequence[int],
     *,
     drop_self_loops: bool = True,
-) -> Set[Edge]:
+) -> Set[Edge] | Dict[int, Set[Edge]]:
     """
     Keep the top-n highest-ranked nodes. For edges incident to dropped nodes:
 
@@ -23,45 +27,71 @@ def redirect_edges_no_backflow(
       • If no valid neighbor exists, drop the edge.
 
     Edge labels are preserved; duplicates removed by returning a set.
+    Given a list of sizes as topn, the sets of each size are returned by
+    size, computed together by redirect_sizes.
     """
 
-    edges = list(edges)
-    all_nodes = {u for (u, _, v) in edges} | {v for (_, _, v) in edges}
+    if not isinstance(topn, numbers.Integral):
+        return redirect_sizes(edges, ranks, topn, drop_self_loops=drop_self_loops)
 
-    # Determine kept nodes: sort by rank desc, tie-break by name asc for determinism
-    ordered = sorted(all_nodes, key=lambda n: (-ranks.get(n, float("-inf")), n))
-    kept = set(ordered[:max(0, topn)])
+    store = as_store(edges)
+    names = store.names
 
-    # Build adjacency
-    preds: Dict[str, Set[str]] = {n: set() for n in all_nodes}
-    succs: Dict[str, Set[str]] = {n: set() for n in all_nodes}
-    for s, _, t in edges:
-        succs[s].add(t)
-        preds[t].add(s)
+    def key(i: int) -> tuple:
+        n = names[i]
+        return (ranks.get(n, float("-inf")), -len(n), n)
 
-    def pick_best_kept(cands: Set[str], *, exclude: Set[str] = frozenset()) -> Optional[str]:
+    # Determine kept nodes: sort by rank desc, tie-break by name asc for determinism
+    ordered = heapq.nsmallest(
+        max(0, topn),
+        store.node_ids(),
+        key=lambda i: (-ranks.get(names[i], float("-inf")), names[i]),
+    )
+    kept = set(ordered)
+
+    # For each dropped node, its two best kept successors and predecessors,
+    # computed once from the store's indexes on first use. The runner-up is
+    # what pick_best_kept falls back to when the best one is excluded.
+    best_succs: Dict[int, Tuple[int, ...]] = {}
+    best_preds: Dict[int, Tuple[int, ...]] = {}
+
+    def best_two(cands: Iterable[int]) -> Tuple[int, ...]:
+        b1 = b2 = None
+        k1 = k2 = None
+        for c in cands:
+            if c not in kept or c == b1 or c == b2:
+                continue
+            k = key(c)
+            if b1 is None or k > k1:
+                b1, k1, b2, k2 = c, k, b1, k1
+            elif b2 is None or k > k2:
+                b2, k2 = c, k
+        return tuple(b for b in (b1, b2) if b is not None)
+
+    def pick_best_kept(best: Tuple[int, ...], exclude: Optional[int]) -> Optional[int]:
         """
-        Pick highest-ranked kept node from candidates, preferring those not in `exclude`.
+        Pick highest-ranked kept node from candidates, preferring one that is not `exclude`.
         If nothing remains after exclusion, fall back to any kept candidate.
         """
-        primary = [n for n in cands if n in kept and n not in exclude]
-        if primary:
-            return max(primary, key=lambda n: (ranks.get(n, float("-inf")), -len(n), n))
-        fallback = [n for n in cands if n in kept]
-        if fallback:
-            return max(fallback, key=lambda n: (ranks.get(n, float("-inf")), -len(n), n))
-        return None
+        if not best:
+            return None
+        if best[0] != exclude or len(best) == 1:
+            return best[0]
+        return best[1]
 
     out: Set[Edge] = set()
+    subj, obj = store.subj, store.obj
 
-    for s, lbl, t in edges:
+    for s, lbl, t in zip(*store.cols):
         # Map source (downstream only if dropped)
         if s in kept:
             ms = s
         else:
             # Avoid creating a self-loop if target already kept
-            exclude = {t} if t in kept else set()
-            ms = pick_best_kept(succs.get(s, set()), exclude=exclude)
+            best = best_succs.get(s)
+            if best is None:
+                best = best_succs[s] = best_two(obj[r] for r in store.rows(0, s))
+            ms = pick_best_kept(best, t if t in kept else None)
             if ms is None:
                 continue  # cannot map dropped source
 
@@ -70,18 +100,102 @@ def redirect_edges_no_backflow(
             mt = t
         else:
             # Avoid creating a self-loop by excluding the already-mapped source
-            mt = pick_best_kept(preds.get(t, set()), exclude={ms})
+            best = best_preds.get(t)
+            if best is None:
+                best = best_preds[t] = best_two(subj[r] for r in store.rows(2, t))
+            mt = pick_best_kept(best, ms)
             if mt is None:
                 continue  # cannot map dropped target
 
         if drop_self_loops and ms == mt:
             continue
 
-        out.add((ms, lbl, mt))
+        out.add((names[ms], names[lbl], names[mt]))
 
     return out
 
 
+def redirect_sizes(
+    edges: Iterable[Edge],
+    ranks: Dict[str, float],
+    sizes: Sequence[int],
+    *,
+    drop_self_loops: bool = True,
+) -> Dict[int, Set[Edge]]:
+    """
+    redirect_edges_no_backflow for each of the sizes, with the nodes ordered
+    once. The kept sets are nested, so going from the largest size to the
+    smallest, the kept successors and predecessors of each node (sorted as
+    best_two ranks them) only lose members, and the edges that cannot be
+    mapped at some size cannot be at the smaller ones either: both are
+    filtered as the sizes shrink, and each size maps the remaining edges
+    with array operations.
+    """
+    store = as_store(edges)
+    names = store.names
+    nodes = list(store.node_ids())
+    rank = {i: ranks.get(names[i], float("-inf")) for i in nodes}
+    nmax = max(sizes, default=0)
+    ordered = heapq.nsmallest(max(0, nmax), nodes, key=lambda i: (-rank[i], names[i]))
+    big = len(names) + 1
+    pos = np.full(len(names), big, dtype=np.int64)  # position in the kept order
+    pos[ordered] = np.arange(len(ordered))
+    keyed = sorted(ordered, key=lambda i: (rank[i], -len(names[i]), names[i]), reverse=True)
+    krank = np.full(len(names), big, dtype=np.int64)  # position in the order of best_two
+    krank[keyed] = np.arange(len(keyed))
+
+    s = np.frombuffer(store.subj, dtype=np.int32).astype(np.int64)
+    v = np.frombuffer(store.verb, dtype=np.int32).astype(np.int64)
+    o = np.frombuffer(store.obj, dtype=np.int32).astype(np.int64)
+
+    def candidates(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """The distinct (x, y) pairs with y kept, sorted by x, then y as best_two prefers it."""
+        keep = pos[y] < big
+        pairs = np.unique(np.stack((x[keep], y[keep]), axis=1), axis=0)
+        order = np.lexsort((krank[pairs[:, 1]], pairs[:, 0]))
+        return pairs[order, 0], pairs[order, 1]
+
+    def best_two(cx: np.ndarray, cy: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """For each node, its first and second candidate, -1 if none."""
+        b1 = np.full(len(names), -1, dtype=np.int64)
+        b2 = np.full(len(names), -1, dtype=np.int64)
+        if len(cx):
+            first = np.flatnonzero(np.r_[True, cx[1:] != cx[:-1]])
+            b1[cx[first]] = cy[first]
+            second = first[first + 1 < len(cx)] + 1
+            second = second[cx[second] == cx[second - 1]]
+            b2[cx[second]] = cy[second]
+        return b1, b2
+
+    def pick(b1: np.ndarray, b2: np.ndarray, exclude: np.ndarray) -> np.ndarray:
+        return np.where((b1 != exclude) | (b2 < 0), b1, b2)
+
+    succ_x, succ_y = candidates(s, o)
+    pred_x, pred_y = candidates(o, s)
+    out = {}
+    for n in sorted(set(sizes), reverse=True):
+        keep = pos[succ_y] < n
+        succ_x, succ_y = succ_x[keep], succ_y[keep]
+        keep = pos[pred_y] < n
+        pred_x, pred_y = pred_x[keep], pred_y[keep]
+        b1s, b2s = best_two(succ_x, succ_y)
+        b1p, b2p = best_two(pred_x, pred_y)
+
+        kept_s, kept_o = pos[s] < n, pos[o] < n
+        ms = np.where(kept_s, s, pick(b1s[s], b2s[s], np.where(kept_o, o, -2)))
+        mo = np.where(kept_o, o, pick(b1p[o], b2p[o], ms))
+        mapped = (ms >= 0) & (mo >= 0)
+        s, v, o, ms, mo = s[mapped], v[mapped], o[mapped], ms[mapped], mo[mapped]
+        if drop_self_loops:
+            loop = ms == mo
+            ms, mv, mo = ms[~loop], v[~loop], mo[~loop]
+        else:
+            mv = v
+        triples = np.unique(np.stack((ms, mv, mo), axis=1), axis=0)
+        out[n] = {(names[a], names[b], names[c]) for a, b, c in triples.tolist()}
+    return out
+
+
 # =========================
 #        Unit Tests
 # =========================
@@ -181,6 +295,22 @@ class TestRedirectNoBackflow(unittest.TestCase):
         self.assertGreater(len(out), 10)
         self.assertLess(len(out), len(self.edges))
 
+    def test_sizes(self):
+        # the sizes at once give what each size gives alone, also with tied ranks
+        import random
+
+        rng = random.Random(3)
+        nodes = [f"n{i}" for i in range(60)]
+        edges = {(rng.choice(nodes), f"v{rng.randrange(4)}", rng.choice(nodes)) for _ in range(300)}
+        for ranks in (self.ranks, {x: rng.randrange(5) for x in nodes}):
+            E = self.edges if ranks is self.ranks else edges
+            for loops in (True, False):
+                out = redirect_edges_no_backflow(E, ranks, [0, 3, 10, 25, 100], drop_self_loops=loops)
+                for n, res in out.items():
+                    self.assertEqual(res, redirect_edges_no_backflow(E, ranks, n, drop_self_loops=loops))
+                one = redirect_edges_no_backflow(E, ranks, np.int64(10), drop_self_loops=loops)
+                self.assertEqual(one, out[10])  # a numpy size is one size
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
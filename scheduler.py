@@ -0,0 +1,152 @@
+import unittest
+from time import sleep
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition, Thread
+from config import CF
+
+# A scheduler shared by concurrent runs: at most a given number of LLM calls
+# per backend are in flight at once, and when calls wait, the free slots go
+# round-robin to the runs (seeds) they come from, so a run making many calls
+# cannot starve the others.
+
+_seed: ContextVar[str] = ContextVar("seed", default="")
+
+
+@contextmanager
+def seed_name(name: str):
+    """Attribute the calls made from the current thread or task to the seed name."""
+    token = _seed.set(name)
+    try:
+        yield
+    finally:
+        _seed.reset(token)
+
+
+def current_seed() -> str:
+    """The seed the calls of the current thread or task are attributed to, "" outside of a batch."""
+    return _seed.get()
+
+
+class FairScheduler:
+    def __init__(self, limits: dict[str, int], default: int = 4):
+        self.limits = limits
+        self.default = default
+        self.cond = Condition()
+        self.active = defaultdict(int)  # backend -> calls in flight
+        self.queues = defaultdict(dict)  # backend -> seed -> deque of waiting tickets
+        self.ring = defaultdict(deque)  # backend -> seeds with waiting calls, next first
+        self.granted = set()
+        self.calls = defaultdict(int)  # seed -> calls let through
+
+    def limit(self, backend: str) -> int:
+        return max(1, self.limits.get(backend, self.default))
+
+    def acquire(self, backend: str, seed: str = ""):
+        ticket = object()
+        with self.cond:
+            queue = self.queues[backend].get(seed)
+            if queue is None:
+                queue = self.queues[backend][seed] = deque()
+                self.ring[backend].append(seed)
+            queue.append(ticket)
+            self.dispatch(backend)
+            while ticket not in self.granted:
+                self.cond.wait()
+            self.granted.remove(ticket)
+            self.calls[seed] += 1
+
+    def release(self, backend: str):
+        with self.cond:
+            self.active[backend] -= 1
+            self.dispatch(backend)
+
+    def dispatch(self, backend: str):
+        """Grant free slots to the waiting calls, one seed at a time in turn."""
+        ring, queues = self.ring[backend], self.queues[backend]
+        while ring and self.active[backend] < self.limit(backend):
+            seed = ring.popleft()
+            queue = queues[seed]
+            self.granted.add(queue.popleft())
+            self.active[backend] += 1
+            if queue:
+                ring.append(seed)
+            else:
+                del queues[seed]
+        self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, backend: str):
+        self.acquire(backend, _seed.get())
+        try:
+            yield
+        finally:
+            self.release(backend)
+
+
+_scheduler: FairScheduler | None = None
+
+
+def set_scheduler(scheduler: FairScheduler | None):
+    global _scheduler
+    _scheduler = scheduler
+
+
+@contextmanager
+def llm_slot(backend: str):
+    """Wait for a free slot of the backend if a scheduler is set, holding it while in the block."""
+    if _scheduler is None:
+        yield
+    else:
+        with _scheduler.slot(backend):
+            yield
+
+
+def new_scheduler() -> FairScheduler:
+    return FairScheduler(CF.LLM_CONCURRENCY, CF.MAX_CONNECTIONS)
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestFairScheduler(unittest.TestCase):
+    def test_limit_and_fairness(self):
+        sched = FairScheduler({"gpt": 2})
+        running, peak, order = [0], [0], []
+
+        def call(seed):
+            with seed_name(seed), sched.slot("gpt"):
+                with sched.cond:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                    order.append(seed)
+                sleep(0.01)
+                with sched.cond:
+                    running[0] -= 1
+
+        # seed a queues 10 calls before b queues its 2
+        sched.acquire("gpt", "x")
+        sched.acquire("gpt", "x")
+        ts = [Thread(target=call, args=("a",)) for _ in range(10)]
+        for t in ts:
+            t.start()
+        sleep(0.05)
+        ts += [Thread(target=call, args=("b",)) for _ in range(2)]
+        for t in ts[10:]:
+            t.start()
+        sleep(0.05)
+        sched.release("gpt")
+        sched.release("gpt")
+        for t in ts:
+            t.join()
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(sorted(order), ["a"] * 10 + ["b"] * 2)
+        self.assertLessEqual(max(i for i, s in enumerate(order) if s == "b"), 4)
+        self.assertEqual(sched.calls["a"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
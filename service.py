@@ -0,0 +1,311 @@
+import os
+import json
+import asyncio
+import unittest
+import tempfile
+from time import perf_counter
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qsl
+from config import CF
+from store import TripleStore
+
+# A local HTTP service answering concept-map queries on a knowledge base held
+# in memory: the edges of the runs in some directories (or files), with
+# their PageRank computed once on loading and the indexes of the TripleStore
+# serving the neighborhood and path queries.
+#
+#   GET /top?n=100                      the n best ranked edges
+#   GET /redirect?n=50                  the edges redirected to the n best nodes
+#   GET /neighborhood?node=x&k=2        the edges within k hops of node x
+#   GET /path?from=x&to=y               the edges of a shortest path from x to y
+#   GET /stats                          the size of the graph and of the cache
+#   GET /reload                         reload the graph now
+#
+# Add format=tsv or format=html (drawn by visualize_rels) for other than JSON.
+# Answers are kept in an LRU cache keyed by the query, emptied when the
+# graph is reloaded, which happens when the files of the runs change.
+
+
+class ConceptMap:
+    """The edges of the runs in paths, with their ranks, and the queries on them."""
+
+    def __init__(self, paths: list[str]):
+        from rank import node_ranks, rank_dict, triple_scores
+        from merge import run_prefixes, read_edges
+
+        self.paths = paths
+        self.files = run_files(paths)
+        self.store = TripleStore()
+        for _, fname in run_prefixes(paths):
+            self.store.update(e for e in read_edges(fname) if e is not None)
+        self.ranks = node_ranks(self.store)
+        self.rank_dict = rank_dict(self.store, self.ranks)
+        self.scores = triple_scores(self.store, self.ranks)
+
+    def top(self, n: int) -> list[tuple]:
+        from rank import top_rows
+
+        return [self.store.triple(r) for r in top_rows(self.scores, n)]
+
+    def redirect(self, n: int) -> list[tuple]:
+        from redir import redirect_edges_no_backflow
+
+        edges = redirect_edges_no_backflow(self.store, self.rank_dict, n)
+        return sorted(edges, key=lambda e: -(self.rank_dict[e[0]] + self.rank_dict[e[2]]))
+
+    def neighborhood(self, node: str, k: int = 1, limit: int = 0) -> list[tuple]:
+        """The edges within k hops of node either way, the best ranked limit of them (all if 0)."""
+        store = self.store
+        i = store.ids.get(node)
+        if i is None or not (store.count[0][i] or store.count[2][i]):
+            return []
+        seen, frontier, rows = {i}, [i], set()
+        for _ in range(k):
+            nxt = []
+            for j in frontier:
+                for kind, other in ((0, store.obj), (2, store.subj)):
+                    for r in store.rows(kind, j):
+                        rows.add(r)
+                        if other[r] not in seen:
+                            seen.add(other[r])
+                            nxt.append(other[r])
+            frontier = nxt
+        rows = sorted(rows, key=lambda r: (-self.scores[r], r))
+        return [store.triple(r) for r in (rows[:limit] if limit > 0 else rows)]
+
+    def path(self, start: str, end: str, max_len: int = 6) -> list[tuple]:
+        """The edges of a shortest path from start to end along the edges, at most max_len long."""
+        store = self.store
+        a, b = store.ids.get(start), store.ids.get(end)
+        if a is None or b is None:
+            return []
+        back = {a: None}  # node -> row reaching it
+        queue = deque([(a, 0)])
+        while queue:
+            j, d = queue.popleft()
+            if j == b:
+                break
+            if d == max_len:
+                continue
+            for r in store.rows(0, j):
+                o = store.obj[r]
+                if o not in back:
+                    back[o] = r
+                    queue.append((o, d + 1))
+        if b not in back:
+            return []
+        edges = []
+        while back[b] is not None:
+            r = back[b]
+            edges.append(store.triple(r))
+            b = store.subj[r]
+        return edges[::-1]
+
+    def stats(self) -> dict:
+        return {"runs": len(self.files), "edges": len(self.store), "nodes": len(self.rank_dict)}
+
+
+def run_files(paths: list[str]) -> dict[str, tuple[float, int]]:
+    """The files of the runs in paths, with their modification time and size."""
+    from merge import run_prefixes
+
+    files = {}
+    for _, fname in run_prefixes(paths):
+        st = os.stat(fname)
+        files[fname] = (st.st_mtime, st.st_size)
+    return files
+
+
+def render(edges: list[tuple], fmt: str) -> tuple[str, bytes]:
+    """The content type and body of edges as JSON, TSV or HTML."""
+    if fmt == "tsv":
+        return "text/tab-separated-values", "".join(f"{s}\t{v}\t{o}\n" for s, v, o in edges).encode()
+    if fmt == "html":
+        from vis import visualize_rels
+
+        with tempfile.TemporaryDirectory() as d:
+            _, hfile = visualize_rels(edges, os.path.join(d, "graph"), show=False, resources="in_line")
+            with open(hfile, "rb") as f:
+                return "text/html", f.read()
+    return "application/json", json.dumps({"edges": edges}).encode()
+
+
+class ConceptService:
+    """The HTTP service of a ConceptMap, reloading it when the files of the runs change."""
+
+    def __init__(self, paths: list[str], cache_size: int | None = None, poll: float | None = None):
+        if cache_size is None:
+            cache_size = CF.SERVICE_CACHE
+        if poll is None:
+            poll = CF.SERVICE_POLL
+        self.paths = paths
+        self.cache_size = cache_size
+        self.poll = poll
+        self.map: ConceptMap | None = None
+        self.cache: OrderedDict = OrderedDict()
+        self.hits = self.misses = 0
+        self.reloading: asyncio.Task | None = None
+
+    async def reload(self):
+        """Load the graph again in a thread, the old one answering queries meanwhile."""
+        t1 = perf_counter()
+        cmap = await asyncio.to_thread(ConceptMap, self.paths)
+        self.map = cmap
+        self.cache.clear()
+        print("Loaded %(edges)d edges of %(runs)d runs" % cmap.stats(), "in %.2fs" % (perf_counter() - t1))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.poll)
+            files = await asyncio.to_thread(run_files, self.paths)
+            if files != self.map.files:
+                await self.reload()
+
+    def query(self, cmap: ConceptMap, path: str, params: dict) -> tuple[str, bytes]:
+        if path == "/stats":
+            stats = {**cmap.stats(), "cached": len(self.cache), "hits": self.hits, "misses": self.misses}
+            return "application/json", json.dumps(stats).encode()
+        if path == "/top":
+            edges = cmap.top(int(params.get("n", CF.TOPN)))
+        elif path == "/redirect":
+            edges = cmap.redirect(int(params.get("n", CF.TOPN)))
+        elif path == "/neighborhood":
+            edges = cmap.neighborhood(params["node"], int(params.get("k", 1)), int(params.get("limit", 0)))
+        elif path == "/path":
+            edges = cmap.path(params["from"], params["to"], int(params.get("max", 6)))
+        else:
+            raise KeyError(path)
+        return render(edges, params.get("format", "json"))
+
+    async def answer(self, target: str) -> tuple[int, str, bytes]:
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        if url.path == "/reload":
+            await self.reload()
+            url = url._replace(path="/stats")
+        key = (url.path, tuple(sorted(params.items())))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return 200, *self.cache[key]
+        cmap = self.map
+        try:
+            ctype, body = await asyncio.to_thread(self.query, cmap, url.path, params)
+        except KeyError as e:
+            return 404 if e.args[0] == url.path else 400, "text/plain", f"missing: {e.args[0]}\n".encode()
+        except ValueError as e:
+            return 400, "text/plain", f"{e}\n".encode()
+        if url.path != "/stats" and cmap is self.map:  # not reloaded meanwhile
+            self.misses += 1
+            self.cache[key] = ctype, body
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return 200, ctype, body
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                close = False
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    close |= h.lower().strip() == b"connection: close"
+                if method != "GET":
+                    status, ctype, body = 405, "text/plain", b"only GET\n"
+                else:
+                    status, ctype, body = await self.answer(target)
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.Server:
+        """Load the graph and start serving it, and watching its files if poll > 0."""
+        await self.reload()
+        server = await asyncio.start_server(self.handle, host, port)
+        if self.poll > 0:
+            self.reloading = asyncio.create_task(self.watch())
+        return server
+
+
+async def serve(paths: list[str], port: int | None = None):
+    if port is None:
+        port = CF.SERVICE_PORT
+    service = ConceptService(paths)
+    server = await service.start(port=port)
+    print(f"Serving the concept map at http://127.0.0.1:{port}/top?n={CF.TOPN}")
+    async with server:
+        await server.serve_forever()
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+async def fetch(port: int, target: str) -> tuple[int, bytes]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+    data = await reader.read()
+    writer.close()
+    head, body = data.split(b"\r\n\r\n", 1)
+    return int(head.split()[1]), body
+
+
+class TestService(unittest.TestCase):
+    def test_queries_and_reload(self):
+        from synt import save_views
+
+        async def run(d):
+            service = ConceptService([d], poll=0)
+            server = await service.start()
+            port = server.sockets[0].getsockname()[1]
+            try:
+                status, body = await fetch(port, "/top?n=2")
+                self.assertEqual((status, len(json.loads(body)["edges"])), (200, 2))
+                await fetch(port, "/top?n=2")
+                status, body = await fetch(port, "/path?from=bbb&to=ddd&format=tsv")
+                self.assertEqual(body, b"bbb\tv\tccc\nccc\tw\tddd\n")
+                status, body = await fetch(port, "/top?n=2&format=html")
+                self.assertEqual(status, 200)
+                self.assertIn(b"vis-network", body)
+                _, body = await fetch(port, "/neighborhood?node=bbb&k=1")
+                self.assertEqual(len(json.loads(body)["edges"]), 2)
+                _, body = await fetch(port, "/neighborhood?node=zzz&k=2")
+                self.assertEqual(json.loads(body)["edges"], [])
+                _, body = await fetch(port, "/stats")
+                self.assertEqual(json.loads(body)["hits"], 1)
+                self.assertEqual((json.loads(body)["runs"], json.loads(body)["edges"]), (1, 4))  # no views
+                self.assertEqual((await fetch(port, "/path?from=aaa"))[0], 400)
+                self.assertEqual((await fetch(port, "/nothing"))[0], 404)
+
+                with open(os.path.join(d, "r2_kb.tsv"), "w") as f:
+                    f.write("ddd\tv\teee\n")
+                _, body = await fetch(port, "/reload")
+                self.assertEqual((json.loads(body)["runs"], json.loads(body)["edges"]), (2, 5))
+                _, body = await fetch(port, "/path?from=aaa&to=eee")
+                self.assertEqual(len(json.loads(body)["edges"]), 3)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "r1_kb.tsv"), "w") as f:
+                f.write("aaa\tv\tbbb\nbbb\tv\tccc\nccc\tw\tddd\naaa\tw\tccc\n")
+            save_views(os.path.join(d, "r1"), {2: [("aaa", "v", "zzz")], 3: [("aaa", "w", "zzz")]})
+            asyncio.run(run(d))
+
+
+if __name__ == "__main__":  # python service.py [<dir or file>...]
+    import sys
+
+    asyncio.run(serve(sys.argv[1:] or [CF.OUTDIR]))
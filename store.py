@@ -0,0 +1,230 @@
+from array import array
+from typing import Iterable, Iterator, Tuple, Dict, Set, Optional
+import unittest
+from threading import RLock
+
+Triple = Tuple[str, str, str]  # (subject, verb, object)
+
+SHIFT = 32  # ids are packed in one int key per triple
+
+
+class TripleStore:
+    """
+    A set of (subject, verb, object) triples with its strings interned to
+    integer ids. Triples are kept in three array columns, and the rows of
+    each subject, verb and object are indexed (SPO, POS and OSP) as triples
+    are added, so that adjacency and pattern lookups need no rebuilding.
+
+    Each index is a linked list threaded through the rows: the last row
+    of each id, the row before it with the same id, and so on, so that an
+    index costs a few bytes per triple and per string.
+
+    It can stand in for the plain set of string tuples: add, update,
+    len, in and iteration over the triples work the same way.
+    """
+
+    def __init__(self, triples: Iterable[Triple] = ()):
+        self.names: list[str] = []
+        self.ids: Dict[str, int] = {}
+        self.cols = (array("i"), array("i"), array("i"))  # subject, verb, object
+        self.last = (array("i"), array("i"), array("i"))  # last row per id, or -1
+        self.prev = (array("i"), array("i"), array("i"))  # previous row per row, or -1
+        self.count = (array("i"), array("i"), array("i"))  # rows per id
+        self.keys: Set[int] = set()
+        self.lock = RLock()  # for the threads of a run sharing the store, see synt.edges_lock
+        self.update(triples)
+
+    @property
+    def subj(self) -> array:
+        return self.cols[0]
+
+    @property
+    def verb(self) -> array:
+        return self.cols[1]
+
+    @property
+    def obj(self) -> array:
+        return self.cols[2]
+
+    def intern(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+            for k in range(3):
+                self.last[k].append(-1)
+                self.count[k].append(0)
+        return i
+
+    def add(self, triple: Triple) -> bool:
+        """Add a triple, returning True if it was not there yet."""
+        s, v, o = triple
+        ids = (self.intern(s), self.intern(v), self.intern(o))
+        key = (((ids[0] << SHIFT) | ids[1]) << SHIFT) | ids[2]
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        row = len(self.cols[0])
+        for k, i in enumerate(ids):
+            self.cols[k].append(i)
+            self.prev[k].append(self.last[k][i])
+            self.last[k][i] = row
+            self.count[k][i] += 1
+        return True
+
+    def update(self, triples: Iterable[Triple]):
+        for t in triples:
+            self.add(t)
+
+    def __len__(self) -> int:
+        return len(self.cols[0])
+
+    def __iter__(self) -> Iterator[Triple]:
+        names = self.names
+        for si, vi, oi in zip(*self.cols):
+            yield names[si], names[vi], names[oi]
+
+    def __contains__(self, triple) -> bool:
+        try:
+            s, v, o = triple
+        except (TypeError, ValueError):
+            return False
+        si, vi, oi = self.ids.get(s), self.ids.get(v), self.ids.get(o)
+        if si is None or vi is None or oi is None:
+            return False
+        return (((si << SHIFT) | vi) << SHIFT) | oi in self.keys
+
+    def __or__(self, triples: Iterable[Triple]) -> "TripleStore":
+        res = TripleStore(self)
+        res.update(triples)
+        return res
+
+    def triple(self, row: int) -> Triple:
+        names = self.names
+        return tuple(names[col[row]] for col in self.cols)
+
+    def rows(self, k: int, i: int) -> Iterator[int]:
+        """Rows with id i in column k (0: subject, 1: verb, 2: object), latest first."""
+        prev = self.prev[k]
+        row = self.last[k][i]
+        while row >= 0:
+            yield row
+            row = prev[row]
+
+    def node_ids(self) -> Set[int]:
+        """Ids of the strings used as subjects or objects."""
+        ns, no = self.count[0], self.count[2]
+        return {i for i in range(len(self.names)) if ns[i] or no[i]}
+
+    def nodes(self) -> Set[str]:
+        names = self.names
+        return {names[i] for i in self.node_ids()}
+
+    def succ_ids(self, i: int) -> Set[int]:
+        obj = self.cols[2]
+        return {obj[row] for row in self.rows(0, i)}
+
+    def pred_ids(self, i: int) -> Set[int]:
+        subj = self.cols[0]
+        return {subj[row] for row in self.rows(2, i)}
+
+    def succs(self, node: str) -> Set[str]:
+        i = self.ids.get(node)
+        if i is None:
+            return set()
+        names = self.names
+        return {names[j] for j in self.succ_ids(i)}
+
+    def preds(self, node: str) -> Set[str]:
+        i = self.ids.get(node)
+        if i is None:
+            return set()
+        names = self.names
+        return {names[j] for j in self.pred_ids(i)}
+
+    def pair_counts(self) -> Dict[Tuple[int, int], int]:
+        """Number of distinct verbs linking each (subject, object) pair of ids."""
+        counts: Dict[Tuple[int, int], int] = {}
+        for so in zip(self.cols[0], self.cols[2]):
+            counts[so] = counts.get(so, 0) + 1
+        return counts
+
+    def match_rows(
+        self, s: Optional[str] = None, v: Optional[str] = None, o: Optional[str] = None
+    ) -> Iterable[int]:
+        """Rows of the triples matching a pattern, None being a wildcard,
+        scanning the smallest of the indexes that apply."""
+        bound = []
+        for k, x in enumerate((s, v, o)):
+            if x is None:
+                continue
+            i = self.ids.get(x)
+            if i is None or not self.count[k][i]:
+                return ()
+            bound.append((self.count[k][i], k, i))
+        if not bound:
+            return range(len(self))
+        bound.sort()
+        _, k, i = bound[0]
+        checks = [(self.cols[k1], i1) for _, k1, i1 in bound[1:]]
+        return [r for r in self.rows(k, i) if all(col[r] == i1 for col, i1 in checks)]
+
+    def match(
+        self, s: Optional[str] = None, v: Optional[str] = None, o: Optional[str] = None
+    ) -> Iterator[Triple]:
+        for row in self.match_rows(s, v, o):
+            yield self.triple(row)
+
+
+def as_store(triples: Iterable[Triple]) -> TripleStore:
+    """Return triples as a TripleStore, building one only if needed."""
+    if isinstance(triples, TripleStore):
+        return triples
+    return TripleStore(triples)
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestTripleStore(unittest.TestCase):
+    def setUp(self):
+        self.triples = {
+            ("a", "likes", "b"),
+            ("a", "knows", "b"),
+            ("a", "likes", "c"),
+            ("b", "likes", "c"),
+            ("c", "is", "a"),
+        }
+        self.store = TripleStore(self.triples)
+
+    def test_set_like(self):
+        self.store.add(("a", "likes", "b"))
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(set(self.store), self.triples)
+        self.assertIn(("c", "is", "a"), self.store)
+        self.assertNotIn(("c", "is", "b"), self.store)
+        self.assertNotIn(("x", "is", "a"), self.store)
+        both = self.store | {("d", "is", "a")}
+        self.assertEqual(len(both), 6)
+        self.assertEqual(len(self.store), 5)
+
+    def test_indexes(self):
+        st = self.store
+        self.assertEqual(st.nodes(), {"a", "b", "c"})
+        self.assertEqual(st.succs("a"), {"b", "c"})
+        self.assertEqual(st.preds("c"), {"a", "b"})
+        self.assertEqual(st.preds("x"), set())
+        ids = st.ids
+        self.assertEqual(st.pair_counts()[(ids["a"], ids["b"])], 2)
+        self.assertEqual(set(st.match(v="likes")), {t for t in self.triples if t[1] == "likes"})
+        self.assertEqual(set(st.match("a", "likes")), {("a", "likes", "b"), ("a", "likes", "c")})
+        self.assertEqual(set(st.match(o="a")), {("c", "is", "a")})
+        self.assertEqual(list(st.match("a", "is")), [])
+        self.assertEqual(set(st.match()), self.triples)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
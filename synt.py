@@ -3,16 +3,29 @@ import os
 
 import re
 import json
+import numbers
+import unittest
 from collections import defaultdict
-import networkx as nx
-from senstore.segmenter import segment_text
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock, RLock
 from config import CF
-from chatbot import ask
+from chatbot import ask, ask_stream, show_timing
+from cache import show_stats
+from ratelimit import show_limits
+from scheduler import current_seed
+from metrics import prompter_name, note_edges, start_run, end_run, save_metrics, show_metrics
 from redir import redirect_edges_no_backflow
+from store import TripleStore, as_store
+from terms import uniform_str, to_edge, parse_edge, good_noun, parse_facts
+from questions import QuestIndex, saturated
+from goals import answer_goal, note_goal, show_goal_stats, format_answer
+from journal import Journal, step_record, replay
+from rank import node_ranks, rank_dict, triple_scores, top_rows, IncrementalRanker
 
-
-from vis import visualize_rels
-from natlog.prolog_parser import parse_prolog_clause, parse_goal, VarNum
+# segmenting, Prolog parsing, inference, concept merging and drawing are
+# imported where used, so that importing synt (as the tools in cli.py do)
+# stays fast
 
 
 def fact_prompter(quest: str) -> str:
@@ -99,6 +112,44 @@ Please return just the question, without any additional text or explanation!
 """.strip()
 
 
+def other_quest_prompter(sum: str, quest0, asked: list[str]) -> str:
+    asked = "\n".join(asked)
+    return f"""
+The topic I have started thinking about is {quest0}.
+
+Here is a summary about the thoughts I am interested to explore in depth:
+
+{sum}
+
+I have already asked these questions:
+
+{asked}
+
+What short, salient question should I ask about it, that is about something else than
+all of them? Please make sure it is not a rephrasing of any of them! Also, try to make
+the question focus on a single topic, not a conjunction of multiple questions!
+
+Please return just the question, without any additional text or explanation!
+""".strip()
+
+
+def next_quests_prompter(sum: str, quest0, k: int) -> str:
+    return f"""
+The topic I have started thinking about is {quest0}.
+
+Here is a summary about the thoughts I am interested to explore in depth:
+
+{sum}
+
+What {k} short, salient and different questions should I ask about it? Please make sure
+they are genuine follow-up questions, not rephrasings of the previous one or of each other!
+Also, try to make each question focus on a single topic, not a conjunction of multiple questions!
+
+Also, to be clear, I want to focus on the contents of the summary, not on meta-questions about it!
+Please return just the questions, one per line, without any additional text or explanation!
+""".strip()
+
+
 def gen_prompter(nouns: str, context: str) -> str:
     return f"""
 I will send you a set of Prolog nouns separated by semicolons (;)
@@ -136,6 +187,16 @@ Please make sure your answers are syntactically correct Prolog terms!
 """.strip()
 
 
+def parse_questions(answer: str, k: int) -> list[str]:
+    """Extract up to k questions, one per line, from an LLM answer."""
+    quests = []
+    for line in answer.split("\n"):
+        q = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip().strip('"')
+        if q:
+            quests.append(q)
+    return quests[:k]
+
+
 def get_llm_name():
     if CF.USE_OLLAMA:
         return "ollama"
@@ -143,23 +204,11 @@ def get_llm_name():
         return "gpt"
 
 
-def camel_to_snake(s: str) -> str:
-    s = s.strip()
-    s = re.sub(r"[\s\-]+", "_", s)  # spaces/dashes -> underscore
-    s = re.sub(
-        r"([A-Z]+)([A-Z][a-z])", r"\1_\2", s
-    )  # split XMLHTTPRequest -> XML_HTTPRequest
-    s = re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", s)  # split fooBar -> foo_Bar
-    s = re.sub(r"([A-Za-z])([0-9])", r"\1_\2", s)  # letters->digits boundary
-    s = re.sub(r"([0-9])([A-Za-z])", r"\1_\2", s)  # digits->letters boundary
-    return s.lower()
-
-
 def onto_name(out_dir: str, quest: str) -> str:
-    """Create a file name based on the question."""
-    return (
-        "out/"
-        + get_llm_name()
+    """Create a file name in out_dir based on the question."""
+    return os.path.join(
+        out_dir,
+        get_llm_name()
         + "_"
         + "_".join(quest.lower().split()).replace('"', "").replace("?", "")[:60]
     )
@@ -179,74 +228,119 @@ def store_kb(ddict: defaultdict, out_dir: str, quest: str):
 def step_with(prompter, *args) -> tuple[str, float]:
     """Create a prompt with the prompter and ask the LLM, returning the answer and cost."""
     prompt = prompter(*args)
-    answer, cost = ask(prompt)
+    with prompter_name(prompter.__name__):
+        answer, cost = ask(prompt)
     return answer, cost
 
 
-def uniform_str(s: str) -> str:
-    """Convert a string to a uniform format for comparison."""
-    s = s.strip().replace(" ", "_").replace("-", "_").replace("'", "")
-    s = s.replace("+", "_and_").replace("/", "_or_")
-    s = s.replace('"', "").replace("`", "")
-    s = camel_to_snake(s)
-    return s
-
-
-def to_edge(f: str) -> tuple[str, str, str] | None:
-    """Convert a Prolog fact string to an edge tuple, or return None if malformed."""
-    if not f:
-        return None
-    try:
-        clause = parse_prolog_clause(f)
-        if not clause:
-            print("WARNING: ignoring unexpected clause:", f, "-->", clause)
-            return None
-        edge = clause[0][0][1:]  # (pred, (s,v,o))
-        if len(edge) != 3:
-            print("WARNING: tuple of length 3 expected:", f, "-->", edge)
-            return None
-
-        for x in edge:
-            if isinstance(x, VarNum):
-                print("WARNING: ignoring fact with variable:", f, "-->", edge)
-                return None
-
-        # return edge
-        s, v, o = edge
-        if not good_noun(s) or not good_noun(o):
-            print("WARNING: ignoring fact with bad noun:", f, "-->", edge)
-            return None
-        return (uniform_str(s), uniform_str(v), uniform_str(o))
-    except Exception as e:
-        print("WARNING: ignoring unparsable fact:", f, "Error:", e)
-        return None
-
-
-def onto_step(
-    quest0: str, quest: str, ddict: defaultdict, edges: set
-) -> tuple[str, float]:
-    """Perform one step of the ontology building process."""
-    t1 = time()
-    facts, c1 = step_with(fact_prompter, quest)
-    sum, c2 = step_with(sum_prompter, facts)
-    new_quest, c3 = step_with(next_quest_prompter, sum, quest0)
-    goal, c4 = step_with(query_prompter, quest, facts)
-
-    facts = facts.split("\n")
+_edges_lock = RLock()  # guards the plain sets of edges; a TripleStore has its own lock
+
+
+def edges_lock(edges):
+    """The lock guarding edges, read and added to by the steps run or prefetched on other threads."""
+    return getattr(edges, "lock", _edges_lock)
+
+
+def stream_facts(quest: str, edges=None, max_edges=None) -> tuple[str, str, list[tuple], float]:
+    """
+    Ask for the facts answering quest, adding the edge of each line to
+    edges (if not None) as soon as it has streamed in. The answer is
+    cancelled once max_edges facts have been parsed (no limit if 0).
+    Return the lines received, the well-formed facts, their edges and the cost.
+    """
+    if max_edges is None:
+        max_edges = CF.MAX_STEP_EDGES
+    with prompter_name(fact_prompter.__name__):
+        answer = ask_stream(fact_prompter(quest))
+        lines, clean_facts, step_edges = [], [], []
+        for f in answer:
+            lines.append(f)
+            fs, es = parse_facts([f])
+            if es and edges is not None:
+                with edges_lock(edges):
+                    edges.update(es)
+            clean_facts += fs
+            step_edges += es
+            if max_edges and len(clean_facts) >= max_edges:
+                print("Edge cap reached, cancelling the facts of:", quest)
+                answer.close()
+                break
+    return "\n".join(lines), "\n".join(clean_facts), step_edges, answer.cost
+
+
+def get_facts(quest: str, edges=None) -> tuple[str, str, list[tuple], float]:
+    """
+    Ask for the facts answering quest, streaming them in if CF.STREAM_FACTS
+    is set, and add their edges to edges (if not None). Return the answer
+    as given, its well-formed facts, their edges and the cost.
+    """
+    if CF.STREAM_FACTS:
+        answer, facts, step_edges, cost = stream_facts(quest, edges)
+    else:
+        answer, cost = step_with(fact_prompter, quest)
+        clean_facts, step_edges = parse_facts(answer.split("\n"))
+        facts = "\n".join(clean_facts)
+        if edges is not None:
+            with edges_lock(edges):
+                edges.update(step_edges)
+    note_edges(len(step_edges))
+    return answer, facts, step_edges, cost
+
+
+def step_facts(quest: str, edges, add: bool = True) -> tuple[str, str, list[tuple], str | None, float]:
+    """
+    The fact answer to quest as given, its well-formed facts, their edges,
+    its query goal if it was asked for already (None otherwise) and the
+    cost. With add, the
+    edges are added to edges as they come in, line by line when streamed.
+    With CF.LOCAL_ANSWERS, the goal is asked for first and, when at least
+    CF.LOCAL_MIN_FACTS edges of the graph answer it, these edges are the
+    facts, with no fact call.
+    """
+    sink = edges if add else None
+    if not CF.LOCAL_ANSWERS:
+        answer, facts, step_edges, cost = get_facts(quest, sink)
+        return answer, facts, step_edges, None, cost
+    goal, cost = step_with(query_prompter, quest, "")
+    with edges_lock(edges):
+        answers, support = answer_goal(edges, goal.replace('"', ""))
+    local = len(support) >= CF.LOCAL_MIN_FACTS
+    note_goal(bool(answers), local)
+    if local:
+        print(f"ANSWERED from the graph with {len(support)} edges:", quest)
+        facts = "\n".join(f"fact('{s}','{v}','{o}')." for s, v, o in support)
+        return facts, facts, list(support), goal, cost
+    answer, facts, step_edges, c1 = get_facts(quest, sink)
+    return answer, facts, step_edges, goal, cost + c1
+
+
+def record_step(
+    quest: str,
+    facts: str,
+    sum: str,
+    new_quest: str | list[str],
+    goal: str,
+    ddict: defaultdict,
+    edges: set,
+    cost: float,
+    t1: float,
+):
+    """
+    Add the answers of one step to ddict and report them. The edges of its
+    facts are already in edges, added by the step.
+    """
+    from senstore.segmenter import segment_text
+
+    facts = facts.split("\n") if facts else []
     goal = goal.strip().replace('"', "").split("\n")
-
-    clean_facts = []
-    for f in facts:
-        edge = to_edge(f)
-        if edge is not None:
-            edges.add(edge)
-            clean_facts.append(f)
-    facts = clean_facts
+    with edges_lock(edges):
+        answers = [format_answer(a) for a in answer_goal(edges, "\n".join(goal))[0]]
 
     sum = segment_text(sum)
 
     print("\nQUESTION:\n", quest)
     print("\nQUEST AS A GOAL:\n", goal)
+    print("\nGOAL ANSWERS:\n", answers)
     print("\nFACTS:\n", facts)
     print("\nSUMMARY:\n", sum)
     print("\nNEXT QUESTION:\n", new_quest)
@@ -254,67 +348,214 @@ def onto_step(
     ddict[quest].append(
         {
             "QUERY_GOAL": goal,
+            "GOAL_ANSWERS": answers,
             "ANSWER_FACTS": facts,
             "ANSWER_SUMMARY": sum,
             "NEXT_QUESTION": new_quest,
         }
     )
 
-    cost = c1 + c2 + c3 + c4
-
+    with edges_lock(edges):
+        svos = list(edges)
     print("\nEDGES:")
-    for svo in edges:
+    for svo in svos:
         print("\t len=", len(svo), svo)
 
     print("\nCost: $%.8f" % cost, "time:", time() - t1)
 
-    return new_quest, cost
-
-
-def good_noun(s: str) -> bool:
-    """Check if a string is a good noun for generalization."""
-
-    if not s:
-        return False
-    s = s.strip()
-    if len(s) < 3:
-        return False
-    if len(s) > 42:
-        return False
-    if s.lower() in {
-        "this",
-        "that",
-        "these",
-        "those",
-        "you",
-        "we",
-        "she",
-        "they",
-        "them",
-        "what",
-        "which",
-        "who",
-        "whom",
-        "where",
-        "when",
-        "why",
-        "how",
-    }:
-        return False
-    return True
-
-
-def gen_step(edges, context: str) -> tuple[set, float]:
-    """Generate generalizations for a set of nouns in a given context."""
-
-    nouns = ";".join(
-        set(s for (s, _, _) in edges if isinstance(s, str) and good_noun(s))
-    )
 
-    gens, cost = step_with(gen_prompter, nouns, context)
-    gens = gens.split("\n")
-    gens = [to_edge(f) for f in gens]
+def next_quest(quest0: str, sum: str, edges, index: QuestIndex | None) -> tuple[str, float]:
+    """
+    Ask for the next question. While it is a near duplicate of a question
+    in index, ask again, up to CF.QUEST_RETRIES times, then reroute to a
+    question about the best connected concept not asked about yet.
+    The question is added to index.
+    """
+    quest, cost = step_with(next_quest_prompter, sum, quest0)
+    if index is None:
+        return quest, cost
+    old = index.similar(quest)
+    for _ in range(CF.QUEST_RETRIES):
+        if old is None:
+            break
+        print("REPEATED question:", quest, "\n\tlike:", old)
+        asked = list(dict.fromkeys([old, quest] + index.quests[-4:]))
+        quest, c = step_with(other_quest_prompter, sum, quest0, asked)
+        cost += c
+        old = index.similar(quest)
+    if old is not None:
+        rerouted = reroute_quest(quest0, edges, index)
+        if rerouted is not None:
+            print("REROUTED question:", quest, "\n\tto:", rerouted)
+            quest = rerouted
+    index.add(quest)
+    return quest, cost
+
+
+def reroute_quest(quest0: str, edges, index: QuestIndex, tries: int = 50) -> str | None:
+    """A question about one of the best connected concepts of edges unlike those in index, if any."""
+    with edges_lock(edges):
+        store = as_store(edges)
+        ids = sorted(store.node_ids(), key=lambda i: -(store.count[0][i] + store.count[2][i]))
+        concepts = [store.names[i] for i in ids[:tries]]
+    for c in concepts:
+        quest = f"What should one know about {c.replace('_', ' ')}?"
+        if index.similar(quest) is None:
+            return quest
+    return None
+
+
+def onto_step(
+    quest0: str, quest: str, ddict: defaultdict, edges: set, index: QuestIndex | None = None
+) -> tuple[str, str, float]:
+    """
+    Perform one step of the ontology building process, returning the next
+    question, the fact answer and the cost.
+    """
+    t1 = time()
+    answer, facts, _, goal, c1 = step_facts(quest, edges)
+    sum, c2 = step_with(sum_prompter, facts)
+    new_quest, c3 = next_quest(quest0, sum, edges, index)
+    c4 = 0.0
+    if goal is None:
+        goal, c4 = step_with(query_prompter, quest, facts)
+
+    cost = c1 + c2 + c3 + c4
+    record_step(quest, facts, sum, new_quest, goal, ddict, edges, cost, t1)
+    return new_quest, answer, cost
+
+
+def onto_steps(
+    quest0: str, n: int, ddict: defaultdict, edges: set, quest=None, done: int = 0, index=None
+):
+    """
+    Run n steps one after the other, from quest (quest0 if None) after done
+    steps, yielding the next question, the fact answer and the cost of
+    each. Next questions repeating one in index are replaced (see next_quest).
+    """
+    if quest is None:
+        quest = quest0
+    for i in range(done, done + n):
+        print(f"\n\n=== STEP {i+1} ===")
+        quest, answer, cost = onto_step(quest0, quest, ddict, edges, index)
+        yield quest, answer, cost
+
+
+def submit(pool: ThreadPoolExecutor, fn, *args):
+    """Submit fn(*args) to the pool, run in a copy of the current context (run, seed)."""
+    return pool.submit(copy_context().run, fn, *args)
+
+
+def onto_steps_parallel(
+    quest0: str, n: int, ddict: defaultdict, edges: set, quest=None, done: int = 0, index=None
+):
+    """
+    Run n steps with independent LLM calls overlapped on a thread pool,
+    from quest (quest0 if None) after done steps, yielding the next
+    question, the fact answer and the cost of each step.
+
+    The summary and the query goal only depend on the facts, so they run
+    together. The facts of step i+1 are requested as soon as the next
+    question is known, while the query goal of step i is still in flight.
+    The edges of step i are added before the facts of step i+1 are asked
+    for, so that these are answered from the same graph as in onto_steps.
+    The prefetched facts are kept out of the graph until their step starts,
+    so that the goal answers of step i do not see those of step i+1.
+    The calls made, and hence the cost, are the same as in onto_steps,
+    except for the facts of a next question prefetched when the caller
+    stops early.
+    """
+    if quest is None:
+        quest = quest0
+    if n <= 0:  # nothing left to do, as when resuming a finished run
+        return
+    with ThreadPoolExecutor(max_workers=max(2, CF.MAX_WORKERS)) as pool:
+        facts_job = submit(pool, step_facts, quest, edges, False)
+        for i in range(n):
+            t1 = time()
+            answer, facts, step_edges, goal, c1 = facts_job.result()
+            with edges_lock(edges):  # before the next facts are asked for, as in onto_steps
+                edges.update(step_edges)
+            goal_job = None if goal is not None else submit(pool, step_with, query_prompter, quest, facts)
+            sum, c2 = step_with(sum_prompter, facts)
+            new_quest, c3 = next_quest(quest0, sum, edges, index)
+            if i + 1 < n:
+                facts_job = submit(pool, step_facts, new_quest, edges, False)
+            goal, c4 = goal_job.result() if goal_job is not None else (goal, 0.0)
+
+            print(f"\n\n=== STEP {done+i+1} ===")
+            cost = c1 + c2 + c3 + c4
+            record_step(quest, facts, sum, new_quest, goal, ddict, edges, cost, t1)
+            yield new_quest, answer, cost
+            quest = new_quest
+
+
+def gen_nouns(edges) -> set:
+    """The subjects of edges worth generalizing."""
+    with edges_lock(edges):
+        return set(s for (s, _, _) in edges if isinstance(s, str) and good_noun(s))
+
+
+def gen_shard(nouns: list[str], context: str) -> tuple[set, float]:
+    """Generalize one shard of nouns with one LLM call."""
+    gens, cost = step_with(gen_prompter, ";".join(nouns), context)
+    gens = [to_edge(f) for f in gens.split("\n")]
     gens = set(f for f in gens if f is not None)
+    note_edges(len(gens))
+    return gens, cost
+
+
+class Generalizer:
+    """
+    Generalizes the nouns of a run in shards of CF.GEN_BATCH nouns (all in
+    one if 0), run in parallel on a pool of CF.MAX_WORKERS threads. feed
+    submits the full shards of the nouns not seen before, so that it can
+    be called after each step of a loop, and finish submits the remaining
+    nouns and merges the generalizations of all shards.
+    """
+
+    def __init__(self, context: str):
+        self.context = context
+        self.pool = ThreadPoolExecutor(max_workers=CF.MAX_WORKERS)
+        self.seen = set()
+        self.pending = []
+        self.jobs = []
+
+    def feed(self, edges, final: bool = False):
+        new = sorted(gen_nouns(edges) - self.seen)  # sorted, so that shards hit the cache on reruns
+        self.seen.update(new)
+        self.pending += new
+        size = CF.GEN_BATCH
+        if size <= 0:
+            if not final:
+                return
+            size = len(self.pending)
+        while self.pending and (final or len(self.pending) >= size):
+            shard, self.pending = self.pending[:size], self.pending[size:]
+            self.jobs.append(submit(self.pool, gen_shard, shard, self.context))
+
+    def finish(self, edges) -> tuple[set, float]:
+        try:
+            self.feed(edges, final=True)
+            gens, cost = set(), 0.0
+            for job in self.jobs:
+                g, c = job.result()
+                gens |= g
+                cost += c
+        finally:
+            self.pool.shutdown()
+        print(f"\nGENERALIZED {len(self.seen)} nouns in {len(self.jobs)} shards")
+        return gens, cost
+
+
+def gen_step(edges, context: str, gen: Generalizer | None = None) -> tuple[set, float]:
+    """
+    Generate generalizations for the nouns of edges in a given context,
+    finishing gen if given, which may have generalized some of them already.
+    """
+    if gen is None:
+        gen = Generalizer(context)
+    gens, cost = gen.finish(edges)
 
     print("\nGENERALIZATION EDGES:")
     for g in gens:
@@ -325,45 +566,239 @@ def gen_step(edges, context: str) -> tuple[set, float]:
     return gens, cost
 
 
-def onto_loop(quest0: str, n: int = 4, out_dir=None) -> tuple[str, defaultdict, float]:
-    """Run the ontology building loop for n steps starting from quest0."""
+def onto_loop(
+    quest0: str, n: int = 4, out_dir=None, parallel=None, resume=None
+) -> tuple[str, defaultdict, float]:
+    """
+    Run the ontology building loop for n steps starting from quest0.
+    Each step is appended to the _journal.jsonl file of the run. With
+    resume, the steps already in the journal are replayed, with no LLM
+    calls, and the loop goes on from the last complete one.
+    Next questions repeating an earlier one are replaced, and the loop
+    stops early once CF.SATURATION_STEPS steps in a row each added fewer
+    than CF.MIN_YIELD new edges.
+    """
     if out_dir is None:
         out_dir=CF.OUTDIR
+    if parallel is None:
+        parallel = CF.PARALLEL
+    if resume is None:
+        resume = CF.RESUME
     CF.show()
-    quest = quest0
+    fname = onto_name(out_dir, quest0)
+    start_run(fname)
     ddict = defaultdict(list)
-    edges = set()
-    total_cost = 0
+    edges = TripleStore()
+    journal = Journal(fname + "_journal.jsonl", resume=resume)
+    replay(journal.records, ddict, edges)
+    done = len(journal.records)
+    quest = journal.records[-1]["next"] if done else quest0
+    total_cost = sum(r["cost"] for r in journal.records)
+    if done:
+        print(f"Resuming after step {done} of {journal.fname}, with {len(edges)} edges")
+    index = QuestIndex()
+    for q in [quest0] + [r["next"] for r in journal.records]:
+        index.add(q)
     t1 = time()
-    for i in range(n):
-        print(f"\n\n=== STEP {i+1} ===")
-        quest, cost = onto_step(
-            quest0, quest, ddict, edges
-        )  # quest to edges + goal !!!!
-        total_cost += cost
-        store_kb(ddict, out_dir, quest0)  # could be moved outside the loop
+    if parallel:
+        steps = onto_steps_parallel(quest0, n - done, ddict, edges, quest, done, index)
+    else:
+        steps = onto_steps(quest0, n - done, ddict, edges, quest, done, index)
+    ranker = IncrementalRanker(edges)
+    gen = Generalizer(quest0) if CF.GEN_INCREMENTAL else None
+    yields, n_edges = [], len(edges)
+    with journal:
+        for i, (new_quest, answer, cost) in enumerate(steps, done + 1):  # quest to edges + goal !!!!
+            total_cost += cost
+            item = ddict[quest][-1]
+            journal.append(step_record(i, quest, item, answer, cost))
+            rank_step(ranker, i, fname)
+            if gen is not None:
+                gen.feed(edges)
+            quest = new_quest
+            yields.append(len(edges) - n_edges)
+            n_edges = len(edges)
+            if saturated(yields):
+                print(f"\nSATURATED: the last {CF.SATURATION_STEPS} steps added {yields[-CF.SATURATION_STEPS:]} new edges")
+                steps.close()
+                break
+
+    total_cost += finish_loop(quest0, ddict, edges, out_dir, gen)
+    print("\nTOTAL Cost: $%.8f" % total_cost, "total time:", time() - t1)
+    if not current_seed():  # in a batch, the totals are shown once for all seeds
+        show_totals()
+    show_metrics()
+    save_metrics(fname)
+    end_run(fname)
+    return quest, ddict, total_cost
 
-    gens, c5 = gen_step(edges, quest0)  # from nouns to generalizations !!!!
-    edges = edges | gens
 
-    print("\nTOTAL EDGES:", len(edges))
+def show_totals():
+    """Print the process-wide counters: response cache, goals, call timing and rate limits."""
+    show_stats()
+    show_goal_stats()
+    show_timing()
+    show_limits()
+
+
+def rank_step(ranker: IncrementalRanker, step: int, fname: str):
+    """
+    Update the ranks with the edges added by a step and report the top
+    CF.STEP_TOPN edges, also appending them to the _steps.tsv file.
+    """
+    topn = CF.STEP_TOPN
+    if topn <= 0:
+        return
+    with edges_lock(ranker.store):
+        ranker.update()
+        top = ranker.top(topn)
+
+    print(f"\nTOP {topn} EDGES AFTER STEP {step}:")
+    for svo in top:
+        print("\t", svo)
+
+    sname = fname + "_steps.tsv"
+    with open(sname, "w" if step == 1 else "a") as f:
+        for s, v, o in top:
+            f.write(f"{step}\t{s}\t{v}\t{o}\n")
+
+
+def finish_loop(
+    quest0: str, ddict: defaultdict, edges: set, out_dir: str, gen: Generalizer | None = None
+) -> float:
+    """
+    Generalize, save, rank and visualize the edges of a run, returning the
+    cost. gen holds the generalizations already started during the run.
+    """
+    from infer import save_inferred
+    from concepts import merge_concepts, save_aliases
+    from vis import visualize_rels
 
     fname = onto_name(out_dir, quest0)
 
+    aliases = {}
+    if CF.MERGE_CONCEPTS:
+        merged, aliases = merge_concepts(edges)
+        edges = set(merged)
+        save_aliases(fname, aliases)
+
+    gens, c5 = gen_step(edges, quest0, gen)  # from nouns to generalizations !!!!
+    edges.update((aliases.get(s, s), v, aliases.get(o, o)) for s, v, o in gens)
+
+    print("\nTOTAL EDGES:", len(edges))
+
+    store_kb(ddict, out_dir, quest0)
     save_files(
         fname, quest0, ddict, edges
     )  # Save the knowledge base, summary, and Prolog facts !!!
 
-    edges = rank_svos(edges, CF.TOPN)  # Rank and filter the edges to keep the top N !!!
-    _, vname = visualize_rels(edges, fname + "_graph", show=True)  # Visualize  !!!
+    if CF.INFER:
+        save_inferred(fname, edges)
+
+    if CF.VIEW_SIZES:  # all the views from one ranking
+        views = rank_svos(edges, sorted({CF.TOPN, *CF.VIEW_SIZES}))
+        save_views(fname, {n: views[n] for n in CF.VIEW_SIZES})
+        edges = views[CF.TOPN]
+    else:
+        edges = rank_svos(edges, CF.TOPN)  # Rank and filter the edges to keep the top N !!!
+    _, vname = visualize_rels(edges, fname + "_graph", show=CF.SHOW_GRAPH)  # Visualize  !!!
 
     print(f"\nKnowledge graph shown in {vname}")
 
     CF.show()
+    return c5
+
+
+def tree_step(
+    quest0: str, quest: str, ddict: defaultdict, edges: set, lock: Lock, k: int
+) -> tuple[list[str], str, float]:
+    """
+    Perform one step of the tree expansion, returning up to k follow-up
+    questions, the fact answer and the cost.
+    With k = 0 (the last level) no follow-up questions are requested.
+    """
+    t1 = time()
+    answer, facts, _, goal, c1 = step_facts(quest, edges)
+    sum, c2 = step_with(sum_prompter, facts)
+    new_quests, c3 = [], 0.0
+    if k > 0:
+        quests, c3 = step_with(next_quests_prompter, sum, quest0, k)
+        new_quests = parse_questions(quests, k)
+    c4 = 0.0
+    if goal is None:
+        goal, c4 = step_with(query_prompter, quest, facts)
 
-    total_cost += c5
+    cost = c1 + c2 + c3 + c4
+    with lock:
+        record_step(quest, facts, sum, new_quests, goal, ddict, edges, cost, t1)
+    return new_quests, answer, cost
+
+
+def onto_tree(
+    quest0: str, k: int | None = None, max_depth: int | None = None, out_dir=None
+) -> tuple[defaultdict, float]:
+    """
+    Expand the concept tree rooted in quest0 breadth-first, asking for k
+    follow-up questions at each step, up to max_depth levels. The questions
+    of a level run concurrently on a pool of CF.MAX_WORKERS threads, all
+    adding to the same edges and ddict. Follow-up questions that are near
+    duplicates of a question already asked or queued are pruned.
+    """
+    if k is None:
+        k = CF.TOP_K
+    if max_depth is None:
+        max_depth = CF.MAX_DEPTH
+    if out_dir is None:
+        out_dir = CF.OUTDIR
+    CF.show()
+    start_run(onto_name(out_dir, quest0))
+    ddict = defaultdict(list)
+    edges = TripleStore()
+    lock = Lock()
+    ranker = IncrementalRanker(edges)
+    index = QuestIndex()
+    index.add(quest0)
+    gen = Generalizer(quest0) if CF.GEN_INCREMENTAL else None
+    frontier = [quest0]
+    total_cost = 0
+    steps = 0
+    t1 = time()
+    journal = Journal(onto_name(out_dir, quest0) + "_journal.jsonl")
+    with journal, ThreadPoolExecutor(max_workers=CF.MAX_WORKERS) as pool:
+        for depth in range(max_depth):
+            if not frontier:
+                break
+            print(f"\n\n=== LEVEL {depth+1}: {len(frontier)} questions ===")
+            last = depth + 1 == max_depth
+            jobs = [
+                submit(pool, tree_step, quest0, q, ddict, edges, lock, 0 if last else k)
+                for q in frontier
+            ]
+            asked, frontier = frontier, []
+            for quest, job in zip(asked, jobs):
+                new_quests, answer, cost = job.result()
+                total_cost += cost
+                steps += 1
+                item = ddict[quest][-1]
+                journal.append(step_record(steps, quest, item, answer, cost))
+                for q in new_quests:
+                    if index.similar(q) is not None:
+                        print("PRUNED near duplicate question:", q)
+                        continue
+                    index.add(q)
+                    frontier.append(q)
+            rank_step(ranker, depth + 1, onto_name(out_dir, quest0))
+            if gen is not None:
+                gen.feed(edges)
+
+    total_cost += finish_loop(quest0, ddict, edges, out_dir, gen)
     print("\nTOTAL Cost: $%.8f" % total_cost, "total time:", time() - t1)
-    return quest, ddict, total_cost
+    if not current_seed():  # in a batch, the totals are shown once for all seeds
+        show_totals()
+    show_metrics()
+    save_metrics(onto_name(out_dir, quest0))
+    end_run(onto_name(out_dir, quest0))
+    return ddict, total_cost
 
 
 def save_files(fname: str, quest0: str, ddict: dict, edges: set):
@@ -399,28 +834,143 @@ def save_files(fname: str, quest0: str, ddict: dict, edges: set):
 
 
 def rank_svos(svos, topn, redirect=None):
+    """
+    The top edges by PageRank, redirected to the topn best nodes if redirect.
+    Given a list of sizes as topn, the views of each size by size, all from
+    one PageRank and one redirection pass.
+    """
     if redirect is None:
         redirect=CF.REDIRECT
-    d = defaultdict(set)
-    for s, v, o in svos:
-        d[(s, o)].add(v)
-    maxlen = max(len(vs) for vs in d.values())
-    print(f"Max verbs per (s,o): {maxlen}")
-
-    g = nx.DiGraph()
-    for (s, o), vs in d.items():
-        weight = maxlen / len(vs)  # smaller is better
-        g.add_edge(s, o, weight=weight)
-    rs = nx.pagerank(g.reverse())
-    ranked = sorted(
-        svos, key=lambda x: rs.get(x[0], 0) + rs.get(x[1], 0), reverse=True
-    )
-    if topn <= 0:
-        return ranked
-
-    if redirect:
+    store = as_store(svos)
+    ranks = node_ranks(store)
+    if not isinstance(topn, numbers.Integral):
+        sizes = list(topn)
+        views = {}
+        if redirect and any(n > 0 for n in sizes):
+            print(f"Redirecting to top {', '.join(str(n) for n in sizes if n > 0)} edges based on PageRank")
+            redirected = redirect_edges_no_backflow(store, rank_dict(store, ranks), [n for n in sizes if n > 0])
+            views = {n: list(res) for n, res in redirected.items()}
+        rest = [n for n in sizes if n not in views]
+        if rest:
+            rows = top_rows(triple_scores(store, ranks), 0 if min(rest) <= 0 else max(rest))
+            views.update((n, [store.triple(r) for r in (rows[:n] if n > 0 else rows)]) for n in rest)
+        return {n: views[n] for n in sizes}
+    if topn > 0 and redirect:
         print(f"Redirecting to top {topn} edges based on PageRank")
-        res = redirect_edges_no_backflow(ranked, rs, topn)
+        res = redirect_edges_no_backflow(store, rank_dict(store, ranks), topn)
         return list(res)
 
-    return ranked[0:topn]
+    rows = top_rows(triple_scores(store, ranks), topn)
+    return [store.triple(r) for r in rows]
+
+
+def save_views(fname: str, views: dict, show=None):
+    """
+    Save the views of the edges by size as _top<n>_kb.tsv, _top<n>.pro and
+    _top<n>_graph.html files, opening the graph of size show in the browser.
+    """
+    from vis import visualize_rels
+
+    for n, edges in views.items():
+        vname = f"{fname}_top{n}"
+        with open(vname + "_kb.tsv", "w") as f:
+            for s, v, o in edges:
+                f.write(f"{s}\t{v}\t{o}\n")
+        with open(vname + ".pro", "w") as f:
+            f.write(f"% TOP {n} NODES\n\n")
+            for s, v, o in edges:
+                f.write(f"fact({s},{v},{o}).\n")
+        visualize_rels(edges, vname + "_graph", show=show == n)
+    print(f"Views of the top {', '.join(map(str, views))} nodes stored in {fname}_top<n>_kb.tsv, .pro and _graph.html")
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestSteps(unittest.TestCase):
+    def test_no_steps_left(self):
+        # resuming a finished run asks for nothing, not even the prefetched facts
+        from unittest import mock
+
+        with mock.patch(f"{__name__}.step_facts") as facts:
+            for n in (0, -2):
+                self.assertEqual(list(onto_steps_parallel("q", n, defaultdict(list), set())), [])
+        facts.assert_not_called()
+
+    def test_stream_into_graph(self):
+        # each streamed edge is in the graph before the next line arrives
+        from unittest import mock
+
+        lines = ["fact(fpga, is_a, chip).", "not a fact", "fact(chip, has, gates).", "fact(gates, are, logic)."]
+        edges, seen = TripleStore(), []
+
+        class Answer:
+            cost = 0.0
+
+            def __iter__(self):
+                for line in lines:
+                    seen.append(len(edges))
+                    yield line
+
+            def close(self):
+                pass
+
+        with mock.patch(f"{__name__}.ask_stream", lambda prompt: Answer()):
+            answer, facts, step_edges, _ = stream_facts("What is an FPGA?", edges)
+        self.assertEqual(seen, [0, 1, 1, 2])
+        self.assertEqual(len(step_edges), 3)
+        self.assertEqual(set(edges), set(step_edges))
+        self.assertEqual(facts.count("\n"), 2)
+        self.assertEqual(answer, "\n".join(lines))
+
+    def test_lock_per_run(self):
+        # the stores of concurrent runs do not wait on each other
+        a, b = TripleStore(), TripleStore()
+        self.assertIsNot(edges_lock(a), edges_lock(b))
+        self.assertIs(edges_lock(set()), edges_lock(set()))
+
+    def run_both(self, n: int) -> list[tuple]:
+        """The questions, ddict and edges of n steps on the mock LLM, run one after the other and in parallel."""
+        import io
+        import contextlib
+        from mockllm import mock_llm
+
+        runs = []
+        for steps in (onto_steps, onto_steps_parallel):
+            ddict, edges = defaultdict(list), set()
+            with mock_llm(), contextlib.redirect_stdout(io.StringIO()):
+                quests = [q for q, _, _ in steps("What is an FPGA?", n, ddict, edges)]
+            runs.append((quests, dict(ddict), edges))
+        return runs
+
+    def test_parallel_local_answers(self):
+        # with goals answered from the graph, the parallel steps do what the sequential ones do
+        import mockllm
+        from goals import goal_stats
+
+        saved = CF.LOCAL_ANSWERS, CF.LOCAL_MIN_FACTS, mockllm.VOCABULARY
+        CF.LOCAL_ANSWERS, CF.LOCAL_MIN_FACTS, mockllm.VOCABULARY = True, 1, 40
+        skipped = goal_stats()["skipped_calls"]
+        try:
+            runs = self.run_both(6)
+        finally:
+            CF.LOCAL_ANSWERS, CF.LOCAL_MIN_FACTS, mockllm.VOCABULARY = saved
+        self.assertGreater(goal_stats()["skipped_calls"], skipped)
+        self.assertEqual(runs[0], runs[1])
+
+    def test_parallel_stream_facts(self):
+        # streamed facts end up in the graph the same way in the sequential and parallel steps
+        saved = CF.STREAM_FACTS
+        CF.STREAM_FACTS = True
+        try:
+            runs = self.run_both(4)
+        finally:
+            CF.STREAM_FACTS = saved
+        self.assertTrue(runs[0][2])
+        self.assertEqual(runs[0], runs[1])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
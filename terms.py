@@ -0,0 +1,156 @@
+import re
+import unittest
+from functools import lru_cache
+
+# Parsing of the fact(S, V, O) lines LLMs answer with into edges, and the
+# normalization of their terms, shared by synt, the goals evaluated on the
+# edges and the tools reading the files of runs.
+# The Prolog parser is imported where used, as the fast path rarely needs it.
+
+
+SPACES_RE = re.compile(r"[\s\-]+")
+BOUNDARY_RE = re.compile(
+    r"(?<=[A-Z])(?=[A-Z][a-z])"  # split XMLHTTPRequest -> XML_HTTPRequest
+    r"|(?<=[a-z0-9])(?=[A-Z])"  # split fooBar -> foo_Bar
+    r"|(?<=[A-Za-z])(?=[0-9])"  # letters->digits boundary
+    r"|(?<=[0-9])(?=[A-Za-z])"  # digits->letters boundary
+)
+
+
+def camel_to_snake(s: str) -> str:
+    s = s.strip()
+    s = SPACES_RE.sub("_", s)  # spaces/dashes -> underscore
+    s = BOUNDARY_RE.sub("_", s)
+    return s.lower()
+
+
+@lru_cache(maxsize=1 << 16)
+def uniform_str(s: str) -> str:
+    """Convert a string to a uniform format for comparison."""
+    s = s.strip().replace(" ", "_").replace("-", "_").replace("'", "")
+    s = s.replace("+", "_and_").replace("/", "_or_")
+    s = s.replace('"', "").replace("`", "")
+    s = camel_to_snake(s)
+    return s
+
+
+# the usual shape of a fact line, with plain quoted or unquoted atoms only;
+# anything else is left to the full Prolog parser
+ATOM = r"'[^'\\\n]+'|[a-z][A-Za-z0-9_]*"
+FACT_RE = re.compile(
+    rf"[ \t]*fact\([ \t]*({ATOM})[ \t]*,[ \t]*({ATOM})[ \t]*,[ \t]*({ATOM})[ \t]*\)[ \t]*\.[ \t]*"
+)
+
+
+def to_edge(f: str) -> tuple[str, str, str] | None:
+    """Convert a Prolog fact string to an edge tuple, or return None if malformed."""
+    if not f:
+        return None
+    m = FACT_RE.fullmatch(f)
+    if m is None:
+        return parse_edge(f)
+    s, v, o = (x[1:-1] if x[0] == "'" else x for x in m.groups())
+    if not good_noun(s) or not good_noun(o):
+        print("WARNING: ignoring fact with bad noun:", f, "-->", (s, v, o))
+        return None
+    return (uniform_str(s), uniform_str(v), uniform_str(o))
+
+
+def parse_edge(f: str) -> tuple[str, str, str] | None:
+    """Like to_edge, but parsing the fact with the full Prolog parser."""
+    from natlog.prolog_parser import parse_prolog_clause, VarNum
+
+    if not f:
+        return None
+    try:
+        clause = parse_prolog_clause(f)
+        if not clause:
+            print("WARNING: ignoring unexpected clause:", f, "-->", clause)
+            return None
+        edge = clause[0][0][1:]  # (pred, (s,v,o))
+        if len(edge) != 3:
+            print("WARNING: tuple of length 3 expected:", f, "-->", edge)
+            return None
+
+        for x in edge:
+            if isinstance(x, VarNum):
+                print("WARNING: ignoring fact with variable:", f, "-->", edge)
+                return None
+
+        # return edge
+        s, v, o = edge
+        if not good_noun(s) or not good_noun(o):
+            print("WARNING: ignoring fact with bad noun:", f, "-->", edge)
+            return None
+        return (uniform_str(s), uniform_str(v), uniform_str(o))
+    except Exception as e:
+        print("WARNING: ignoring unparsable fact:", f, "Error:", e)
+        return None
+
+
+def good_noun(s: str) -> bool:
+    """Check if a string is a good noun for generalization."""
+
+    if not s:
+        return False
+    s = s.strip()
+    if len(s) < 3:
+        return False
+    if len(s) > 42:
+        return False
+    if s.lower() in {
+        "this",
+        "that",
+        "these",
+        "those",
+        "you",
+        "we",
+        "she",
+        "they",
+        "them",
+        "what",
+        "which",
+        "who",
+        "whom",
+        "where",
+        "when",
+        "why",
+        "how",
+    }:
+        return False
+    return True
+
+
+def parse_facts(facts: list[str]) -> tuple[list[str], list[tuple]]:
+    """The well-formed fact lines among facts and their edges, each line parsed once."""
+    clean_facts, edges = [], []
+    for f in facts:
+        edge = to_edge(f)
+        if edge is not None:
+            clean_facts.append(f)
+            edges.append(edge)
+    return clean_facts, edges
+
+
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestTerms(unittest.TestCase):
+    def test_uniform_str(self):
+        self.assertEqual(uniform_str("Stable Model"), "stable_model")
+        self.assertEqual(uniform_str("LogicProgram"), "logic_program")
+        self.assertEqual(uniform_str("x-ray/MRI"), "x_ray_or_mri")
+
+    def test_to_edge(self):
+        for f in ("fact(fpga, speeds_up, interpreter).", "fact('Instruction Set', is_a, 'ISA')."):
+            self.assertEqual(to_edge(f), parse_edge(f))
+        self.assertEqual(to_edge("fact('FPGA',speeds_up,interpreter)."), ("fpga", "speeds_up", "interpreter"))
+        self.assertIsNone(to_edge("fact(it, is, fpga)."))
+        self.assertIsNone(to_edge("fact(X, is, fpga)."))
+        self.assertIsNone(to_edge(""))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
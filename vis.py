@@ -1,11 +1,79 @@
-from pyvis.network import Network
-
 import webbrowser
 import os
+import json
+import shutil
+import unittest
+import tempfile
+import numpy as np
+from config import CF
+from store import as_store
+from rank import node_ranks, triple_scores, top_rows
+
+
+def visualize_rels(svos, fname, show=True, edge_labels=None, layout=None, resources="local"):
+    """
+    Show the edges svos as an HTML graph. With layout "physics" the browser
+    lays it out live, with "fixed" the layout is computed here and only the
+    best ranked nodes are drawn, the others collapsed until zoomed in.
+    With "auto" (CF.VIS_LAYOUT by default), "fixed" is used for more than
+    CF.VIS_LIVE_NODES nodes. The scripts of the page are in a lib directory
+    next to it with resources "local", in the page with "in_line".
+    """
+    if edge_labels is None:
+        edge_labels = CF.EDGE_LABELS
+    if layout is None:
+        layout = CF.VIS_LAYOUT
+    svos = list(svos)
+    if layout == "auto":
+        n = len(set(x for (s, _, o) in svos for x in (s, o)))
+        layout = "fixed" if n > CF.VIS_LIVE_NODES else "physics"
+
+    if layout == "fixed":
+        net, script = fixed_net(svos, edge_labels)
+    else:
+        net, script = physics_net(svos, edge_labels), ""
+    net.cdn_resources = resources
+
+    hfile = fname + ".html"
+    write_page(net, hfile, script)
+    assert os.path.exists(hfile), "No such file: " + hfile
+    url = "file://" + os.path.abspath(hfile)
+    if show:
+        browse(url)
+    return url, hfile
+
 
+def write_page(net, hfile: str, script: str = ""):
+    """
+    Write the page of net, with script added, to hfile. Unlike
+    Network.write_html, which copies them to the current directory, the
+    local scripts go to the lib directory next to the page, where it loads
+    them from.
+    """
+    import pyvis
 
-def visualize_rels(svos, fname, show=True, edge_labels=None):
-    if edge_labels is not None:edge_label=CF.EDGE_LABELS
+    html = net.generate_html(notebook=False)
+    k = html.rfind("</body>")
+    html = html[:k] + script + html[k:]
+    if net.cdn_resources == "local":
+        lib = os.path.join(os.path.dirname(pyvis.__file__), "templates", "lib")
+        dest = os.path.join(os.path.dirname(hfile), "lib")
+        for name in ("bindings", "tom-select", "vis-9.1.2"):
+            if not os.path.exists(os.path.join(dest, name)):
+                shutil.copytree(os.path.join(lib, name), os.path.join(dest, name), dirs_exist_ok=True)
+    with open(hfile, "w") as f:
+        f.write(html)
+
+
+def edge_label(v: str, edge_labels) -> str | None:
+    """The label shown for verb v: mapped if edge_labels is a dict, v if True, none if False."""
+    if isinstance(edge_labels, dict):
+        return edge_labels.get(v, v)
+    return v if edge_labels else None
+
+
+def physics_net(svos, edge_labels) -> "Network":
+    from pyvis.network import Network
 
     net = Network(
         directed=True,
@@ -22,8 +90,9 @@ def visualize_rels(svos, fname, show=True, edge_labels=None):
     def add(x, v, y):
         if (x, v, y) not in es:
             es.add((x, v, y))
-            if edge_labels:
-                net.add_edge(x, y, label=edge_labels.get(v, v), color="blue")
+            label = edge_label(v, edge_labels)
+            if label:
+                net.add_edge(x, y, label=label, color="blue")
             else:
                 net.add_edge(x, y, color="blue")
 
@@ -31,13 +100,182 @@ def visualize_rels(svos, fname, show=True, edge_labels=None):
         add(s, v, o)
 
     net.toggle_physics(True)
-    hfile = fname + ".html"
-    net.show(hfile, notebook=False)
-    assert os.path.exists(hfile), "No such file: " + hfile
-    url = "file://" + os.path.abspath(hfile)
-    if show:
-        browse(url)
-    return url, hfile
+    return net
+
+
+def spectral_layout(src: np.ndarray, dst: np.ndarray, n: int, seed: int = 0) -> np.ndarray:
+    """
+    Coordinates of n nodes from the eigenvectors of the normalized adjacency
+    matrix next to the top one, random if they do not converge.
+    """
+    import scipy.sparse as sp
+    from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+
+    rng = np.random.default_rng(seed)
+    if n < 4 or len(src) == 0:
+        return rng.uniform(-1, 1, (n, 2))
+    A = sp.csr_array((np.ones(len(src)), (src, dst)), shape=(n, n))
+    A = A + A.T
+    deg = np.asarray(A.sum(axis=1)).ravel()
+    d = np.divide(1.0, np.sqrt(deg), out=np.zeros(n), where=deg > 0)
+    M = sp.diags_array(d) @ A @ sp.diags_array(d)
+    try:
+        _, vecs = eigsh(M, k=3, which="LA", v0=rng.uniform(-1, 1, n))
+    except ArpackNoConvergence:
+        return rng.uniform(-1, 1, (n, 2))
+    return vecs[:, :2] * d[:, None]
+
+
+def force_layout(
+    src: np.ndarray, dst: np.ndarray, n: int, iters: int = 50, seed: int = 0
+) -> np.ndarray:
+    """
+    Fruchterman-Reingold layout of n nodes, started from the spectral one,
+    with the repulsion of all node pairs computed by matrix products, and
+    coordinates scaled to about 100 pixels between neighbors.
+    """
+    pos = spectral_layout(src, dst, n, seed)
+    if n < 2:
+        return pos * 100
+    rng = np.random.default_rng(seed)
+    span = np.ptp(pos, axis=0).max() or 1.0
+    pos = pos / span + rng.uniform(-1e-3, 1e-3, pos.shape)  # split coinciding nodes
+    k = 1.0 / np.sqrt(n)
+    t = 0.1
+    for _ in range(iters):
+        sq = (pos * pos).sum(axis=1)
+        d2 = np.maximum(sq[:, None] + sq[None, :] - 2 * (pos @ pos.T), 1e-8)
+        w = (k * k) / d2
+        np.fill_diagonal(w, 0.0)
+        disp = pos * w.sum(axis=1)[:, None] - w @ pos  # repulsion
+        d = pos[src] - pos[dst]
+        pull = d * (np.linalg.norm(d, axis=1) / k)[:, None]  # attraction
+        np.add.at(disp, src, -pull)
+        np.add.at(disp, dst, pull)
+        length = np.maximum(np.linalg.norm(disp, axis=1), 1e-9)
+        pos += disp * (np.minimum(length, t) / length)[:, None]
+        t *= 0.95
+    return (pos - pos.mean(axis=0)) * (100 / k)
+
+
+def lod_roots(src: np.ndarray, dst: np.ndarray, n: int, levels: int):
+    """
+    For nodes 0..n-1 numbered by decreasing rank, their level of detail (0 for
+    the best ranked bucket, levels - 1 for the worst) and their root: the
+    node of the top bucket they collapse into, found by following the best
+    ranked better neighbor, or the node itself if it has none.
+    """
+    lod = np.arange(n) * levels // max(n, 1)
+    # the best ranked neighbor of each node, ranked better than the node
+    a = np.concatenate((src, dst))
+    b = np.concatenate((dst, src))
+    better = b < a
+    a, b = a[better], b[better]
+    anchor = np.full(n, -1)
+    k = np.lexsort((b, a))
+    first = np.ones(len(k), dtype=bool)
+    first[1:] = a[k][1:] != a[k][:-1]
+    anchor[a[k][first]] = b[k][first]
+
+    root = np.arange(n)
+    for x in range(n):  # anchors come first, so their roots are known
+        if lod[x] > 0 and anchor[x] >= 0:
+            root[x] = root[anchor[x]]
+    return lod, root
+
+
+def fixed_net(svos, edge_labels) -> tuple["Network", str]:
+    """
+    The network of the CF.VIS_MAX_NODES best ranked nodes and of the
+    CF.VIS_MAX_EDGES best ranked edges between them, laid out with physics
+    off, and the script collapsing the lower ranked ones into their roots
+    until zoomed in. Each doubling of the zoom expands one more level.
+    """
+    from pyvis.network import Network
+
+    store = as_store(svos)
+    ranks = node_ranks(store) if len(store) else np.zeros(len(store.names))
+    ids = np.array(sorted(store.node_ids()), dtype=np.int64)
+    order = ids[np.argsort(-ranks[ids], kind="stable")]
+    levels = max(1, CF.VIS_LOD_LEVELS)
+
+    index = np.full(len(store.names), -1)
+    index[order] = np.arange(len(order))
+    s = index[np.frombuffer(store.subj, dtype=np.int32)]
+    o = index[np.frombuffer(store.obj, dtype=np.int32)]
+    lod, root = lod_roots(s, o, len(order), levels)
+
+    # only the best ranked nodes and edges between them are drawn
+    keep = min(len(order), CF.VIS_MAX_NODES)
+    rows = np.flatnonzero((s < keep) & (o < keep))
+    scores = triple_scores(store, ranks)[rows]
+    rows = rows[top_rows(scores, CF.VIS_MAX_EDGES)]
+    hidden = np.bincount(root[keep:], minlength=len(order))
+    src, dst = s[rows], o[rows]
+    pos = force_layout(src, dst, keep)
+
+    net = Network(directed=True, height="1200px")
+    names = store.names
+    for i in range(keep):
+        name = names[order[i]]
+        title = f"rank {ranks[order[i]]:.2e}"
+        if hidden[i]:
+            title += f", {hidden[i]} more not shown"
+        net.add_node(
+            name, shape="box", color="green", title=title, x=float(pos[i, 0]), y=float(pos[i, 1]),
+            physics=False, lod=int(lod[i]), root=names[order[root[i]]],
+        )
+    for r, i, j in zip(rows, src, dst):
+        label = edge_label(names[store.verb[r]], edge_labels)
+        if label:
+            net.add_edge(names[order[i]], names[order[j]], label=label, color="blue")
+        else:
+            net.add_edge(names[order[i]], names[order[j]], color="blue")
+    net.toggle_physics(False)
+
+    members = {}
+    for i in range(keep):
+        if root[i] != i:
+            members.setdefault(names[order[root[i]]], []).append(int(lod[i]))
+    return net, LOD_SCRIPT % (levels, json.dumps(members).replace("</", "<\\/"))
+
+
+LOD_SCRIPT = """
+<script type="text/javascript">
+  // level of detail: nodes with lod above the level are collapsed into their root
+  var lodLevels = %d;
+  var lodMembers = %s;
+  var lodLevel = -1;
+  var lodBase = 1.0;
+  network.once("afterDrawing", function () { lodBase = network.getScale(); });
+
+  function lodSetLevel(level) {
+    if (level === lodLevel) return;
+    lodLevel = level;
+    Object.keys(network.body.nodes).forEach(function (id) {
+      if (network.isCluster(id)) network.openCluster(id);
+    });
+    for (var r in lodMembers) {
+      var k = lodMembers[r].filter(function (l) { return l > level; }).length;
+      if (k === 0) continue;
+      var pos = network.getPositions([r])[r];
+      network.cluster({
+        joinCondition: function (n) { return n.id === r || (n.root === r && n.lod > level); },
+        clusterNodeProperties: {
+          id: "cluster:" + r, label: r + " (+" + k + ")", shape: "box", color: "orange",
+          x: pos.x, y: pos.y, physics: false
+        }
+      });
+    }
+  }
+
+  network.on("zoom", function (params) {
+    var level = Math.floor(Math.log2(params.scale / lodBase));
+    lodSetLevel(Math.max(0, Math.min(lodLevels - 1, level)));
+  });
+  lodSetLevel(0);
+</script>
+"""
 
 
 def browse(url):
@@ -45,5 +283,53 @@ def browse(url):
     return webbrowser.open(url)
 
 
+# =========================
+#        Unit Tests
+# =========================
+
+
+class TestFixedLayout(unittest.TestCase):
+    def test_lod_roots(self):
+        # 0 is the hub, 1 and 2 hang from it, 3 from 2, 4 is alone
+        src, dst = np.array([0, 0, 2]), np.array([1, 2, 3])
+        lod, root = lod_roots(src, dst, 5, 5)
+        self.assertEqual(list(lod), [0, 1, 2, 3, 4])
+        self.assertEqual(list(root), [0, 0, 0, 0, 4])
+
+    def test_layout_separates_nodes(self):
+        src, dst = np.arange(19), np.arange(1, 20)
+        pos = force_layout(src, dst, 20)
+        self.assertEqual(pos.shape, (20, 2))
+        dist = np.linalg.norm(pos[:, None] - pos[None, :], axis=2) + np.eye(20) * 1e9
+        self.assertGreater(dist.min(), 1.0)
+
+    def test_bounded_html(self):
+        svos = [(f"n{i}", "v", f"n{(i * 7) % 300}") for i in range(300)]
+        max_nodes = CF.VIS_MAX_NODES
+        CF.VIS_MAX_NODES = 50
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                _, hfile = visualize_rels(svos, os.path.join(d, "g"), show=False, layout="fixed")
+                with open(hfile) as f:
+                    html = f.read()
+        finally:
+            CF.VIS_MAX_NODES = max_nodes
+        self.assertIn("lodSetLevel", html)
+        self.assertEqual(html.count('"lod": '), 50)
+
+    def test_assets_next_to_page(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as run:
+            os.chdir(run)
+            try:
+                visualize_rels([("aaa", "v", "bbb")], os.path.join(d, "g"), show=False, layout="physics")
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(os.listdir(run), [])
+            self.assertTrue(os.path.exists(os.path.join(d, "lib", "bindings", "utils.js")))
+            _, hfile = visualize_rels([("aaa", "v", "bbb")], os.path.join(run, "g"), show=False, resources="in_line")
+            self.assertEqual(os.listdir(run), ["g.html"])
+
+
 if __name__ == "__main__":
     visualize_rels([("a", "v", "b"), ("b", "u", "c"), ("c", "w", "a")], "out/rel_graph")